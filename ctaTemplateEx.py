@@ -8,6 +8,7 @@
 4. 封装K线回调注册以及历史K线获取API，对应实盘和回测
 """
 
+import numpy as np
 import pymongo
 
 from ctaAlgo.ctaBase import *
@@ -37,6 +38,9 @@ class CtaTemplate(CtaTemplateOrginal):
         if 'backtestingStartDatetime' in setting:
             self.backtestingStartDatetime = setting['backtestingStartDatetime']
 
+        # 回测时预读的全部K线数组，周期 => KLineArrays
+        self.backtestingKlineArrays = {}
+
     def onInit(self):
         """初始化策略"""
         # 实盘获取当前仓位
@@ -112,6 +116,8 @@ class CtaTemplate(CtaTemplateOrginal):
     def getLastKlines(self, count, period=drEngineEx.ctaKLine.PERIOD_1MIN, from_datetime=None,
                       only_completed=True, newest_tick_datetime=None):
         """获取最近的历史K线
+        实盘时可在任意线程中调用。配置了kline_dispatch_workers时onBar在工作线程中执行，
+        返回的K线为拷贝；否则最新一根更新中的K线为K线生成器中继续更新的对象。
 
         :param count: 获取K线的数量
         :param period: 获取K线的周期
@@ -130,11 +136,38 @@ class CtaTemplate(CtaTemplateOrginal):
         return list(col.find(filter={'datetime': {'$lte': from_datetime}},
                              projection={'_id': False},
                              limit=count,
-                             sort=(('date', pymongo.DESCENDING),
-                                   ('time', pymongo.DESCENDING))))
+                             sort=(('datetime', pymongo.DESCENDING),)))
+
+    def getLastKlineArrays(self, count, period=drEngineEx.ctaKLine.PERIOD_1MIN, from_datetime=None,
+                           only_completed=True, newest_tick_datetime=None):
+        """获取最近的历史K线的数组视图，参数同getLastKlines
+        与getLastKlines不同，返回值为按时间升序排列的只读numpy数组，不产生拷贝，
+        适合需要对大量K线计算指标的策略。
+        配置了kline_dispatch_workers时onBar在工作线程中执行，返回值为拷贝，不随之后的tick变化。
+
+        :return: drEngineEx.ctaKLine.KLineArrays
+        """
+        # 实盘使用K线生成器获取
+        if not self.inBacktesting:
+            return self.ctaEngine.mainEngine.drEngine.kline_gen.get_last_kline_arrays(
+                    self.vtSymbol, count, period, only_completed, newest_tick_datetime)
+
+        # 非实盘首次调用时从数据库中读取该周期全部K线，之后按时间截取
+        if period not in self.backtestingKlineArrays:
+            col = self.ctaEngine.dbClient[drEngineEx.ctaKLine.KLINE_DB_NAMES[period]][self.vtSymbol]
+            self.backtestingKlineArrays[period] = drEngineEx.ctaKLine.make_kline_arrays(
+                    col.find(projection={'_id': False}, sort=(('datetime', pymongo.ASCENDING),)))
+        arrays = self.backtestingKlineArrays[period]
+
+        stop = (len(arrays.datetime) if from_datetime is None else
+                int(np.searchsorted(arrays.datetime, np.datetime64(from_datetime, 'us'), side='right')))
+        start = max(stop - count, 0)
+        return drEngineEx.ctaKLine.KLineArrays(*[array[start:stop] for array in arrays])
 
     def registerOnbar(self, periods):
         """注册K线回调
+        配置了kline_dispatch_workers时onBar不在事件引擎线程中执行，可能与onTick、onTrade等同时执行，
+        访问与这些回调共用的状态时需要自行同步；同一策略的onBar按K线完成顺序串行执行。
 
         :param periods: 周期集合
         :return:
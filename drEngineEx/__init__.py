@@ -1,13 +1,12 @@
 # encoding: UTF-8
 
-import copy
-import datetime as dt
 import json
 import os
-from collections import defaultdict
 
 from dataRecorder import drEngine
-from . import ctaKLine, ctaMongo
+from eventEngine import Event
+from eventType import EVENT_TIMER
+from . import ctaDispatch, ctaKLine, ctaMongo, ctaPipeline, ctaProfile, ctaShard, ctaShm
 
 # 默认采集周期，仅在无法读取配置文件时有效
 DEFAULT_PERIODS = (ctaKLine.PERIOD_1MIN,
@@ -15,9 +14,21 @@ DEFAULT_PERIODS = (ctaKLine.PERIOD_1MIN,
                    ctaKLine.PERIOD_30MIN,
                    ctaKLine.PERIOD_60MIN)
 
+# 数据库写入统计信息事件，事件数据参照ctaMongo.get_write_stats
+EVENT_DR_WRITE_STATS = 'eDrWriteStats'
+
+# K线完成回调分发统计信息事件，事件数据参照ctaDispatch.KlineDispatcher.report
+EVENT_DR_DISPATCH_STATS = 'eDrDispatchStats'
+
+# K线生成进程统计信息事件，事件数据参照ctaShard.ShardedTickPipeline.report
+EVENT_DR_SHARD_STATS = 'eDrShardStats'
+
 # 数据采集配置文件
 CONFIG_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'CTADR_setting.json')
 
+# 默认写前日志目录，配置文件中的相对路径也以配置文件所在目录为基准
+DEFAULT_JOURNAL_DIR = 'journal'
+
 
 class CtaDrEngine(drEngine.DrEngine):
     """数据采集引擎
@@ -35,9 +46,6 @@ class CtaDrEngine(drEngine.DrEngine):
         """
         super(CtaDrEngine, self).__init__(mainEngine, eventEngine)
 
-        # 启动数据库异步写入进程
-        ctaMongo.init_db_write_process()
-
         try:
             # 从配置文件中获取需要的采集周期
             with open(CONFIG_FILE) as fp:
@@ -45,15 +53,89 @@ class CtaDrEngine(drEngine.DrEngine):
                 self.kline_periods = settings['recording_kline_periods']
                 self.recording_tick = settings['recording_tick']
         except:
+            settings = {}
             self.kline_periods = DEFAULT_PERIODS
             self.recording_tick = False
 
-        # K线生成器
-        self.kline_gen = ctaKLine.KLineGenerator(periods=self.kline_periods,
-                                                 recording_tick=self.recording_tick)
+        # 启动数据库异步写入进程
+        journal_dir = settings.get('db_write_journal_dir', DEFAULT_JOURNAL_DIR)
+        if journal_dir:
+            journal_dir = os.path.join(os.path.dirname(CONFIG_FILE), journal_dir)
+        ctaMongo.init_db_write_process(
+                shards=settings.get('db_write_shards', ctaMongo.DEFAULT_WRITE_SHARDS),
+                batch_size=settings.get('db_write_batch_size', ctaMongo.DEFAULT_WRITE_BATCH_SIZE),
+                linger=settings.get('db_write_linger', ctaMongo.DEFAULT_WRITE_LINGER),
+                kline_flush_interval=settings.get('kline_flush_interval', ctaMongo.DEFAULT_KLINE_FLUSH_INTERVAL),
+                journal_dir=journal_dir)
+
+        # 配置了发布时，K线同时发布到共享内存供其他进程读取
+        shm_dir = shm_capacity = None
+        if settings.get('kline_shm_publish', False):
+            shm_dir = settings.get('kline_shm_dir') or ctaShm.DEFAULT_SHM_DIR
+            shm_capacity = settings.get('kline_shm_capacity', ctaShm.DEFAULT_SHM_CAPACITY)
+
+        kline_workers = settings.get('kline_worker_processes', 0)
+        if kline_workers:
+            # 分片模式下K线在子进程中生成，主进程的K线生成器只保存已注册回调的周期的已完成K线
+            self.kline_gen = ctaKLine.KLineGenerator(periods=())
+            self.tick_pipeline = ctaShard.ShardedTickPipeline(
+                    self.kline_gen, self.activeSymbolDict, kline_workers,
+                    dict(periods=self.kline_periods,
+                         recording_tick=self.recording_tick,
+                         cascade=settings.get('cascade_kline_periods', False),
+                         symbol_periods=settings.get('recording_kline_symbol_periods'),
+                         kline_flush_interval=settings.get('kline_flush_interval',
+                                                           ctaMongo.DEFAULT_KLINE_FLUSH_INTERVAL),
+                         shm_dir=shm_dir,
+                         shm_capacity=shm_capacity))
+        else:
+            # K线生成器，各合约只生成记录周期及已注册回调的周期
+            self.kline_gen = ctaKLine.KLineGenerator(periods=self.kline_periods,
+                                                     recording_tick=self.recording_tick,
+                                                     cascade=settings.get('cascade_kline_periods', False),
+                                                     symbol_periods=settings.get('recording_kline_symbol_periods'))
+            if shm_dir:
+                self.kline_gen.publisher = ctaShm.BarPublisher(shm_dir, shm_capacity)
+
+            # 在后台预读已订阅合约的历史K线
+            self.kline_gen.warm_up(set(self.tickDict.keys()) | set(self.barDict.keys()))
+
+            # tick处理流程，与回放历史tick共用
+            self.tick_pipeline = ctaPipeline.TickPipeline(self.kline_gen, self.activeSymbolDict)
 
         # K线完成事件回调集合，合约代码 => 采集周期 => 回调列表
-        self.kline_completed_listeners = defaultdict(lambda: defaultdict(list))
+        self.kline_completed_listeners = self.tick_pipeline.kline_completed_listeners
+
+        # 配置了工作线程数时，K线完成回调由线程池异步执行，否则在tick处理线程中执行
+        dispatch_workers = settings.get('kline_dispatch_workers', 0)
+        if dispatch_workers:
+            self.tick_pipeline.dispatcher = ctaDispatch.KlineDispatcher(dispatch_workers)
+            # 工作线程中获取的过去K线不随tick线程的更新而变化
+            self.kline_gen.snapshot_reads = True
+
+        # tick处理各阶段耗时记录，默认关闭
+        self.tick_profiler = ctaProfile.TickProfiler()
+        if settings.get('profile_tick_path', False):
+            self.tick_pipeline.set_profiler(self.tick_profiler)
+
+        # 行情清淡时由定时器负责将暂存的更新中K线写入数据库
+        self.eventEngine.register(EVENT_TIMER, self.processTimerEvent)
+
+    def stop(self):
+        """停止引擎
+        在父类行为的基础上，等待K线生成进程处理完剩余的tick、已入队的K线完成回调执行完毕，
+        以及所有数据库写入进程完成剩余任务后退出。
+
+        :return:
+        """
+        super(CtaDrEngine, self).stop()
+        self.tick_pipeline.stop()
+        if self.tick_pipeline.dispatcher:
+            self.tick_pipeline.dispatcher.stop()
+        if self.kline_gen.publisher:
+            self.kline_gen.publisher.close()
+        self.kline_gen.flush(self.activeSymbolDict)
+        ctaMongo.stop_db_write_process()
 
     def insertData(self, dbName, collectionName, data):
         """屏蔽父类的数据库写入行为
@@ -75,30 +157,70 @@ class CtaDrEngine(drEngine.DrEngine):
         """
         super(CtaDrEngine, self).procecssTickEvent(event)
 
-        # 获取tick的拷贝，对其进行修改
-        tick = copy.deepcopy(event.dict_['data'])
+        # 规范化tick、更新K线，K线完成时执行回调
+        self.tick_pipeline.process(event.dict_['data'])
+
+    def processTimerEvent(self, event):
+        """处理定时器事件
+        刷新暂存的更新中K线，处理K线生成进程送回的K线；收到写入进程的统计信息时，以EVENT_DR_WRITE_STATS事件发布；
+        异步分发K线完成回调时，定期以EVENT_DR_DISPATCH_STATS事件发布各监听者的统计信息；
+        分片模式下，定期以EVENT_DR_SHARD_STATS事件发布各K线生成进程的队列积压。
+
+        :param event: 定时器事件
+        :return:
+        """
+        self.kline_gen.flush(self.activeSymbolDict)
+        self.tick_pipeline.poll()
+
+        stats = ctaMongo.get_write_stats()
+        if stats['updated']:
+            stats_event = Event(type_=EVENT_DR_WRITE_STATS)
+            stats_event.dict_['data'] = stats
+            self.eventEngine.put(stats_event)
+
+        dispatcher = self.tick_pipeline.dispatcher
+        if dispatcher and dispatcher.is_due():
+            stats_event = Event(type_=EVENT_DR_DISPATCH_STATS)
+            stats_event.dict_['data'] = dispatcher.report()
+            self.eventEngine.put(stats_event)
+
+        pipeline = self.tick_pipeline
+        if isinstance(pipeline, ctaShard.ShardedTickPipeline) and pipeline.is_due():
+            stats_event = Event(type_=EVENT_DR_SHARD_STATS)
+            stats_event.dict_['data'] = pipeline.report()
+            self.eventEngine.put(stats_event)
+
+    def enableTickProfiling(self, enabled=True):
+        """开启或关闭tick处理各阶段耗时的记录，已有记录保留
+
+        :param enabled: 是否开启
+        :return:
+        """
+        self.tick_pipeline.set_profiler(self.tick_profiler if enabled else None)
 
-        # 将tick中的字母信息统一修改为大写
-        tick.symbol = tick.symbol.upper()
-        tick.exchange = tick.exchange.upper()
-        tick.vtSymbol = tick.vtSymbol.upper()
+    def getTickProfile(self):
+        """获取tick处理各阶段的耗时分布
 
-        # 提前计算tick时间
-        tick.datetime = dt.datetime.strptime(' '.join([tick.date, tick.time]), '%Y%m%d %H:%M:%S.%f')
+        :return: 参照ctaProfile.TickProfiler.snapshot
+        """
+        return self.tick_profiler.snapshot()
 
-        # 更新K线
-        updated_klines = self.kline_gen.update(tick, self.activeSymbolDict)
-        if not updated_klines:
-            return
+    def dumpTickProfile(self, filename=None):
+        """输出tick处理各阶段的耗时分布
 
-        # K线完成时执行回调
-        for p in self.kline_periods:
-            if updated_klines[p].is_completed:
-                map(lambda callback: callback(updated_klines[p].updated_kline),
-                    self.kline_completed_listeners[updated_klines[p].updated_kline.symbol][p])
+        :param filename: JSON文件名，默认输出文本至标准输出
+        :return: 参照ctaProfile.TickProfiler.snapshot
+        """
+        if filename:
+            return self.tick_profiler.dump(filename)
+        rows = self.tick_profiler.snapshot()
+        print(ctaProfile.format_profile(rows))
+        return rows
 
     def registerKlineCompletedEvent(self, symbol, period_callback_dict):
         """注册K线完成事件回调
+        配置了kline_dispatch_workers时，回调不在事件引擎线程中，而在工作线程中执行，
+        同一对象的回调按K线完成顺序串行执行，回调中获取的过去K线为拷贝。
 
         :param symbol: 交易的合约代码
         :param period_callback_dict: 采集周期对应回调的字典
@@ -107,6 +229,10 @@ class CtaDrEngine(drEngine.DrEngine):
         for k, v in period_callback_dict.items():
             self.kline_completed_listeners[symbol.upper()][k].append(v)
 
+        # 生成注册的周期，交易的合约可能不在采集配置中，提前预读其历史K线
+        self.tick_pipeline.add_demand(symbol, period_callback_dict.keys())
+        self.kline_gen.warm_up((symbol,))
+
     def removeKlineCompletedEvent(self, symbol, period_callback_dict):
         """注销K线完成事件回调
 
@@ -116,3 +242,6 @@ class CtaDrEngine(drEngine.DrEngine):
         """
         for k, v in period_callback_dict.items():
             self.kline_completed_listeners[symbol.upper()][k].remove(v)
+
+        # 不再需要的周期停止生成
+        self.tick_pipeline.remove_demand(symbol, period_callback_dict.keys())
@@ -0,0 +1,280 @@
+# encoding: UTF-8
+
+import argparse
+import datetime as dt
+from collections import namedtuple
+
+import numpy as np
+
+from . import ctaCalendar
+from . import ctaMongo
+from . import ctaTimeline
+from .ctaKLine import (
+    KLINE_DB_NAMES,
+    KLineArrays,
+    MINUTES_OF_PERIOD,
+    TICK_DB_NAME,
+    TickTime,
+    compile_kline_table,
+    empty_kline_arrays,
+)
+from .ctaTimeline import (
+    BIAS_MINUTES,
+    MINUTES_OF_DAY,
+)
+
+"""
+【由历史tick批量生成K线】
+修正交易时间配置或增加采集周期后，需要由数据库中的tick重新生成K线。
+aggregate_ticks使用numpy一次处理一个交易日的全部tick，结果与按时间顺序逐个tick更新KLineGenerator相同：
+    1. 按交易时间线的有效分钟表过滤非交易时间的tick；
+    2. 由当日累计成交量的差值计算每个tick的成交量，负值（跨交易日的反转）记为0；
+    3. 按ctaKLine.compile_kline_table的查找表计算K线时间（K线结束时间，日线为交易日零时），
+       需要调整至交易日的K线（周五夜盘、日线等）按交易日历调整；
+    4. K线时间相同的连续tick归入同一根K线，开盘价为时间最早的tick，收盘价为时间最晚的tick中最先出现的一个。
+
+rebuild_klines按交易日逐日读取tick数据库，生成各周期K线后同步写入K线数据库，替换同一时间的已有K线。
+命令行运行方式：python -m dataRecorder.drEngineEx.ctaAggregate 合约代码 交易所代码 开始日期 结束日期 [-p 周期 ...]
+"""
+
+# 批量生成K线所需的tick字段
+TICK_ARRAY_FIELDS = ('datetime', 'lastPrice', 'volume')
+
+# tick数组，各字段为按时间升序排列的numpy数组
+TickArrays = namedtuple('TickArrays', TICK_ARRAY_FIELDS)
+
+# tick数组各字段的类型
+TICK_COLUMNS = (
+    ('datetime', 'M8[us]'),
+    ('lastPrice', 'f8'),
+    ('volume', 'f8'),
+)
+
+# 与KLine初始值相同的最高价、最低价下限和上限
+KLINE_HIGH_FLOOR = 0
+KLINE_LOW_CEILING = 0x7FFFFFFFF
+
+# 交易日开始的时刻，前一交易日该时刻之后的tick（夜盘）属于当前交易日
+TRADING_DAY_START = dt.time(24 - ctaTimeline.HOUR_BIAS)
+
+# 默认生成的周期
+ALL_PERIODS = tuple(range(len(KLINE_DB_NAMES)))
+
+
+def make_tick_arrays(docs):
+    """根据数据库中的tick记录生成tick数组
+
+    :param docs: 按时间升序排列的tick记录
+    :return: TickArrays
+    """
+    return TickArrays(*[np.array([doc[name] for doc in docs], dtype) for name, dtype in TICK_COLUMNS])
+
+
+def compile_kline_arrays_table(period, trade_timeline):
+    """将K线时间查找表转换为数组形式，参照ctaKLine.compile_kline_table
+
+    :param period: K线周期常量
+    :param trade_timeline: 交易时间线
+    :return: (到K线时间的分钟差数组, 是否需要调整至交易日数组, 分钟是否属于K线数组)，均以偏移后的分钟数为索引
+    """
+    # 尝试从缓存中获取已计算的结果
+    memorize_key = (period, tuple(trade_timeline))
+    if memorize_key in compile_kline_arrays_table.__dict__:
+        return compile_kline_arrays_table.__dict__[memorize_key]
+
+    offsets = np.zeros(MINUTES_OF_DAY, 'm8[m]')
+    to_working_days = np.zeros(MINUTES_OF_DAY, bool)
+    found = np.zeros(MINUTES_OF_DAY, bool)
+    for minute, entry in enumerate(compile_kline_table(period, trade_timeline)):
+        if entry is not None:
+            timedelta_tick2kline, to_working_days[minute] = entry
+            offsets[minute] = int(timedelta_tick2kline.total_seconds()) // 60
+            found[minute] = True
+
+    table = (offsets, to_working_days, found)
+    compile_kline_arrays_table.__dict__[memorize_key] = table
+    return table
+
+
+def aggregate_ticks(ticks, period, trade_timeline, last_volume=None):
+    """将一段时间的tick批量生成K线
+
+    :param ticks: TickArrays，或包含datetime、lastPrice、volume字段的numpy结构化数组，按时间升序排列
+    :param period: K线周期常量
+    :param trade_timeline: tick品种的交易时间线
+    :param last_volume: 上一个有效tick的当日累计成交量，默认为None，即第一个有效tick的成交量记为0
+    :return: KLineArrays，按K线时间升序排列
+    """
+    if isinstance(ticks, np.ndarray):
+        ticks = TickArrays(*[ticks[name] for name in TICK_ARRAY_FIELDS])
+    datetimes = np.asarray(ticks.datetime, 'M8[us]')
+    prices = np.asarray(ticks.lastPrice, 'f8')
+    volumes = np.asarray(ticks.volume, 'f8')
+
+    # 过滤非交易时间的tick
+    minutes = datetimes.astype('M8[m]')
+    valid = valid_minute_mask(minutes, trade_timeline)
+    if not valid.all():
+        datetimes, prices, volumes, minutes = datetimes[valid], prices[valid], volumes[valid], minutes[valid]
+    if not len(datetimes):
+        return empty_kline_arrays()
+
+    # 由累计成交量的差值计算每个tick的成交量
+    prev_volumes = np.empty_like(volumes)
+    prev_volumes[0] = volumes[0] if last_volume is None else last_volume
+    prev_volumes[1:] = volumes[:-1]
+    last_volumes = np.maximum(volumes - prev_volumes, 0)
+
+    return reduce_klines(calc_kline_datetimes(minutes, period, trade_timeline),
+                         KLineArrays(datetime=datetimes, open=prices, high=prices, low=prices, close=prices,
+                                     volume=last_volumes, open_datetime=datetimes, close_datetime=datetimes))
+
+
+def valid_minute_mask(minutes, trade_timeline):
+    """批量判断分钟是否在交易时间内，结果与ctaTimeline.is_valid_tick相同
+
+    :param minutes: datetime64[m]数组
+    :param trade_timeline: 交易时间线
+    :return: bool数组
+    """
+    valid_minutes = np.frombuffer(ctaTimeline.compile_valid_minutes(trade_timeline), np.uint8)
+    return valid_minutes[_biased_minutes(minutes)] == 1
+
+
+def calc_kline_datetimes(minutes, period, trade_timeline):
+    """批量计算K线时间，结果与KLineGenImpl._calc_kline_datetime相同
+
+    :param minutes: 交易时间内的分钟，datetime64[m]数组
+    :param period: K线周期常量
+    :param trade_timeline: 交易时间线
+    :return: datetime64[us]数组
+    """
+    biased_minutes = _biased_minutes(minutes)
+    offsets, to_working_days, found = compile_kline_arrays_table(period, trade_timeline)
+    if not found[biased_minutes].all():
+        raise LookupError('找不到Tick数据对应的K线时间。')
+
+    kline_minutes = minutes + offsets[biased_minutes]
+    adjusting = to_working_days[biased_minutes]
+    if adjusting.any():
+        days = kline_minutes[adjusting].astype('M8[D]')
+        kline_minutes[adjusting] += ctaCalendar.next_trading_days(days) - days
+    return kline_minutes.astype('M8[us]')
+
+
+def reduce_klines(kline_datetimes, parts):
+    """将K线时间相同的连续tick或较短周期K线合并为K线，规则与KLine.update和KLine.merge相同：
+    开盘价取开盘时间最早者中最先出现的一个，收盘价取收盘时间最晚者中最先出现的一个。
+
+    :param kline_datetimes: 各部分所属K线的时间，datetime64[us]数组
+    :param parts: 按时间升序排列的KLineArrays，tick的开盘、收盘时间均为tick时间
+    :return: KLineArrays
+    """
+    # K线时间不随原数据时间单调递增时（不应出现），按K线时间稳定排序，同一K线内保持原顺序
+    if (kline_datetimes[1:] < kline_datetimes[:-1]).any():
+        order = np.argsort(kline_datetimes, kind='mergesort')
+        kline_datetimes = kline_datetimes[order]
+        parts = KLineArrays(*[column[order] for column in parts])
+
+    # K线时间相同的连续部分为同一根K线
+    starts = np.flatnonzero(np.concatenate(([True], kline_datetimes[1:] != kline_datetimes[:-1])))
+    lengths = np.diff(np.append(starts, len(kline_datetimes)))
+    positions = np.arange(len(kline_datetimes))
+
+    def first_of(datetimes, reduce_ufunc):
+        # 各组中时间等于组内极值的第一个位置
+        extremes = np.repeat(reduce_ufunc.reduceat(datetimes, starts), lengths)
+        return np.minimum.reduceat(np.where(datetimes == extremes, positions, len(positions)), starts)
+
+    open_idx = first_of(parts.open_datetime, np.minimum)
+    close_idx = first_of(parts.close_datetime, np.maximum)
+
+    return KLineArrays(
+            datetime=kline_datetimes[starts],
+            open=parts.open[open_idx],
+            high=np.maximum(np.maximum.reduceat(parts.high, starts), KLINE_HIGH_FLOOR),
+            low=np.minimum(np.minimum.reduceat(parts.low, starts), KLINE_LOW_CEILING),
+            close=parts.close[close_idx],
+            volume=np.add.reduceat(parts.volume, starts),
+            open_datetime=parts.open_datetime[open_idx],
+            close_datetime=parts.close_datetime[close_idx])
+
+
+def _biased_minutes(minutes):
+    """计算偏移后的分钟数
+
+    :param minutes: datetime64[m]数组
+    :return: int64数组
+    """
+    return (minutes.astype(np.int64) + BIAS_MINUTES) % MINUTES_OF_DAY
+
+
+def encode_kline_arrays(symbol, arrays):
+    """将K线数组编码为K线数据列表
+
+    :param symbol: 合约代码
+    :param arrays: KLineArrays
+    :return: 按KLINE_FIELDS编码的K线数据列表
+    """
+    columns = [getattr(arrays, name).tolist() for name in ctaMongo.KLINE_FIELDS[1:]]
+    return [(symbol,) + row for row in zip(*columns)]
+
+
+def load_trading_day_ticks(colname, trading_day):
+    """从tick数据库读取一个交易日（包括前一交易日夜盘）的tick
+
+    :param colname: 集合名
+    :param trading_day: 交易日，dt.date
+    :return: TickArrays
+    """
+    start = dt.datetime.combine(ctaCalendar.previous_trading_day(trading_day), TRADING_DAY_START)
+    end = dt.datetime.combine(trading_day, TRADING_DAY_START)
+    return make_tick_arrays(ctaMongo.find_ticks(TICK_DB_NAME, colname, start, end, TICK_ARRAY_FIELDS))
+
+
+def rebuild_klines(symbol, exchange, first_day, last_day, periods=ALL_PERIODS, colname=None):
+    """由tick数据库中的历史tick重新生成一段日期内的K线，写入K线数据库
+    按交易日逐日读取tick并生成各周期K线，写入时替换同一时间的已有K线。
+
+    :param symbol: 合约代码
+    :param exchange: 交易所代码，用于确定交易时间线
+    :param first_day: 开始交易日（包含），dt.date
+    :param last_day: 结束交易日（包含），dt.date
+    :param periods: K线周期常量列表，默认为全部周期
+    :param colname: tick和K线的集合名，默认为合约代码，也可以指定主力合约等别名
+    :return: 周期 => 写入的K线数目
+    """
+    symbol = symbol.upper()
+    colname = colname or symbol
+    trade_timeline = ctaTimeline.timeline_for_tick(TickTime(symbol, exchange.upper(), None))
+
+    counts = dict.fromkeys(periods, 0)
+    for trading_day in ctaCalendar.trading_days_between(first_day, last_day):
+        ticks = load_trading_day_ticks(colname, trading_day)
+        for period in periods:
+            arrays = aggregate_ticks(ticks, period, trade_timeline)
+            ctaMongo.write_klines(KLINE_DB_NAMES[period], colname, encode_kline_arrays(symbol, arrays))
+            counts[period] += len(arrays.datetime)
+        print('{} 交易日 {}，tick {} 个。'.format(colname, trading_day, len(ticks.datetime)))
+    return counts
+
+
+def main():
+    parse_date = lambda s: dt.datetime.strptime(s, '%Y%m%d').date()
+
+    parser = argparse.ArgumentParser(description='由历史tick重新生成K线')
+    parser.add_argument('symbol', help='合约代码')
+    parser.add_argument('exchange', help='交易所代码')
+    parser.add_argument('first_day', type=parse_date, help='开始交易日，YYYYMMDD')
+    parser.add_argument('last_day', type=parse_date, help='结束交易日，YYYYMMDD')
+    parser.add_argument('-p', '--periods', type=int, nargs='+', default=ALL_PERIODS, help='K线周期常量')
+    parser.add_argument('-c', '--colname', help='集合名，默认为合约代码')
+    args = parser.parse_args()
+
+    counts = rebuild_klines(args.symbol, args.exchange, args.first_day, args.last_day, args.periods, args.colname)
+    for period, count in sorted(counts.items()):
+        print('{}分钟K线 {} 根。'.format(MINUTES_OF_PERIOD[period], count))
+
+
+if __name__ == '__main__':
+    main()
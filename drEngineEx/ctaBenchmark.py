@@ -0,0 +1,526 @@
+# encoding: UTF-8
+
+"""
+数据采集热点路径的性能测试
+运行方式：python -m dataRecorder.drEngineEx.ctaBenchmark [-o 结果文件] [-c 对比的结果文件] [--quick]
+
+包括两部分：
+    1. 各热点函数的单项测试；
+    2. 吞吐量测试：用合成的一个交易日的tick驱动与CtaDrEngine.procecssTickEvent相同的处理流程
+       （ctaPipeline.TickPipeline → KLineGenerator.update → ctaMongo），数据库写入由内存中的MemorySink代替，
+       覆盖不同的品种组合、全部K线周期、级联模式以及主力合约别名的写入，
+       报告每秒处理的tick数、单个tick处理耗时的百分位以及内存增长。
+吞吐量测试的结果可保存为JSON文件，并与之前保存的结果对比，吞吐量下降超过阈值时以非零状态退出。
+"""
+
+import argparse
+import copy
+import cPickle
+import datetime as dt
+import gc
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import timeit
+from collections import namedtuple
+
+import numpy as np
+
+from vtGateway import VtTickData
+
+from . import ctaAggregate, ctaCalendar, ctaKLine, ctaMongo, ctaPipeline, ctaResample, ctaTick, ctaTimeline
+
+# 默认测试次数
+DEFAULT_NUMBER = 100000
+
+# 合成tick使用的品种组合，(合约代码, 交易所, 基准价格)
+SYMBOL_MIXES = {
+    'night_shfe': (('RB1705', 'SHFE', 3000.0), ('AU1706', 'SHFE', 280.0), ('CU1705', 'SHFE', 47000.0)),
+    'night_dce': (('M1709', 'DCE', 2800.0), ('I1709', 'DCE', 600.0), ('J1709', 'DCE', 1700.0)),
+    'day_only': (('C1709', 'DCE', 1700.0), ('JD1709', 'DCE', 4000.0), ('IF1706', 'CFFEX', 3400.0)),
+}
+SYMBOL_MIXES['mixed'] = SYMBOL_MIXES['night_shfe'] + SYMBOL_MIXES['night_dce'] + SYMBOL_MIXES['day_only']
+
+# 全部K线周期
+ALL_PERIODS = tuple(range(ctaKLine.PERIOD_1MIN, ctaKLine.PERIOD_1DAY + 1))
+
+# 吞吐量测试场景
+Scenario = namedtuple('Scenario', 'name mix periods cascade active recording_tick')
+SCENARIOS = (
+    Scenario('night_shfe_1min', 'night_shfe', (ctaKLine.PERIOD_1MIN,), False, False, False),
+    Scenario('night_shfe_all', 'night_shfe', ALL_PERIODS, False, False, False),
+    Scenario('night_dce_all', 'night_dce', ALL_PERIODS, False, False, False),
+    Scenario('day_only_all', 'day_only', ALL_PERIODS, False, False, False),
+    Scenario('mixed_all', 'mixed', ALL_PERIODS, False, False, False),
+    Scenario('mixed_all_active', 'mixed', ALL_PERIODS, False, True, False),
+    Scenario('mixed_all_active_tick', 'mixed', ALL_PERIODS, False, True, True),
+    Scenario('mixed_all_cascade', 'mixed', ALL_PERIODS, True, False, False),
+)
+
+# 合成tick的交易日
+SYNTHETIC_TRADING_DAY = dt.date(2017, 3, 3)
+
+# 合成tick中每个合约的tick间隔（毫秒），快速模式使用较大的间隔
+DEFAULT_TICK_INTERVAL = 500
+QUICK_TICK_INTERVAL = 5000
+
+# 交易时间外tick的比例，用于覆盖无效tick的处理
+INVALID_TICK_RATIO = 0.01
+
+# 单个tick处理耗时统计的百分位
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# 结果文件格式版本
+RESULT_VERSION = 1
+
+# 与之前的结果对比时，吞吐量下降超过该比例视为性能退化
+REGRESSION_THRESHOLD = 0.2
+
+
+def make_tick(symbol='RB1705', exchange='SHFE', datetime=dt.datetime(2017, 3, 1, 9, 30, 0, 500000)):
+    """生成一个字段完整的测试用tick
+
+    :param symbol: 合约代码
+    :param exchange: 交易所代码
+    :param datetime: tick时间
+    :return: VtTickData
+    """
+    tick = VtTickData()
+    tick.gatewayName = 'CTP'
+    tick.symbol = symbol
+    tick.exchange = exchange
+    tick.vtSymbol = symbol
+    tick.lastPrice = 3000.0
+    tick.lastVolume = 2
+    tick.volume = 123456
+    tick.openInterest = 654321
+    tick.date = datetime.strftime('%Y%m%d')
+    tick.time = datetime.strftime('%H:%M:%S.%f')[:10]
+    tick.datetime = datetime
+    tick.openPrice = tick.highPrice = tick.lowPrice = tick.preClosePrice = 3000.0
+    tick.upperLimit = 3300.0
+    tick.lowerLimit = 2700.0
+    for i in range(1, 6):
+        setattr(tick, 'bidPrice{}'.format(i), 3000.0 - i)
+        setattr(tick, 'askPrice{}'.format(i), 3000.0 + i)
+        setattr(tick, 'bidVolume{}'.format(i), 10 * i)
+        setattr(tick, 'askVolume{}'.format(i), 10 * i)
+    return tick
+
+
+def make_kline(symbol='RB1705', datetime=dt.datetime(2017, 3, 1, 9, 31)):
+    """生成一根测试用K线
+
+    :param symbol: 合约代码
+    :param datetime: K线时间
+    :return: KLine
+    """
+    kline = ctaKLine.KLine(datetime)
+    kline.symbol = kline.vtSymbol = symbol
+    kline.update(make_tick(symbol, datetime=datetime - dt.timedelta(seconds=30)))
+    return kline
+
+
+def _best_per_call(stmt, number):
+    """多次计时取最好结果，返回单次调用的微秒数"""
+    return min(timeit.repeat(stmt, number=number, repeat=3)) / number * 1e6
+
+
+def bench_wire_format(number=DEFAULT_NUMBER):
+    """写入任务序列化开销测试
+    比较直接传输对象与传输编码后元组时，tick线程上序列化写入任务的耗时以及数据量。
+
+    :param number: 测试次数
+    :return: 测试结果字典
+    """
+    tick = make_tick()
+    kline = make_kline()
+    dumps = cPickle.dumps
+    protocol = cPickle.HIGHEST_PROTOCOL
+    name = ctaKLine.TICK_DB_NAME
+
+    results = {}
+    for kind, obj, encode in (('tick', tick, ctaMongo.encode_tick),
+                              ('kline', kline, ctaMongo.encode_kline)):
+        results[kind] = {
+            'object_us': _best_per_call(lambda: dumps(('task', (name, 'RB1705', obj)), protocol), number),
+            'encoded_us': _best_per_call(lambda: dumps(('task', (name, 'RB1705', encode(obj))), protocol), number),
+            'object_bytes': len(dumps(('task', (name, 'RB1705', obj)), protocol)),
+            'encoded_bytes': len(dumps(('task', (name, 'RB1705', encode(obj))), protocol)),
+        }
+    return results
+
+
+def bench_parse_tick_datetime(number=DEFAULT_NUMBER):
+    """tick时间解析的开销测试
+    比较strptime与ctaTick.parse_tick_datetime对不同小数位数时间的解析耗时。
+
+    :param number: 测试次数
+    :return: 时间字符串 => (strptime每次调用微秒数, parse_tick_datetime每次调用微秒数)
+    """
+    date = '20170301'
+    results = {}
+    for time in ('21:30:15.5', '21:30:15.500', '21:30:15.500000'):
+        results[time] = (
+            _best_per_call(lambda: dt.datetime.strptime(' '.join([date, time]), ctaTick.TICK_DATETIME_FORMAT),
+                           number),
+            _best_per_call(lambda: ctaTick.parse_tick_datetime(date, time), number))
+    return results
+
+
+def bench_normalize_tick(number=DEFAULT_NUMBER):
+    """tick规范化的开销测试
+    比较深拷贝后修改字段与直接生成CtaTickData的耗时。
+
+    :param number: 测试次数
+    :return: 测试结果字典
+    """
+    vt_tick = make_tick(symbol='rb1705', exchange='shfe')
+
+    def deepcopy_tick():
+        tick = copy.deepcopy(vt_tick)
+        tick.symbol = tick.symbol.upper()
+        tick.exchange = tick.exchange.upper()
+        tick.vtSymbol = tick.vtSymbol.upper()
+        tick.datetime = ctaTick.parse_tick_datetime(tick.date, tick.time)
+        return tick
+
+    return {
+        'deepcopy_us': _best_per_call(deepcopy_tick, number),
+        'normalize_us': _best_per_call(lambda: ctaTick.normalize_tick(vt_tick), number),
+    }
+
+
+def bench_kline_datetime(number=DEFAULT_NUMBER):
+    """各周期K线时间计算的开销测试
+    使用周五夜盘的tick，覆盖跨周末调整的情况。
+    分别测试与上一个tick在同一分钟内以及每次都进入新的一分钟的情况。
+
+    :param number: 测试次数
+    :return: 周期 => (同一分钟内每次调用微秒数, 新的一分钟每次调用微秒数)
+    """
+    tick = make_tick(datetime=dt.datetime(2017, 3, 3, 22, 45, 30))
+    minute_ticks = [make_tick(datetime=dt.datetime(2017, 3, 3, 21, 0, 30) + dt.timedelta(minutes=i))
+                    for i in range(120)]
+    results = {}
+    for period in range(ctaKLine.PERIOD_1MIN, ctaKLine.PERIOD_1DAY + 1):
+        gen = ctaKLine.KLineGenImpl(period)
+        next_tick = itertools.cycle(minute_ticks).next
+        results[period] = (_best_per_call(lambda: gen._calc_kline_datetime(tick), number),
+                           _best_per_call(lambda: gen._calc_kline_datetime(next_tick()), number))
+    return results
+
+
+def bench_last_klines(count=500, number=1000):
+    """策略获取历史K线收盘价序列的开销测试
+    比较由get_last_klines返回的K线对象构建数组与直接获取数组视图的耗时。
+
+    :param count: 每次获取的K线数目
+    :param number: 测试次数
+    :return: 测试结果字典
+    """
+    # 不预读、不查询数据库
+    gen = ctaKLine.KLineGenImpl(ctaKLine.PERIOD_1MIN)
+    gen.warmed_symbols.add('RB1705')
+    gen.exhausted_symbols.add('RB1705')
+    start = dt.datetime(2017, 3, 1, 9, 0, 30)
+    for i in range(count * 2):
+        gen.update(make_tick(datetime=start + dt.timedelta(minutes=i)))
+    newest = start + dt.timedelta(minutes=count * 2)
+
+    return {
+        'objects_us': _best_per_call(lambda: np.array([k.close for k in gen.get_last_klines(
+                'RB1705', count, newest_tick_datetime=newest)]), number),
+        'arrays_us': _best_per_call(lambda: gen.get_last_kline_arrays(
+                'RB1705', count, newest_tick_datetime=newest).close, number),
+    }
+
+
+def bench_aggregate_ticks(period=ctaKLine.PERIOD_1MIN, number=3):
+    """由历史tick生成K线的开销测试
+    使用一个交易日（含夜盘）每0.5秒一个的tick，比较逐个tick更新K线生成器与批量生成的耗时。
+
+    :param period: K线周期常量
+    :param number: 测试次数
+    :return: 测试结果字典
+    """
+    start = dt.datetime(2017, 3, 2, 21, 0)
+    datetimes = [start + dt.timedelta(milliseconds=500 * i) for i in range(2 * 60 * 60 * 18)]
+    ticks = [make_tick(datetime=d) for d in datetimes]
+    ticks = [tick for tick in ticks if ctaTimeline.is_valid_tick(tick)]
+    for i, tick in enumerate(ticks):
+        tick.volume = i
+        tick.lastVolume = 1
+    tick_arrays = ctaAggregate.TickArrays(np.array([t.datetime for t in ticks], 'M8[us]'),
+                                          np.array([t.lastPrice for t in ticks]),
+                                          np.array([t.volume for t in ticks], 'f8'))
+    trade_timeline = ctaTimeline.timeline_for_tick(ticks[0])
+
+    def update_ticks():
+        # 不预读、不查询数据库
+        gen = ctaKLine.KLineGenImpl(period)
+        gen.warmed_symbols.add('RB1705')
+        gen.exhausted_symbols.add('RB1705')
+        for tick in ticks:
+            gen.update(tick)
+
+    return {
+        'ticks': len(ticks),
+        'update_ms': _best_per_call(update_ticks, number) / 1000,
+        'aggregate_ms': _best_per_call(lambda: ctaAggregate.aggregate_ticks(tick_arrays, period, trade_timeline),
+                                       number) / 1000,
+    }
+
+
+def bench_resample_klines(days=250, number=3):
+    """由1分钟K线生成其他周期K线的开销测试
+    使用有夜盘品种一年左右的1分钟K线，测试生成各周期K线的耗时（不含数据库读写）。
+
+    :param days: 自然日数
+    :param number: 测试次数
+    :return: 1分钟K线数目, 周期 => 毫秒数
+    """
+    tick = make_tick()
+    trade_timeline = ctaTimeline.timeline_for_tick(tick)
+    minutes = np.arange(np.datetime64('2017-01-02T00:00'), np.datetime64('2017-01-02T00:00') + days * 1440)
+    minutes = minutes[ctaAggregate.valid_minute_mask(minutes, trade_timeline)]
+    prices = np.random.RandomState(0).randint(2900, 3100, len(minutes)).astype('f8')
+    minute_klines = ctaKLine.KLineArrays(minutes.astype('M8[us]') + np.timedelta64(1, 'm'),
+                                         prices, prices + 5, prices - 5, prices, np.ones(len(minutes)),
+                                         minutes.astype('M8[us]'), minutes.astype('M8[us]') + np.timedelta64(59, 's'))
+
+    results = {}
+    for period in range(ctaKLine.PERIOD_2MIN, ctaKLine.PERIOD_1DAY + 1):
+        results[period] = _best_per_call(
+                lambda: ctaResample.resample_klines(minute_klines, period, trade_timeline), number) / 1000
+    return len(minutes), results
+
+
+def generate_ticks(symbols, trading_day=SYNTHETIC_TRADING_DAY, interval_ms=DEFAULT_TICK_INTERVAL, seed=0):
+    """生成一个交易日的合成tick
+    从前一交易日夜盘开盘前至交易日收盘后，每个合约每隔interval_ms毫秒以一定概率产生一个tick，
+    价格随机游走，累计成交量递增；交易时间外的tick按INVALID_TICK_RATIO的比例保留。
+
+    :param symbols: (合约代码, 交易所, 基准价格)列表
+    :param trading_day: 交易日
+    :param interval_ms: 每个合约的tick间隔（毫秒）
+    :param seed: 随机数种子
+    :return: 按时间排列的VtTickData列表
+    """
+    rand = random.Random(seed)
+    start = dt.datetime.combine(ctaCalendar.previous_trading_day(trading_day), dt.time(20, 59))
+    end = dt.datetime.combine(trading_day, dt.time(15, 16))
+    steps = int((end - start).total_seconds() * 1000 // interval_ms)
+
+    states = [[symbol, exchange, price, 0] for symbol, exchange, price in symbols]
+    ticks = []
+    for step in xrange(steps):
+        step_datetime = start + dt.timedelta(milliseconds=step * interval_ms)
+        for state in states:
+            if rand.random() < 0.2:
+                continue
+            symbol, exchange, price, volume = state
+            tick = make_tick(symbol, exchange,
+                             step_datetime + dt.timedelta(milliseconds=rand.randrange(0, interval_ms, 500)))
+            if not ctaTimeline.is_valid_tick(ctaTick.normalize_tick(tick)) and rand.random() >= INVALID_TICK_RATIO:
+                continue
+
+            state[2] = price = max(price + rand.choice((-1, 0, 0, 1)), 1.0)
+            state[3] = volume = volume + rand.randint(0, 20)
+            tick.lastPrice = price
+            tick.volume = volume
+            ticks.append(tick)
+
+    ticks.sort(key=lambda t: (t.date, t.time))
+    return ticks
+
+
+def run_scenario(scenario, ticks):
+    """运行一个吞吐量测试场景
+
+    :param scenario: Scenario
+    :param ticks: 合成的tick
+    :return: 测试结果字典：
+             - ticks             tick数
+             - ticks_per_second  每秒处理的tick数
+             - latency_us        单个tick处理耗时的百分位（微秒），参照ctaMongo.percentiles
+             - memory_kb         处理前后常驻内存的增长（KB），无法获取时为None
+             - write_tasks       数据库写入任务数
+    """
+    sink = ctaMongo.MemorySink()
+    previous_sink = ctaMongo.set_write_sink(sink)
+    try:
+        kline_gen = ctaKLine.KLineGenerator(scenario.periods, scenario.recording_tick, ignore_past=False,
+                                            cascade=scenario.cascade, load_history=False)
+        active_dict = {symbol: symbol.rstrip('0123456789') + '0000'
+                       for symbol, _, _ in SYMBOL_MIXES[scenario.mix]} if scenario.active else {}
+        pipeline = ctaPipeline.TickPipeline(kline_gen, active_dict)
+
+        gc.collect()
+        memory_before = _rss_kb()
+        latencies = []
+        timer = timeit.default_timer
+        start = timer()
+        for tick in ticks:
+            tick_start = timer()
+            pipeline.process(tick)
+            latencies.append(timer() - tick_start)
+        kline_gen.flush(active_dict)
+        elapsed = timer() - start
+        memory_after = _rss_kb()
+    finally:
+        ctaMongo.set_write_sink(previous_sink)
+
+    latency_us = ctaMongo.percentiles([l * 1e6 for l in latencies], LATENCY_PERCENTILES)
+    del latency_us['count']
+    return dict(ticks=len(ticks),
+                ticks_per_second=len(ticks) / elapsed,
+                latency_us=latency_us,
+                memory_kb=memory_after - memory_before if memory_before is not None else None,
+                write_tasks=sink.task_count)
+
+
+def run_suite(scenarios=SCENARIOS, interval_ms=DEFAULT_TICK_INTERVAL):
+    """运行吞吐量测试
+
+    :param scenarios: Scenario列表
+    :param interval_ms: 合成tick中每个合约的tick间隔（毫秒）
+    :return: 可保存为JSON的结果字典
+    """
+    ticks = {}
+    results = {}
+    for scenario in scenarios:
+        if scenario.mix not in ticks:
+            ticks[scenario.mix] = generate_ticks(SYMBOL_MIXES[scenario.mix], interval_ms=interval_ms)
+        results[scenario.name] = run_scenario(scenario, ticks[scenario.mix])
+
+    return dict(version=RESULT_VERSION,
+                created=dt.datetime.now().isoformat(),
+                revision=_git_revision(),
+                python=sys.version.split()[0],
+                platform=platform.platform(),
+                interval_ms=interval_ms,
+                scenarios=results)
+
+
+def compare_results(old, new, threshold=REGRESSION_THRESHOLD):
+    """对比两次吞吐量测试的结果
+
+    :param old: 之前的结果字典
+    :param new: 本次的结果字典
+    :param threshold: 吞吐量下降超过该比例视为性能退化
+    :return: [(场景名, 吞吐量之比, p99耗时之比, 是否退化)]，只包括两次都有的场景
+    """
+    if old.get('interval_ms') != new.get('interval_ms'):
+        print('注意：两次测试的tick间隔不同，结果不可直接对比。')
+
+    rows = []
+    for name in sorted(set(old['scenarios']) & set(new['scenarios'])):
+        old_result, new_result = old['scenarios'][name], new['scenarios'][name]
+        throughput_ratio = new_result['ticks_per_second'] / old_result['ticks_per_second']
+        p99_ratio = new_result['latency_us']['p99'] / old_result['latency_us']['p99'] \
+            if old_result['latency_us']['p99'] else float('nan')
+        rows.append((name, throughput_ratio, p99_ratio, throughput_ratio < 1 - threshold))
+    return rows
+
+
+def _rss_kb():
+    """获取当前进程的常驻内存（KB），仅支持Linux，无法获取时返回None"""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+def _git_revision():
+    """获取代码的git版本，无法获取时返回None"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_micro_benchmarks():
+    print('写入任务序列化（每次调用微秒数 / 字节数）：')
+    for kind, result in sorted(bench_wire_format().items()):
+        print('  {:<6} 对象 {:6.2f}us {:5d}B    编码后 {:6.2f}us {:5d}B'.format(
+                kind, result['object_us'], result['object_bytes'],
+                result['encoded_us'], result['encoded_bytes']))
+
+    print('tick时间解析（每次调用微秒数）：')
+    for time, (strptime_us, parse_us) in sorted(bench_parse_tick_datetime().items()):
+        print('  {:<16} strptime {:6.2f}us    parse_tick_datetime {:6.2f}us'.format(time, strptime_us, parse_us))
+
+    result = bench_normalize_tick()
+    print('tick规范化（每次调用微秒数）：')
+    print('  深拷贝 {:6.2f}us    CtaTickData {:6.2f}us'.format(result['deepcopy_us'], result['normalize_us']))
+
+    print('K线时间计算（每次调用微秒数）：')
+    for period, (same_us, new_us) in sorted(bench_kline_datetime().items()):
+        print('  {:>4}分钟 同一分钟 {:6.2f}us    新的一分钟 {:6.2f}us'.format(
+                ctaKLine.MINUTES_OF_PERIOD[period], same_us, new_us))
+
+    result = bench_last_klines()
+    print('获取500根K线收盘价（每次调用微秒数）：')
+    print('  K线对象 {:8.2f}us    数组视图 {:8.2f}us'.format(result['objects_us'], result['arrays_us']))
+
+    result = bench_aggregate_ticks()
+    print('由{}个tick生成1分钟K线（毫秒数）：'.format(result['ticks']))
+    print('  逐个tick更新 {:8.2f}ms    批量生成 {:8.2f}ms'.format(result['update_ms'], result['aggregate_ms']))
+
+    count, results = bench_resample_klines()
+    print('由{}根1分钟K线生成K线（毫秒数）：'.format(count))
+    for period, elapsed_ms in sorted(results.items()):
+        print('  {:>4}分钟 {:8.2f}ms'.format(ctaKLine.MINUTES_OF_PERIOD[period], elapsed_ms))
+
+
+def print_suite_results(results):
+    print('吞吐量（tick间隔 {}ms）：'.format(results['interval_ms']))
+    for name, result in sorted(results['scenarios'].items()):
+        latency = result['latency_us']
+        print('  {:<24} {:7d} tick {:9.0f} tick/s    p50 {:6.1f}us p90 {:6.1f}us p99 {:7.1f}us max {:8.1f}us'
+              '    内存 {}    写入任务 {}'.format(
+                name, result['ticks'], result['ticks_per_second'], latency['p50'], latency['p90'], latency['p99'],
+                latency['max'], '{}KB'.format(result['memory_kb']) if result['memory_kb'] is not None else '-',
+                result['write_tasks']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='数据采集热点路径的性能测试')
+    parser.add_argument('-o', '--output', help='保存吞吐量测试结果的JSON文件')
+    parser.add_argument('-c', '--compare', help='对比之前保存的吞吐量测试结果')
+    parser.add_argument('--quick', action='store_true', help='使用较少的tick快速测试')
+    parser.add_argument('--skip-micro', action='store_true', help='跳过单项测试')
+    args = parser.parse_args()
+
+    if not args.skip_micro:
+        print_micro_benchmarks()
+
+    results = run_suite(interval_ms=QUICK_TICK_INTERVAL if args.quick else DEFAULT_TICK_INTERVAL)
+    print_suite_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            old = json.load(fp)
+        print('与 {}（版本 {}）对比：'.format(args.compare, old.get('revision')))
+        rows = compare_results(old, results)
+        for name, throughput_ratio, p99_ratio, regressed in rows:
+            print('  {:<24} 吞吐量 {:6.2f}x    p99 {:6.2f}x{}'.format(
+                    name, throughput_ratio, p99_ratio, '    性能退化' if regressed else ''))
+        if any(row[3] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
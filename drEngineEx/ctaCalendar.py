@@ -0,0 +1,218 @@
+# encoding: UTF-8
+
+import bisect
+import datetime as dt
+import json
+import os
+
+import numpy as np
+
+from . import ctaTimeline
+
+"""
+【交易日历】
+交易日为去除周末和交易所节假日之后的日期，节假日由配置文件CTADR_calendar.json定义。
+日历覆盖配置文件中first_day至last_day的日期，节假日必须在此范围内，
+并按日期预先计算出每一天到下一个交易日的天数，查找任意时间点所属的交易日只需一次下标计算。
+超出日历范围的日期只考虑周末，与不区分节假日时的行为相同，每个年份首次出现时提示更新配置文件。
+
+夜盘tick属于下一个交易日，计算交易日时先将tick时间加上ctaTimeline.HOUR_BIAS小时偏移量。
+"""
+
+# 交易日历配置文件
+CALENDAR_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'CTADR_calendar.json')
+
+# 日历范围结束后只考虑周末的天数，保证范围内最后几天也能找到下一个交易日
+CALENDAR_MARGIN_DAYS = 7
+
+# 小时偏移量
+HOUR_BIAS_DELTA = dt.timedelta(hours=ctaTimeline.HOUR_BIAS)
+
+# 当前使用的交易日历，由load_calendar设置
+_calendar = None
+
+
+class TradingCalendar(object):
+    """交易日历"""
+
+    def __init__(self, first_day, last_day, holidays):
+        """初始化
+
+        :param first_day: 日历开始日期，dt.date
+        :param last_day: 日历结束日期，dt.date
+        :param holidays: 节假日（非周末的休市日）列表
+        """
+        self.first_day = first_day
+        self.last_day = last_day
+        holidays = set(holidays)
+        outside = sorted(d for d in holidays if not first_day <= d <= last_day)
+        if outside:
+            raise ValueError('节假日{}不在交易日历范围{}至{}内。'.format(outside[0], first_day, last_day))
+
+        # 已提示超出日历范围的年份
+        self._warned_years = set()
+
+        # 按日期升序排列的交易日
+        days = (first_day + dt.timedelta(days=n)
+                for n in range((last_day - first_day).days + 1 + CALENDAR_MARGIN_DAYS))
+        self.trading_days = [d for d in days if d.weekday() < 5 and d not in holidays]
+
+        # 从开始日期起每一天到下一个交易日（当天为交易日时为0）的天数，结束日期之后的部分只考虑周末
+        self._first_ordinal = first_day.toordinal()
+        self._last_idx = (last_day - first_day).days
+        self._days_to_next = []
+        ordinal = self._first_ordinal
+        for d in self.trading_days:
+            while ordinal <= d.toordinal():
+                self._days_to_next.append(d.toordinal() - ordinal)
+                ordinal += 1
+
+        # 预先生成各天数对应的时间差
+        self._deltas = [dt.timedelta(days=n) for n in range(max(self._days_to_next) + 1)]
+
+        # 批量调整使用的数组形式
+        self._first_day64 = np.datetime64(first_day, 'D')
+        self._days_to_next64 = np.array(self._days_to_next, 'm8[D]')
+
+    def next_trading_day(self, datetime):
+        """将时间点向后调整至交易日，当天为交易日时不变
+
+        :param datetime: dt.datetime or dt.date
+        :return: 与参数同类型，时间部分不变
+        """
+        idx = datetime.toordinal() - self._first_ordinal
+        if 0 <= idx <= self._last_idx:
+            days = self._days_to_next[idx]
+            return datetime + self._deltas[days] if days else datetime
+
+        # 超出日历范围时只考虑周末
+        self._warn_out_of_range((datetime.year,))
+        while datetime.weekday() in (5, 6):
+            datetime += dt.timedelta(days=1)
+        return datetime
+
+    def next_trading_days(self, days):
+        """批量将日期向后调整至交易日，结果与逐个调用next_trading_day相同
+
+        :param days: datetime64[D]数组
+        :return: datetime64[D]数组
+        """
+        days = np.asarray(days, 'M8[D]')
+        idx = (days - self._first_day64).astype(np.int64)
+        in_range = (idx >= 0) & (idx <= self._last_idx)
+        if not in_range.all():
+            self._warn_out_of_range(np.unique(days[~in_range].astype('M8[Y]').astype(np.int64) + 1970).tolist())
+
+        # 超出日历范围时只考虑周末，1970-01-01为周四
+        weekday = (days.astype(np.int64) + 3) % 7
+        shift = np.where(weekday >= 5, 7 - weekday, 0).astype('m8[D]')
+        shift[in_range] = self._days_to_next64[idx[in_range]]
+        return days + shift
+
+    def previous_trading_day(self, date):
+        """获取日期之前（不含当天）的最近一个交易日
+
+        :param date: dt.date
+        :return: dt.date
+        """
+        date -= dt.timedelta(days=1)
+        while not self.is_trading_day(date):
+            date -= dt.timedelta(days=1)
+        return date
+
+    def trading_days_between(self, first_day, last_day):
+        """获取日期区间内的交易日
+
+        :param first_day: 开始日期（包含），dt.date
+        :param last_day: 结束日期（包含），dt.date
+        :return: 按日期升序排列的交易日列表
+        """
+        days = (first_day + dt.timedelta(days=n) for n in range((last_day - first_day).days + 1))
+        return [d for d in days if self.is_trading_day(d)]
+
+    def trading_day(self, datetime):
+        """获取时间点所属的交易日，夜盘属于下一个交易日
+
+        :param datetime: dt.datetime
+        :return: dt.date
+        """
+        return self.next_trading_day(datetime + HOUR_BIAS_DELTA).date()
+
+    def is_trading_day(self, date):
+        """判断日期是否为交易日
+
+        :param date: dt.date
+        :return: True/False
+        """
+        if self.first_day <= date <= self.last_day:
+            idx = bisect.bisect_left(self.trading_days, date)
+            return idx < len(self.trading_days) and self.trading_days[idx] == date
+        self._warn_out_of_range((date.year,))
+        return date.weekday() < 5
+
+    def _warn_out_of_range(self, years):
+        """提示日期超出日历范围，每个年份只提示一次
+
+        :param years: 超出范围的日期所在年份
+        :return:
+        """
+        for year in years:
+            if year not in self._warned_years:
+                self._warned_years.add(year)
+                print('{}年的日期超出交易日历范围{}至{}，只按周末判断交易日，请更新{}。'.format(
+                        year, self.first_day, self.last_day, os.path.basename(CALENDAR_FILE)))
+
+
+def load_calendar(filename=CALENDAR_FILE):
+    """读取交易日历配置文件，替换当前使用的交易日历
+
+    :param filename: 配置文件名
+    :return: TradingCalendar
+    """
+    global _calendar
+
+    with open(filename) as fp:
+        settings = json.load(fp)
+
+    parse = lambda s: dt.datetime.strptime(s, '%Y-%m-%d').date()
+    _calendar = TradingCalendar(parse(settings['first_day']), parse(settings['last_day']),
+                                map(parse, settings['holidays']))
+    return _calendar
+
+
+def get_calendar():
+    """获取当前使用的交易日历"""
+    return _calendar
+
+
+def next_trading_day(datetime):
+    """参照TradingCalendar.next_trading_day"""
+    return _calendar.next_trading_day(datetime)
+
+
+def next_trading_days(days):
+    """参照TradingCalendar.next_trading_days"""
+    return _calendar.next_trading_days(days)
+
+
+def previous_trading_day(date):
+    """参照TradingCalendar.previous_trading_day"""
+    return _calendar.previous_trading_day(date)
+
+
+def trading_days_between(first_day, last_day):
+    """参照TradingCalendar.trading_days_between"""
+    return _calendar.trading_days_between(first_day, last_day)
+
+
+def trading_day(datetime):
+    """参照TradingCalendar.trading_day"""
+    return _calendar.trading_day(datetime)
+
+
+def is_trading_day(date):
+    """参照TradingCalendar.is_trading_day"""
+    return _calendar.is_trading_day(date)
+
+
+load_calendar()
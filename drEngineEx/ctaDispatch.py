@@ -0,0 +1,191 @@
+# encoding: UTF-8
+
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from . import ctaProfile
+
+"""
+【K线完成回调的异步分发】
+默认情况下K线完成回调在tick处理线程中依次执行，一个策略的onBar耗时过长会推迟所有合约的K线生成。
+异步分发时，完成的K线放入各监听者的队列，由线程池中的工作线程执行回调，tick处理线程只负责入队，不等待策略代码。
+
+同一对象的绑定方法（例如同一策略的各个onBar）属于同一监听者，共用一个队列，按入队顺序串行执行，
+因此同一策略、同一合约的K线保持顺序，策略代码不会被并发调用；不同监听者的队列并行执行。
+回调不在事件引擎线程中执行，与onTick等其他回调可能同时执行；回调中获取的过去K线为拷贝（KLineGenerator.snapshot_reads）。
+每个队列连续执行DISPATCH_BATCH_SIZE个回调后重新排队，避免个别繁忙的监听者长期占用工作线程。
+注销回调不影响已入队的K线。
+"""
+
+# 默认工作线程数
+DEFAULT_DISPATCH_WORKERS = 4
+
+# 每个队列连续执行的回调数
+DISPATCH_BATCH_SIZE = 16
+
+# 统计信息汇报间隔（秒）
+DISPATCH_STATS_INTERVAL = 5.0
+
+
+class ListenerQueue(object):
+    """一个监听者的K线队列及其统计信息"""
+
+    def __init__(self, name):
+        """初始化
+
+        :param name: 监听者名称，用于统计信息
+        """
+        self.name = name
+        self.items = deque()  # (回调, K线, 入队时间, 耗时记录信息)
+        self.scheduled = False  # 是否已在线程池中排队或执行
+        self.errors = 0  # 累计异常次数
+        self.reset()
+
+    def reset(self):
+        """开始新的汇报周期"""
+        self.handled = 0
+        self.max_depth = len(self.items)
+        self.wait_times = ctaProfile.LatencyHistogram()  # 入队至开始执行的时间
+        self.handler_times = ctaProfile.LatencyHistogram()  # 回调的执行时间
+
+
+class KlineDispatcher(object):
+    """K线完成回调的异步分发器"""
+
+    def __init__(self, workers=DEFAULT_DISPATCH_WORKERS, batch_size=DISPATCH_BATCH_SIZE):
+        """初始化
+
+        :param workers: 工作线程数
+        :param batch_size: 每个队列连续执行的回调数
+        """
+        self.pool = ThreadPool(workers)
+        self.batch_size = batch_size
+        self.queues = {}  # 监听者 => ListenerQueue
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.begin_time = time.time()
+
+    def submit(self, callback, kline, profile=None):
+        """将完成的K线放入回调所属监听者的队列，不等待回调执行
+
+        :param callback: K线完成回调
+        :param kline: 完成的K线
+        :param profile: (ctaProfile.TickProfiler, 合约代码, K线周期, tick时间)，回调执行完毕时记录callback、end_to_end阶段；
+                        为None时不记录
+        :return:
+        """
+        key = _listener_of(callback)
+        with self.lock:
+            if self.stopping:
+                queue = None
+            else:
+                queue = self.queues.get(key)
+                if queue is None:
+                    queue = self.queues[key] = ListenerQueue(_listener_name(callback))
+                queue.items.append((callback, kline, time.time(), profile))
+                queue.max_depth = max(queue.max_depth, len(queue.items))
+                schedule = not queue.scheduled
+                queue.scheduled = True
+
+        # 停止后仍到达的K线直接执行
+        if queue is None:
+            callback(kline)
+        elif schedule:
+            self.pool.apply_async(self._drain, (queue,))
+
+    def _drain(self, queue):
+        """在工作线程中依次执行一个队列中的回调
+
+        :param queue: ListenerQueue
+        :return:
+        """
+        handled = 0
+        while True:
+            with self.lock:
+                if not queue.items:
+                    queue.scheduled = False
+                    return
+                if handled >= self.batch_size and not self.stopping:
+                    self.pool.apply_async(self._drain, (queue,))
+                    return
+                callback, kline, submit_time, profile = queue.items.popleft()
+
+            start = time.time()
+            failed = False
+            try:
+                callback(kline)
+            except:
+                failed = True
+                traceback.print_exc()
+            end = time.time()
+            handled += 1
+
+            with self.lock:
+                if failed:
+                    queue.errors += 1
+                queue.handled += 1
+                queue.wait_times.record(start - submit_time)
+                queue.handler_times.record(end - start)
+                if profile is not None:
+                    profiler, symbol, period, tick_datetime = profile
+                    profiler.record('callback', symbol, period, end - start)
+                    profiler.record_since('end_to_end', symbol, period, tick_datetime)
+
+    def is_due(self):
+        """是否到达汇报时间"""
+        return time.time() - self.begin_time >= DISPATCH_STATS_INTERVAL
+
+    def report(self):
+        """生成各监听者的统计信息，并开始新的汇报周期
+
+        :return: 统计信息字典列表，每项包括：
+                 - name          监听者名称
+                 - queue_depth   队列中等待的K线数
+                 - max_depth     汇报周期内队列的最大深度
+                 - handled       汇报周期内执行的回调数
+                 - wait_time     入队至开始执行的时间，参照ctaProfile.LatencyHistogram.summary（微秒）
+                 - handler_time  回调执行时间，参照ctaProfile.LatencyHistogram.summary（微秒）
+                 - errors        累计异常次数
+        """
+        with self.lock:
+            queues = list(self.queues.values())
+            stats = []
+            for queue in queues:
+                stats.append(dict(name=queue.name,
+                                  queue_depth=len(queue.items),
+                                  max_depth=queue.max_depth,
+                                  handled=queue.handled,
+                                  wait_time=queue.wait_times.summary(),
+                                  handler_time=queue.handler_times.summary(),
+                                  errors=queue.errors))
+                queue.reset()
+            self.begin_time = time.time()
+        stats.sort(key=lambda s: s['name'])
+        return stats
+
+    def stop(self):
+        """等待已入队的回调执行完毕后停止工作线程
+
+        :return:
+        """
+        with self.lock:
+            self.stopping = True
+        self.pool.close()
+        self.pool.join()
+
+
+def _listener_of(callback):
+    """回调所属的监听者，绑定方法为其所属对象，其余为回调本身"""
+    owner = getattr(callback, '__self__', None)
+    return owner if owner is not None else callback
+
+
+def _listener_name(callback):
+    """监听者名称，vnpy策略使用策略名"""
+    owner = getattr(callback, '__self__', None)
+    if owner is None:
+        return getattr(callback, '__name__', repr(callback))
+    return getattr(owner, 'name', None) or type(owner).__name__
@@ -0,0 +1,219 @@
+# encoding: UTF-8
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+"""
+【写前日志】
+数据库写入进程先将任务追加到本地日志中，再由发送线程从日志中读取任务批量写入数据库。
+数据库停顿或重启时任务在日志中积压，内存占用不随积压增长；程序重启后从检查点继续发送未写入的任务。
+
+日志目录中包含：
+    0000000000.wal, 0000000001.wal, ...  固定大小的分段文件，通过内存映射追加写入
+    checkpoint                           已发送位置（分段序号，段内偏移）
+
+每条记录由记录头（长度，CRC32）和数据组成，长度为0或校验失败的位置视作分段中有效数据的结尾。
+"""
+
+# 默认分段文件大小（字节）
+DEFAULT_SEGMENT_SIZE = 32 * 1024 * 1024
+
+# 分段文件扩展名
+SEGMENT_SUFFIX = '.wal'
+
+# 检查点文件名
+CHECKPOINT_FILENAME = 'checkpoint'
+
+# 记录头：数据长度、数据的CRC32
+RECORD_HEADER = struct.Struct('<II')
+
+# 检查点：分段序号、段内偏移
+CHECKPOINT = struct.Struct('<QQ')
+
+
+class Journal(object):
+    """追加写入的内存映射日志
+    支持一个线程追加、另一个线程读取和提交。
+    """
+
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE):
+        """初始化
+        打开或新建日志目录，恢复写入位置和已发送位置。
+
+        :param path: 日志目录
+        :param segment_size: 分段文件大小（字节）
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # 已发送位置
+        self._checkpoint_file, self._checkpoint = _open_mmap(os.path.join(path, CHECKPOINT_FILENAME),
+                                                             CHECKPOINT.size)
+        self.read_seq, self.read_offset = CHECKPOINT.unpack_from(self._checkpoint)
+
+        # 写入位置为最后一个分段中最后一条有效记录之后
+        seqs = self._segment_seqs()
+        self.write_seq = max(seqs[-1] if seqs else 0, self.read_seq)
+        self._write_file, self._write_map = self._open_segment(self.write_seq)
+        self.write_offset = self._scan(self._write_map, 0)
+
+        # 检查点之前的分段已被删除时，从现存的第一个分段开始读取
+        if seqs and self.read_seq < seqs[0]:
+            self.read_seq, self.read_offset = seqs[0], 0
+
+        # 读取用的内存映射，分段序号 => (文件, 内存映射)
+        self._read_maps = {}
+
+    def append(self, payloads):
+        """追加记录
+
+        :param payloads: 记录数据（字节串）列表
+        :return:
+        """
+        with self.lock:
+            for payload in payloads:
+                size = RECORD_HEADER.size + len(payload)
+                if size > self.segment_size:
+                    raise ValueError('记录长度超过日志分段大小。')
+
+                # 当前分段剩余空间不足时切换到新分段
+                if self.write_offset + size > self.segment_size:
+                    self._write_map.flush()
+                    _close_mmap(self._write_file, self._write_map)
+                    self.write_seq += 1
+                    self._write_file, self._write_map = self._open_segment(self.write_seq)
+                    self.write_offset = 0
+
+                # 先写数据再写记录头，写入中途退出时该记录不会被视作有效
+                data_offset = self.write_offset + RECORD_HEADER.size
+                self._write_map[data_offset:data_offset + len(payload)] = payload
+                RECORD_HEADER.pack_into(self._write_map, self.write_offset,
+                                        len(payload), zlib.crc32(payload) & 0xFFFFFFFF)
+                self.write_offset += size
+
+    def read(self, max_count):
+        """从已发送位置开始读取记录
+        读取不会改变已发送位置，需在记录处理完成后调用commit。
+
+        :param max_count: 最多读取的记录数
+        :return: (读取结束位置, 记录数据列表)
+        """
+        with self.lock:
+            write_seq, write_offset = self.write_seq, self.write_offset
+
+        seq, offset = self.read_seq, self.read_offset
+        payloads = []
+        while len(payloads) < max_count:
+            if seq == write_seq and offset >= write_offset:
+                break
+
+            mm = self._read_map(seq)
+            payload = None
+            if offset + RECORD_HEADER.size <= self.segment_size:
+                length, crc = RECORD_HEADER.unpack_from(mm, offset)
+                data_offset = offset + RECORD_HEADER.size
+                if 0 < length <= self.segment_size - data_offset:
+                    payload = mm[data_offset:data_offset + length]
+                    if zlib.crc32(payload) & 0xFFFFFFFF != crc:
+                        payload = None
+
+            if payload is None:  # 分段结尾，进入下一个分段
+                if seq >= write_seq:
+                    break
+                seq, offset = seq + 1, 0
+                continue
+
+            payloads.append(payload)
+            offset += RECORD_HEADER.size + len(payload)
+
+        return (seq, offset), payloads
+
+    def commit(self, position):
+        """提交已发送位置
+        已发送位置之前的分段文件将被删除。
+
+        :param position: read返回的读取结束位置
+        :return:
+        """
+        self.read_seq, self.read_offset = position
+        CHECKPOINT.pack_into(self._checkpoint, 0, self.read_seq, self.read_offset)
+
+        for seq in self._segment_seqs():
+            if seq >= self.read_seq:
+                break
+            if seq in self._read_maps:
+                _close_mmap(*self._read_maps.pop(seq))
+            os.remove(self._segment_filename(seq))
+
+    def backlog(self):
+        """未发送数据的大致字节数"""
+        with self.lock:
+            return (self.write_seq - self.read_seq) * self.segment_size + self.write_offset - self.read_offset
+
+    def close(self):
+        """关闭日志"""
+        with self.lock:
+            self._write_map.flush()
+            _close_mmap(self._write_file, self._write_map)
+            for f, mm in self._read_maps.values():
+                _close_mmap(f, mm)
+            self._read_maps.clear()
+            self._checkpoint.flush()
+            _close_mmap(self._checkpoint_file, self._checkpoint)
+
+    def _read_map(self, seq):
+        """获取读取用的分段内存映射"""
+        if seq not in self._read_maps:
+            self._read_maps[seq] = self._open_segment(seq)
+        return self._read_maps[seq][1]
+
+    def _segment_filename(self, seq):
+        """分段文件名"""
+        return os.path.join(self.path, '{:010d}{}'.format(seq, SEGMENT_SUFFIX))
+
+    def _segment_seqs(self):
+        """现存分段的序号，升序排列"""
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _open_segment(self, seq):
+        """打开或新建分段文件"""
+        return _open_mmap(self._segment_filename(seq), self.segment_size)
+
+    def _scan(self, mm, offset):
+        """从指定位置开始扫描分段，返回最后一条有效记录之后的位置"""
+        while offset + RECORD_HEADER.size <= self.segment_size:
+            length, crc = RECORD_HEADER.unpack_from(mm, offset)
+            data_offset = offset + RECORD_HEADER.size
+            if (length == 0 or data_offset + length > self.segment_size or
+                    zlib.crc32(mm[data_offset:data_offset + length]) & 0xFFFFFFFF != crc):
+                break
+            offset = data_offset + length
+        return offset
+
+
+def _open_mmap(filename, size):
+    """打开文件的内存映射，文件不存在时新建并以零填充到指定大小
+
+    :param filename: 文件名
+    :param size: 文件大小（字节）
+    :return: (文件, 内存映射)
+    """
+    if not os.path.exists(filename):
+        with open(filename, 'wb') as f:
+            f.truncate(size)
+    f = open(filename, 'r+b')
+    return f, mmap.mmap(f.fileno(), size)
+
+
+def _close_mmap(f, mm):
+    """关闭内存映射及其文件"""
+    mm.close()
+    f.close()
@@ -3,13 +3,20 @@
 import bisect
 import datetime as dt
 import itertools
+import threading
+import traceback
+import weakref
 from collections import (
-    OrderedDict,
-    defaultdict,
+    deque,
     namedtuple
 )
+from multiprocessing.pool import ThreadPool
 
+import numpy as np
+
+from . import ctaCalendar
 from . import ctaMongo
+from . import ctaTick
 from . import ctaTimeline
 
 # K线周期常量
@@ -59,20 +66,102 @@ INIT_KLINE_COUNT = 10
 # 单个K线生成器的K线最大缓存数目
 MAX_KLINE_COUNT = 100000
 
+# K线缓存的初始容量，不足时成倍扩大
+INIT_BUFFER_CAPACITY = 64
+
+# K线缓存的列名及其数据类型，时间精确到微秒
+KLINE_COLUMNS = (
+    ('datetime', 'M8[us]'),
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('volume', 'f8'),
+    ('open_datetime', 'M8[us]'),
+    ('close_datetime', 'M8[us]'),
+)
+
+# 一天的分钟数
+MINUTES_OF_DAY = ctaTimeline.MINUTES_OF_DAY
+
+# 小时偏移量对应的分钟数
+BIAS_MINUTES = ctaTimeline.BIAS_MINUTES
+
+ONE_MINUTE = dt.timedelta(minutes=1)
+
+# 预读历史K线的线程数
+WARM_UP_THREADS = 8
+
+# 预读历史K线的线程池，首次使用时创建
+_warm_up_pool = None
+_warm_up_pool_lock = threading.Lock()
+
+# 所有K线生成器实例，交易时间线替换时清除其K线时间查找表
+_kline_gen_impls = weakref.WeakSet()
+
 KLineTuple = namedtuple('KLineTuple', 'updated_kline is_completed')
 
+# 级联模式下用于计算K线时间的最小tick信息
+TickTime = namedtuple('TickTime', 'symbol exchange datetime')
+
+# K线数组，字段与KLINE_COLUMNS相同
+KLineArrays = namedtuple('KLineArrays', [name for name, _ in KLINE_COLUMNS])
+
 
 class KLineGenerator(object):
-    """K线生成器类"""
+    """K线生成器类
+    每个合约生成的周期为其记录周期与已注册回调的周期的并集：
+    记录周期由periods和symbol_periods配置，写入数据库；注册回调的周期只生成不写入。
+    注册或注销回调后，新增周期的生成器在下一个tick时开始生成，不再需要的周期的K线缓存随之释放，
+    新增周期的第一根K线可能只包括注册后的tick，除非数据库中已有该周期的历史K线。
+    """
 
-    def __init__(self, periods=(PERIOD_1MIN,), recording_tick=False, ignore_past=True):
+    def __init__(self, periods=(PERIOD_1MIN,), recording_tick=False, ignore_past=True, cascade=False,
+                 load_history=True, symbol_periods=None):
         """初始化
 
-        :param periods: 使用K线周期常量指定需要生成的特定周期K线，默认只生成1分钟K线
+        :param periods: 使用K线周期常量指定需要生成并记录的特定周期K线，默认只生成1分钟K线
         :param ignore_past: 如果为True，则该生成器将记忆实例化时间，并过滤该时间之前的tick
+        :param cascade: 级联模式，只有1分钟K线由tick更新，其余周期在1分钟K线完成时由其合成，
+                        每个tick的处理开销与生成的周期数基本无关
+        :param load_history: 是否从数据库中读取历史K线，回放历史tick时应为False
+        :param symbol_periods: 按合约代码或品种代码（例如RB）单独指定的记录周期，代替periods，默认为空
         """
-        # 存放特定周期K线生成器的字典容器
-        self.kline_gens = {prd: KLineGenImpl(prd) for prd in periods}
+        self.load_history = load_history
+
+        # 存放特定周期K线生成器的字典容器，按需创建
+        self.kline_gens = {}
+        self.kline_gens_lock = threading.Lock()
+
+        # K线缓存的锁，由各周期的K线生成器共用。tick线程更新K线时持有，
+        # 异步分发时策略在工作线程中获取过去K线，读取及合并历史K线时持有
+        self.lock = threading.Lock()
+
+        # 获取过去K线时是否返回拷贝，异步分发K线完成回调时应为True，
+        # 否则返回的数组视图及最新一根K线对象会在tick线程中继续更新
+        self.snapshot_reads = False
+
+        # 记录周期
+        self.periods = tuple(periods)
+        self.symbol_periods = {k.upper(): tuple(v) for k, v in (symbol_periods or {}).items()}
+
+        # 已注册回调的周期，合约代码 => 周期 => 注册次数，在任意线程中修改，由tick线程应用
+        self.demands = {}
+        self.demand_lock = threading.Lock()
+        self.changed_symbols = set()
+
+        # 各合约生成的周期及其中的记录周期，合约代码 => (周期元组, 记录周期集合)，由tick线程维护
+        self.active_periods = {}
+
+        # 级联模式下的1分钟K线生成器（未要求生成1分钟K线时仅内部使用）
+        self.cascade = cascade
+        self.minute_gen = self._get_gen(PERIOD_1MIN) if cascade else None
+
+        # 级联模式下上次刷新后1分钟K线有更新、需要合成其余周期的合约，合约代码 => 交易所代码
+        self.forming_minutes = {}
+
+        for prd in set(self.periods).union(*self.symbol_periods.values()):
+            self._get_gen(prd)
 
         # 是否将tick记录到数据库
         self.recording_tick = recording_tick
@@ -83,44 +172,355 @@ class KLineGenerator(object):
         # 存放各合约最后一个tick中的当日总成交量信息，用于计算差值得出每个tick所包含的成交量
         self.last_daily_volumes = {}
 
+        # 记录各阶段耗时的ctaProfile.TickProfiler，为None时不记录
+        self.profiler = None
+
+        # 将K线发布到共享内存的ctaShm.BarPublisher，为None时不发布
+        self.publisher = None
+
+    def add_demand(self, symbol, periods):
+        """注册回调时增加合约需要生成的周期，可在任意线程中调用
+
+        :param symbol: 合约代码
+        :param periods: K线周期常量列表
+        :return:
+        """
+        self._change_demand(symbol, periods, 1)
+
+    def remove_demand(self, symbol, periods):
+        """注销回调时减少合约需要生成的周期，可在任意线程中调用
+
+        :param symbol: 合约代码
+        :param periods: K线周期常量列表
+        :return:
+        """
+        self._change_demand(symbol, periods, -1)
+
+    def _change_demand(self, symbol, periods, delta):
+        """修改注册次数，在下一个tick时生效"""
+        symbol = symbol.upper()
+        with self.demand_lock:
+            counts = self.demands.setdefault(symbol, {})
+            for prd in periods:
+                self._get_gen(prd)
+                counts[prd] = max(counts.get(prd, 0) + delta, 0)
+                if not counts[prd]:
+                    del counts[prd]
+            if not counts:
+                del self.demands[symbol]
+            self.changed_symbols.add(symbol)
+
+    def recorded_periods_of(self, symbol):
+        """合约的记录周期，依次查找合约代码、品种代码的单独配置，均未配置时为periods
+
+        :param symbol: 合约代码
+        :return: K线周期常量元组
+        """
+        symbol = symbol.upper()
+        periods = self.symbol_periods.get(symbol)
+        if periods is None:
+            periods = self.symbol_periods.get(symbol.rstrip('0123456789'), self.periods)
+        return periods
+
+    def periods_of(self, symbol):
+        """合约生成的周期，即记录周期与已注册回调的周期的并集
+
+        :param symbol: 合约代码
+        :return: 按周期排列的K线周期常量元组
+        """
+        symbol = symbol.upper()
+        with self.demand_lock:
+            demanded = set(self.demands.get(symbol, ()))
+        return tuple(sorted(demanded.union(self.recorded_periods_of(symbol))))
+
+    def _active_periods_of(self, symbol):
+        """tick线程中使用的生成周期及记录周期，参照periods_of
+
+        :param symbol: 合约代码，必须为大写
+        :return: (周期元组, 记录周期集合)
+        """
+        active = self.active_periods.get(symbol)
+        if active is None:
+            active = self.active_periods[symbol] = (self.periods_of(symbol),
+                                                    frozenset(self.recorded_periods_of(symbol)))
+        return active
+
+    def _apply_demand_changes(self):
+        """在tick线程中应用注册次数的修改，释放不再生成的周期的K线缓存"""
+        with self.demand_lock:
+            symbols, self.changed_symbols = self.changed_symbols, set()
+
+        for symbol in symbols:
+            old = self.active_periods.pop(symbol, None)
+            if old is None:
+                continue
+            periods, _ = self._active_periods_of(symbol)
+            dropped = set(old[0]).difference(periods)
+            if self.cascade:
+                # 级联模式下1分钟K线用于合成其余周期，不再生成任何周期时才释放
+                dropped.discard(PERIOD_1MIN)
+                if not periods:
+                    dropped.add(PERIOD_1MIN)
+            for prd in dropped:
+                self.kline_gens[prd].drop(symbol)
+
+    def _get_gen(self, period):
+        """获取周期对应的K线生成器，不存在时创建
+
+        :param period: K线周期常量
+        :return: KLineGenImpl
+        """
+        gen = self.kline_gens.get(period)
+        if gen is None:
+            with self.kline_gens_lock:
+                gen = self.kline_gens.get(period)
+                if gen is None:
+                    gen = self.kline_gens[period] = KLineGenImpl(period, self.load_history, self.lock)
+        return gen
+
     def update(self, tick, active_dict):
         """实时更新K线值
 
         :param tick: VtTickData，合约代码、交易所等含字母的信息必须为大写
         :param active_dict: 主力合约对应表
-        :return: 如果tick为有效数据，返回特定周期K线的字典，{PERIOD: KLineTuple(KLINE, STATUS), ...}，其中：
+        :return: 如果tick为有效数据，返回该合约生成周期的K线字典，{PERIOD: KLineTuple(KLINE, STATUS), ...}，其中：
                  - PERIOD K线周期常量
                  - KLINE  KLine类实例
                  - STATUS True/False -> 完整/更新中
+                 级联模式下，1分钟以外的周期只在1分钟K线完成时出现在字典中
                  如果tick为非交易时间段的无效数据，返回None
         """
+        with self.lock:
+            if self.changed_symbols:
+                self._apply_demand_changes()
+
+            return self._update(tick, active_dict, self.profiler)
+
+    def _update(self, tick, active_dict, profiler):
+        """实时更新K线值，持有锁时调用，并记录检验、各周期K线更新和数据库任务推送的耗时，参照update
+        未启用记录时只在各阶段判断一次profiler是否为None，不计时也不调用记录函数。
+
+        :param profiler: ctaProfile.TickProfiler，为None时不记录
+        """
+        timed = profiler is not None
+        if timed:
+            clock, record = profiler.clock, profiler.record
+        symbol = tick.symbol
+
         # 检验tick是否为有效数据
-        if tick.datetime >= self.datetime_guard and ctaTimeline.is_valid_tick(tick):
-            # 计算tick的交易量
-            # TODO 该算法会导致程序启动后第一个tick、交易日第一个tick的交易量被忽略
-            last_volume = self.last_daily_volumes.get(tick.symbol, tick.volume)
-            tick.lastVolume = max(tick.volume - last_volume, 0)  # 跨交易日的时候成交量大小会反转，导致出现负值
-            self.last_daily_volumes[tick.symbol] = tick.volume
-
-            # 将tick记录到数据库中
-            if self.recording_tick:
-                ctaMongo.upsert_tick(TICK_DB_NAME, tick.symbol, tick)
-                if tick.symbol in active_dict:
-                    ctaMongo.upsert_tick(TICK_DB_NAME, active_dict[tick.symbol], tick)
-
-            # 更新容器中所有K线生成器，并返回所有得到的K线
-            updated_klines = {prd: gen.update(tick) for prd, gen in self.kline_gens.items()}
-
-            # 将K线记录到数据库
-            for prd, kline in updated_klines.items():
-                ctaMongo.upsert_kline(KLINE_DB_NAMES[prd], tick.symbol, kline.updated_kline)
-                if tick.symbol in active_dict:
-                    ctaMongo.upsert_kline(KLINE_DB_NAMES[prd], active_dict[tick.symbol], kline.updated_kline)
-
-            return updated_klines
-        else:
+        if timed:
+            start = clock()
+        valid = tick.datetime >= self.datetime_guard and ctaTimeline.is_valid_tick(tick)
+        if timed:
+            record('validate', symbol, None, clock() - start)
+        if not valid:
             return None
 
+        # 计算tick的交易量
+        self._update_volume(tick)
+
+        # 将tick记录到数据库中
+        if self.recording_tick:
+            if timed:
+                start = clock()
+            ctaMongo.upsert_tick(TICK_DB_NAME, symbol, tick)
+            if symbol in active_dict:
+                ctaMongo.upsert_tick(TICK_DB_NAME, active_dict[symbol], tick)
+            if timed:
+                record('post', symbol, None, clock() - start)
+
+        # 更新该合约生成的所有周期，并返回所有得到的K线
+        periods, recorded = self._active_periods_of(symbol)
+        if self.cascade:
+            updated_klines = self._update_cascade(tick, periods, profiler)
+        else:
+            updated_klines = {}
+            for prd in periods:
+                if timed:
+                    start = clock()
+                updated_klines[prd] = self.kline_gens[prd].update(tick)
+                if timed:
+                    record('kline', symbol, prd, clock() - start)
+
+        # 将记录周期的K线记录到数据库
+        for prd, kline in updated_klines.items():
+            if prd in recorded:
+                if timed:
+                    start = clock()
+                gen = self.kline_gens[prd]
+                if symbol in gen.loading_symbols or symbol in gen.held_symbols:
+                    self._post_held_klines(gen, symbol, active_dict)
+                else:
+                    ctaMongo.upsert_kline(KLINE_DB_NAMES[prd], symbol, kline.updated_kline, kline.is_completed)
+                    if symbol in active_dict:
+                        ctaMongo.upsert_kline(KLINE_DB_NAMES[prd], active_dict[symbol],
+                                              kline.updated_kline, kline.is_completed)
+                if timed:
+                    record('post', symbol, prd, clock() - start)
+
+        # 发布到共享内存
+        if self.publisher is not None:
+            self._publish(symbol, updated_klines)
+
+        return updated_klines
+
+    def _post_held_klines(self, gen, symbol, active_dict):
+        """推送预读历史K线期间生成的K线
+        预读合并前推送的K线只包含本次启动后的数据，会覆盖数据库中同一K线本次启动前的数据，
+        因此预读期间不推送，预读合并或失败后将此期间生成的K线一并推送。
+
+        :param gen: KLineGenImpl
+        :param symbol: 合约代码
+        :param active_dict: 主力合约对应表
+        :return:
+        """
+        if symbol in gen.loading_symbols:
+            gen.held_symbols.add(symbol)
+            return
+        gen.held_symbols.discard(symbol)
+        buf = gen.buffers.get(symbol)
+        if buf is None or buf.live_begin is None:
+            return
+        klines = buf.klines(buf.count_before(buf.live_begin))
+        dbname = KLINE_DB_NAMES[gen.period]
+        for idx, kline in enumerate(klines):
+            is_completed = idx < len(klines) - 1
+            ctaMongo.upsert_kline(dbname, symbol, kline, is_completed)
+            if symbol in active_dict:
+                ctaMongo.upsert_kline(dbname, active_dict[symbol], kline, is_completed)
+
+    def _publish(self, symbol, updated_klines):
+        """将更新的K线发布到共享内存
+        K线完成时新K线已创建但不在返回值中，一并发布，使读取者与K线缓存一致。
+
+        :param symbol: 合约代码
+        :param updated_klines: 参照update
+        :return:
+        """
+        for prd, kline in updated_klines.items():
+            self.publisher.publish(symbol, prd, kline.updated_kline, kline.is_completed)
+            if kline.is_completed:
+                last = self.kline_gens[prd].buffers[symbol].last
+                if last is not kline.updated_kline:
+                    self.publisher.publish(symbol, prd, last, False)
+
+    def _update_volume(self, tick):
+        """由当日总成交量计算tick的成交量
+
+        :param tick: VtTickData
+        :return:
+        """
+        # TODO 该算法会导致程序启动后第一个tick、交易日第一个tick的交易量被忽略
+        last_volume = self.last_daily_volumes.get(tick.symbol, tick.volume)
+        tick.lastVolume = max(tick.volume - last_volume, 0)  # 跨交易日的时候成交量大小会反转，导致出现负值
+        self.last_daily_volumes[tick.symbol] = tick.volume
+
+    def _update_cascade(self, tick, periods, profiler=None):
+        """级联模式下更新K线
+        用tick更新1分钟K线，1分钟K线完成时再用其更新其余周期的K线。
+
+        :param tick: VtTickData
+        :param periods: 该合约生成的周期
+        :param profiler: 记录各周期K线更新耗时的TickProfiler，默认为None不记录
+        :return: 参照update
+        """
+        if not periods:
+            return {}
+
+        timed = profiler is not None
+        if timed:
+            clock, record = profiler.clock, profiler.record
+            start = clock()
+        minute_kline = self.minute_gen.update(tick)
+        if timed:
+            record('kline', tick.symbol, PERIOD_1MIN, clock() - start)
+        updated_klines = {PERIOD_1MIN: minute_kline} if periods[0] == PERIOD_1MIN else {}
+        if periods[-1] != PERIOD_1MIN:
+            self.forming_minutes[tick.symbol] = tick.exchange
+
+        # 本次启动前的数据已计入其余周期的历史K线，只合成本次启动后的实时部分
+        live_kline = minute_kline.updated_kline.live_part()
+        if minute_kline.is_completed and live_kline is not None:
+            next_datetime = self.minute_gen.buffers[tick.symbol].last.datetime
+            for prd in periods:
+                if prd == PERIOD_1MIN:
+                    continue
+                if timed:
+                    start = clock()
+                updated_klines[prd] = self.kline_gens[prd].update_with_kline(live_kline, next_datetime, tick)
+                if timed:
+                    record('kline', tick.symbol, prd, clock() - start)
+        return updated_klines
+
+    def flush(self, active_dict=None):
+        """将暂存的更新中K线推送至数据库写入进程，由定时器及停止时调用
+        级联模式下其余周期只合并了已完成的1分钟K线，先将更新中的1分钟K线合并到其副本中一并推送，
+        否则交易时间段最后一分钟的数据要到下一个交易时间段的第一个tick才写入，期间重新启动则丢失。
+        缓存中的K线不变，1分钟K线完成时正常合并，写入的结果取代此前推送的副本。
+
+        :param active_dict: 主力合约对应表
+        :return:
+        """
+        with self.lock:
+            # 预读已合并或失败、但此后尚无tick到达的合约，在此推送其预读期间生成的K线
+            for gen in self.kline_gens.values():
+                if gen.warmed_klines:
+                    gen._merge_warmed_klines()
+                for symbol in list(gen.held_symbols):
+                    self._post_held_klines(gen, symbol, active_dict or {})
+            if self.forming_minutes:
+                forming_minutes, self.forming_minutes = self.forming_minutes, {}
+                for symbol, exchange in forming_minutes.items():
+                    self._post_forming_klines(symbol, exchange, active_dict or {})
+        ctaMongo.flush_klines()
+
+    def _post_forming_klines(self, symbol, exchange, active_dict):
+        """级联模式下推送合并了更新中1分钟K线的其余记录周期K线
+
+        :param symbol: 合约代码
+        :param exchange: 交易所代码
+        :param active_dict: 主力合约对应表
+        :return:
+        """
+        buf = self.minute_gen.buffers.get(symbol)
+        minute_kline = buf.last.live_part() if buf is not None and buf.last is not None else None
+        if minute_kline is None:
+            return
+
+        periods, recorded = self._active_periods_of(symbol)
+        for prd in periods:
+            if prd == PERIOD_1MIN or prd not in recorded:
+                continue
+            gen = self.kline_gens[prd]
+            if symbol in gen.loading_symbols or symbol in gen.held_symbols:
+                continue
+            kline_datetime = gen._calc_kline_datetime(
+                    TickTime(symbol, exchange, minute_kline.datetime - ONE_MINUTE))
+            last_kline = gen.buffers[symbol].last if symbol in gen.buffers else None
+            if last_kline is not None and kline_datetime == last_kline.datetime:
+                kline = gen._new_kline(kline_datetime, last_kline)
+                kline.merge(minute_kline)
+            elif last_kline is None or kline_datetime > last_kline.datetime:
+                kline = gen._new_kline(kline_datetime, minute_kline)
+            else:
+                continue
+            ctaMongo.upsert_kline(KLINE_DB_NAMES[prd], symbol, kline)
+            if symbol in active_dict:
+                ctaMongo.upsert_kline(KLINE_DB_NAMES[prd], active_dict[symbol], kline)
+
+    def put_completed_kline(self, period, kline):
+        """加入在其他进程中生成的已完成K线，用于获取过去K线
+
+        :param period: K线周期常量
+        :param kline: KLine
+        :return:
+        """
+        gen = self._get_gen(period)
+        with self.lock:
+            if gen.warmed_klines:
+                gen._merge_warmed_klines()
+            gen.put_kline(kline)
+
     def get_last_klines(self, symbol, count, period=PERIOD_1MIN, only_completed=True, newest_tick_datetime=None):
         """获取一定数量的过去K线
 
@@ -134,9 +534,37 @@ class KLineGenerator(object):
                                      可以通过手动传递最新到达的tick时间来彻底防止这个问题。
         :return:
         """
-        return self.kline_gens[period].get_last_klines(
+        return self._get_gen(period).get_last_klines(
                 symbol, count, only_completed,
-                newest_tick_datetime=newest_tick_datetime if newest_tick_datetime else dt.datetime.now())
+                newest_tick_datetime=newest_tick_datetime if newest_tick_datetime else dt.datetime.now(),
+                snapshot=self.snapshot_reads)
+
+    def get_last_kline_arrays(self, symbol, count, period=PERIOD_1MIN, only_completed=True,
+                              newest_tick_datetime=None):
+        """获取一定数量的过去K线的数组视图，参数同get_last_klines
+        返回的数组与K线缓存共享内存，不产生拷贝，适合需要对大量K线计算指标的策略；
+        snapshot_reads为True时返回拷贝。
+
+        :return: KLineArrays，各字段为按时间升序排列的只读numpy数组
+        """
+        return self._get_gen(period).get_last_kline_arrays(
+                symbol, count, only_completed,
+                newest_tick_datetime=newest_tick_datetime if newest_tick_datetime else dt.datetime.now(),
+                snapshot=self.snapshot_reads)
+
+    def warm_up(self, symbols, periods=None, count=INIT_KLINE_COUNT):
+        """预读历史K线
+        在线程池中并发查询数据库，查询结果在tick线程下一次更新K线时合并到缓存中，
+        避免在行情到来时同步查询数据库。
+
+        :param symbols: 合约代码列表
+        :param periods: K线周期常量列表，默认为各合约生成的周期
+        :param count: 每个合约预读的K线数目
+        :return:
+        """
+        for symbol in symbols:
+            for period in (periods if periods is not None else self.periods_of(symbol)):
+                self._get_gen(period).warm_up((symbol,), count)
 
 
 class KLine(object):
@@ -177,6 +605,16 @@ class KLine(object):
         self.volume = 0  # 成交量
         # self.openInterest = 0  # 持仓量
 
+        self.is_history = False  # 是否包含从数据库中读取的数据
+        self.live = None  # 包含从数据库中读取的数据时，其中由本次启动后的实时数据生成的部分
+
+    def live_part(self):
+        """由本次启动后的实时数据生成的部分，级联模式下只将该部分合成到其余周期
+
+        :return: KLine，全部为实时数据时为其本身，全部为数据库中的数据时为None
+        """
+        return self.live if self.is_history else self
+
     def update(self, tick):
         """更新K线值
 
@@ -196,6 +634,289 @@ class KLine(object):
         # 更新成交量
         self.volume += tick.lastVolume
 
+    def merge(self, other):
+        """合并同一时间的另一根K线，用于合并数据库中同一K线在本次启动前的数据，
+        级联模式下也用于将1分钟K线合并到较长周期的K线
+
+        :param other: KLine
+        :return:
+        """
+        if other.open_datetime < self.open_datetime:
+            self.open = other.open
+            self.open_datetime = other.open_datetime
+        if other.close_datetime > self.close_datetime:
+            self.close = other.close
+            self.close_datetime = other.close_datetime
+        self.high = max(self.high, other.high)
+        self.low = min(self.low, other.low)
+        self.volume += other.volume
+
+
+class KLineBuffer(object):
+    """单个合约单一周期的K线缓存
+    K线各字段按列存放在numpy数组中，数组的[begin, end)区间为按时间升序排列的有效K线。
+    最新一根K线同时以KLine对象保存，tick只更新该对象，读取缓存或追加K线前再写回数组。
+    数组尾部写满时将有效K线移到新数组头部，有效K线超过容量一半时容量加倍；
+    K线数目超过上限时从最老的K线开始丢弃。
+    """
+
+    def __init__(self, symbol, vtSymbol='', max_count=MAX_KLINE_COUNT, capacity=INIT_BUFFER_CAPACITY):
+        """初始化
+
+        :param symbol: 合约代码
+        :param vtSymbol: vt系统代码
+        :param max_count: K线最大缓存数目
+        :param capacity: 数组初始容量
+        """
+        self.symbol = symbol
+        self.vtSymbol = vtSymbol
+        self.max_count = max_count
+
+        self.columns = {}  # 列名 => numpy数组
+        self.capacity = 0
+        self.begin = 0
+        self.end = 0
+        self._resize(capacity)
+
+        self.last = None  # 最新一根K线
+        self.last_dirty = False  # 最新一根K线是否有尚未写回数组的修改
+        self.live_begin = None  # 第一根由实时数据生成的K线的时间，此前的K线均从数据库中读取
+
+    def __len__(self):
+        return self.end - self.begin
+
+    def update_last(self, tick):
+        """用tick更新最新一根K线
+
+        :param tick: VtTickData
+        :return: 最新一根K线
+        """
+        last = self.last
+        last.update(tick)
+        if last.is_history:
+            if last.live is None:
+                last.live = KLine(last.datetime)
+                last.live.symbol, last.live.vtSymbol = last.symbol, last.vtSymbol
+            last.live.update(tick)
+        self.last_dirty = True
+        if self.live_begin is None:
+            self.live_begin = self.last.datetime
+        return self.last
+
+    def append(self, kline):
+        """在末尾追加K线，K线时间须晚于缓存中所有K线
+
+        :param kline: KLine
+        :return:
+        """
+        self.sync()
+        self._reserve()
+        self._write(self.end, kline)
+        self.end += 1
+        self.last = kline
+        self._trim()
+
+    def insert(self, kline):
+        """按时间顺序插入K线，K线时间须与缓存中的K线都不相同
+        插入位置不在末尾时重新分配数组，不移动已取得的数组视图中的数据。
+
+        :param kline: KLine
+        :return:
+        """
+        if self.last is None or kline.datetime > self.last.datetime:
+            self.append(kline)
+        else:
+            self.merge((kline,))
+
+    def find(self, datetime):
+        """二分查找指定时间的K线
+
+        :param datetime: K线时间
+        :return: K线在缓存中的序号，不存在时返回-1
+        """
+        key = np.datetime64(datetime, 'us')
+        datetimes = self.columns['datetime'][self.begin:self.end]
+        idx = int(np.searchsorted(datetimes, key))
+        return idx if idx < len(datetimes) and datetimes[idx] == key else -1
+
+    def count_before(self, datetime):
+        """时间早于指定时间的K线数目
+
+        :param datetime: 时间
+        :return:
+        """
+        return int(np.searchsorted(self.columns['datetime'][self.begin:self.end], np.datetime64(datetime, 'us')))
+
+    def get(self, idx):
+        """获取指定序号的K线
+
+        :param idx: K线序号
+        :return: KLine，最新一根K线返回其对象本身，其余为根据数组内容新生成的对象
+        """
+        return self.klines(idx, idx + 1)[0]
+
+    def set(self, idx, kline):
+        """修改指定序号的K线
+
+        :param idx: K线序号
+        :param kline: KLine，时间须与原K线相同
+        :return:
+        """
+        if idx == len(self) - 1:
+            self.last = kline
+            self.last_dirty = True
+        else:
+            self._write(self.begin + idx, kline)
+
+    def klines(self, start=0, stop=None, snapshot=False):
+        """获取序号区间内的K线
+
+        :param start: 开始序号
+        :param stop: 结束序号（不包含），默认至最新一根K线
+        :param snapshot: 是否将最新一根K线也根据数组内容新生成，而不返回继续更新的对象本身
+        :return: KLine列表
+        """
+        self.sync()
+        count = len(self)
+        start, stop, _ = slice(start, stop).indices(count)
+        if start >= stop:
+            return []
+
+        values = zip(*[self.columns[name][self.begin + start:self.begin + stop].tolist()
+                       for name, _ in KLINE_COLUMNS])
+        klines = [self._make_kline(value) for value in values]
+        if stop == count and not snapshot:
+            klines[-1] = self.last
+        return klines
+
+    def arrays(self, start=0, stop=None, snapshot=False):
+        """获取序号区间内K线的数组视图
+        视图与缓存共享内存，不产生拷贝；之后追加的K线不会出现在视图中，
+        迟到的tick对区间内K线的更新会反映在视图中。
+
+        :param start: 开始序号
+        :param stop: 结束序号（不包含），默认至最新一根K线
+        :param snapshot: 是否返回拷贝，之后的更新不会反映在拷贝中
+        :return: KLineArrays，各字段为只读numpy数组
+        """
+        self.sync()
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        arrays = [self.columns[name][self.begin + start:self.begin + stop] for name, _ in KLINE_COLUMNS]
+        if snapshot:
+            arrays = [array.copy() for array in arrays]
+        return KLineArrays(*[_read_only(array) for array in arrays])
+
+    def mark_live(self, datetime):
+        """记录由实时数据生成或更新的K线，此后合并历史K线时不覆盖该时间及以后的K线
+
+        :param datetime: K线时间
+        :return:
+        """
+        if self.live_begin is None or datetime < self.live_begin:
+            self.live_begin = datetime
+
+    def merge(self, klines):
+        """合并历史K线
+        缓存中同一时间的K线：
+            由实时数据生成的K线，合并数据库中该K线在其第一个tick之前的数据，已合并过的部分不再重复合并；
+            从数据库中读取的K线（例如策略同步读取后预读结果才到达），以新读取的K线替换。
+        其余K线按时间顺序加入缓存。
+
+        :param klines: KLine列表
+        :return:
+        """
+        self.sync()
+
+        new_klines = []
+        for kline in klines:
+            idx = self.find(kline.datetime)
+            if idx < 0:
+                new_klines.append(kline)
+                continue
+            cached = self.get(idx)
+            if kline.close_datetime < cached.open_datetime:
+                # 早于缓存中K线的数据，即本次启动前该K线的数据；合并前的数据即为实时部分
+                if not cached.is_history:
+                    cached.live = KLineGenImpl._new_kline(cached.datetime, cached)
+                    cached.is_history = True
+                cached.merge(kline)
+                self.set(idx, cached)
+            elif self.live_begin is None or kline.datetime < self.live_begin:
+                self.set(idx, kline)
+        if not new_klines:
+            return
+
+        self.sync()
+        new_klines.sort(key=lambda k: k.datetime)
+
+        # 将新K线与缓存中的K线一起重新排序
+        count = len(self)
+        total = count + len(new_klines)
+        columns = {}
+        for name, dtype in KLINE_COLUMNS:
+            column = np.empty(max(self.capacity, total * 2), dtype)
+            column[:count] = self.columns[name][self.begin:self.end]
+            column[count:total] = [getattr(k, name) for k in new_klines]
+            columns[name] = column
+        order = np.argsort(columns['datetime'][:total], kind='mergesort')
+        for column in columns.values():
+            column[:total] = column[:total][order]
+
+        if self.last is None or new_klines[-1].datetime > self.last.datetime:
+            self.last = new_klines[-1]
+        self.columns = columns
+        self.capacity = len(columns['datetime'])
+        self.begin, self.end = 0, total
+        self._trim()
+
+    def sync(self):
+        """将最新一根K线的修改写回数组"""
+        if self.last_dirty:
+            self._write(self.end - 1, self.last)
+            self.last_dirty = False
+
+    def _write(self, pos, kline):
+        """将K线写入数组的指定位置"""
+        for name, _ in KLINE_COLUMNS:
+            self.columns[name][pos] = getattr(kline, name)
+
+    def _make_kline(self, values):
+        """根据数组中一行的值生成K线"""
+        kline = KLine(values[0])
+        kline.symbol = self.symbol
+        kline.vtSymbol = self.vtSymbol
+        (kline.open, kline.high, kline.low, kline.close, kline.volume,
+         kline.open_datetime, kline.close_datetime) = values[1:]
+        return kline
+
+    def _reserve(self):
+        """保证数组尾部至少有一个空位"""
+        if self.end < self.capacity:
+            return
+        count = len(self)
+        if count * 2 <= self.capacity:
+            self._resize(self.capacity)
+        else:
+            self._resize(min(self.capacity * 2, self.max_count * 2))
+
+    def _resize(self, capacity):
+        """重新分配数组并将有效K线移到头部"""
+        count = len(self)
+        columns = {}
+        for name, dtype in KLINE_COLUMNS:
+            columns[name] = np.empty(capacity, dtype)
+            if count:
+                columns[name][:count] = self.columns[name][self.begin:self.end]
+        self.columns = columns
+        self.capacity = capacity
+        self.begin, self.end = 0, count
+
+    def _trim(self):
+        """K线数目超过上限时丢弃最老的K线"""
+        if len(self) > self.max_count:
+            self.begin = self.end - self.max_count
+
 
 class KLineGenImpl(object):
     """K线生成器具体实现"""
@@ -204,14 +925,42 @@ class KLineGenImpl(object):
     kline_pattern_2 = {PERIOD_2MIN, PERIOD_30MIN, PERIOD_60MIN, PERIOD_120MIN, PERIOD_240MIN}
     kline_pattern_3 = PERIOD_1DAY
 
-    def __init__(self, period):
+    def __init__(self, period, load_history=True, lock=None):
         """初始化
 
         :param period: K线周期常量
+        :param load_history: 是否从数据库中读取历史K线
+        :param lock: K线缓存的锁，参照KLineGenerator.lock。update等tick线程中的方法由调用者持有，
+                     获取过去K线的方法自行获取
         """
         assert PERIOD_1MIN <= period <= PERIOD_1DAY
-        self.klines = defaultdict(OrderedDict)  # 各品种短周期K线容器，以symbol为键，每条线按时间顺序存放
+        self.lock = lock or threading.Lock()
+        self.buffers = {}  # 各品种K线缓存，以symbol为键
         self.period = period
+        self.load_history = load_history
+
+        # 各品种K线时间查找表，以symbol为键，交易时间线替换时清空，参照clear_timeline_caches
+        self.kline_tables = {}
+
+        # 各品种上一个tick所在分钟的开始、结束时间及其K线时间，以symbol为键
+        self.last_minutes = {}
+
+        # 数据库中已没有更早K线的合约
+        self.exhausted_symbols = set()
+
+        # 已开始预读历史K线的合约
+        self.warmed_symbols = set()
+
+        # 正在预读历史K线、尚未合并的合约
+        self.loading_symbols = set()
+
+        # 预读合并前暂不推送至数据库的合约，由KLineGenerator在预读合并或失败后推送期间生成的K线
+        self.held_symbols = set()
+
+        _kline_gen_impls.add(self)
+
+        # 预读完成等待合并的历史K线，由线程池追加，tick线程取出
+        self.warmed_klines = deque()
 
     def update(self, tick):
         """实时更新K线值
@@ -224,44 +973,93 @@ class KLineGenImpl(object):
         # updated_kline, is_completed = None, False
 
         if not tick.datetime:
-            tick.datetime = dt.datetime.strptime(' '.join([tick.date, tick.time]), '%Y%m%d %H:%M:%S.%f')
+            tick.datetime = ctaTick.parse_tick_datetime(tick.date, tick.time)
 
-        # 如缓存中不存在K线，则尝试从数据库中获取一部分K线
-        if not self.klines[tick.symbol]:
-            self.get_last_klines(tick.symbol, INIT_KLINE_COUNT)
+        # 合并已预读完成的历史K线；未预读过的合约在后台开始预读，不阻塞tick线程
+        if self.warmed_klines:
+            self._merge_warmed_klines()
+        if tick.symbol not in self.warmed_symbols:
+            self.warm_up((tick.symbol,), INIT_KLINE_COUNT)
 
         kline_datetime = self._calc_kline_datetime(tick)
 
-        if kline_datetime not in self.klines[tick.symbol]:  # 需要创建新的K线
-            # 创建新的K线并用tick更新
-            new_kline = KLine(kline_datetime)
-            new_kline.symbol = tick.symbol
-            new_kline.vtSymbol = tick.vtSymbol
-            new_kline.update(tick)
-
-            if len(self.klines[tick.symbol]) == 0:  # 若无历史K线
-                updated_kline, is_completed = new_kline, False
-            else:  # 将队列中最后一根K线作为已完成K线返回
-                updated_kline, is_completed = self.klines[tick.symbol].values()[-1], True
-
-            # 将K线放入容器，并确保新创建的K线不会破坏容器内的顺序
-            self.klines[tick.symbol][kline_datetime] = new_kline
-            if len(self.klines[tick.symbol]) > 1:
-                last_but_one, last_one = self.klines[tick.symbol].keys()[-2:]
-                if last_but_one > last_one:  # 违反时间顺序
-                    self.klines[tick.symbol] = OrderedDict(sorted(self.klines[tick.symbol].items()))
-
-            # 如果K线数量大于缓存最大容量，从最老的记录开始删除
-            while len(self.klines[tick.symbol]) > MAX_KLINE_COUNT:
-                self.klines[tick.symbol].popitem()
-        else:  # 更新既有K线
-            self.klines[tick.symbol][kline_datetime].update(tick)
-            updated_kline, is_completed = self.klines[tick.symbol][kline_datetime], False
-
-        return KLineTuple(updated_kline, is_completed)
-
-    def get_last_klines(self, symbol, count, only_completed=True, newest_tick_datetime=None):
-        """获取一定数量的过去K线
+        buf = self.buffers.get(tick.symbol)
+        if buf is None:
+            buf = self.buffers[tick.symbol] = KLineBuffer(tick.symbol, tick.vtSymbol)
+        last_kline = buf.last
+
+        # 更新最新一根K线
+        if last_kline is not None and kline_datetime == last_kline.datetime:
+            return KLineTuple(buf.update_last(tick), False)
+
+        # 需要创建新的K线，将上一根K线作为已完成K线返回
+        if last_kline is None or kline_datetime > last_kline.datetime:
+            buf.append(self._new_kline(kline_datetime, tick))
+            buf.mark_live(kline_datetime)
+            if last_kline is None:  # 若无历史K线
+                return KLineTuple(buf.last, False)
+            return KLineTuple(last_kline, True)
+
+        # 迟到的tick，更新或创建较早的K线
+        idx = buf.find(kline_datetime)
+        if idx >= 0:
+            kline = buf.get(idx)
+            kline.update(tick)
+            buf.set(idx, kline)
+        else:
+            kline = self._new_kline(kline_datetime, tick)
+            buf.insert(kline)
+        buf.mark_live(kline_datetime)
+        return KLineTuple(kline, False)
+
+    def update_with_kline(self, minute_kline, next_datetime, tick):
+        """级联模式下用已完成的1分钟K线更新K线
+
+        :param minute_kline: 已完成的1分钟K线
+        :param next_datetime: 下一根1分钟K线的时间，不属于同一根K线时判定K线已完成
+        :param tick: 触发1分钟K线完成的tick，用于获取合约的交易时间
+        :return: KLineTuple(更新后的K线, 是否已完成)
+        """
+        if self.warmed_klines:
+            self._merge_warmed_klines()
+        if tick.symbol not in self.warmed_symbols:
+            self.warm_up((tick.symbol,), INIT_KLINE_COUNT)
+
+        # 用1分钟K线的开始时间计算所属K线的时间
+        kline_datetime = self._calc_kline_datetime(
+                TickTime(tick.symbol, tick.exchange, minute_kline.datetime - ONE_MINUTE))
+
+        buf = self.buffers.get(tick.symbol)
+        if buf is None:
+            buf = self.buffers[tick.symbol] = KLineBuffer(tick.symbol, tick.vtSymbol)
+        last_kline = buf.last
+        buf.mark_live(kline_datetime)
+
+        if last_kline is not None and kline_datetime == last_kline.datetime:
+            kline = last_kline
+            kline.merge(minute_kline)
+            buf.last_dirty = True
+        elif last_kline is None or kline_datetime > last_kline.datetime:
+            kline = self._new_kline(kline_datetime, minute_kline)
+            buf.append(kline)
+        else:  # 迟到的1分钟K线
+            idx = buf.find(kline_datetime)
+            if idx >= 0:
+                kline = buf.get(idx)
+                kline.merge(minute_kline)
+                buf.set(idx, kline)
+            else:
+                kline = self._new_kline(kline_datetime, minute_kline)
+                buf.insert(kline)
+            return KLineTuple(kline, False)
+
+        # 下一根1分钟K线属于其他K线时，本K线已完成
+        next_kline_datetime = self._calc_kline_datetime(
+                TickTime(tick.symbol, tick.exchange, next_datetime - ONE_MINUTE))
+        return KLineTuple(kline, next_kline_datetime != kline_datetime)
+
+    def get_last_klines(self, symbol, count, only_completed=True, newest_tick_datetime=None, snapshot=False):
+        """获取一定数量的过去K线，可在任意线程中调用，但不能在持有锁时调用
 
         :param symbol: 合约代码
         :param count: K线数目
@@ -270,128 +1068,351 @@ class KLineGenImpl(object):
                                      默认使用当前本地时间，由于tick会延时到达，可能会造成将尚未更新完的K线返回，
                                      但在网络条件较好的情况下，影响很小，可以忽略。
                                      可以通过手动传递最新到达的tick时间来彻底防止这个问题。
+        :param snapshot: 是否返回最新一根K线的拷贝，默认返回tick线程继续更新的对象本身
         :return:
         """
+        with self.lock:
+            buf, start, stop = self._last_range(symbol, count, only_completed, newest_tick_datetime)
+            return buf.klines(start, stop, snapshot) if buf is not None else []
+
+    def get_last_kline_arrays(self, symbol, count, only_completed=True, newest_tick_datetime=None, snapshot=False):
+        """获取一定数量的过去K线的数组视图，参数同get_last_klines
+
+        :param snapshot: 是否返回拷贝，默认返回与缓存共享内存的视图
+        :return: KLineArrays，各字段为按时间升序排列的只读numpy数组
+        """
+        with self.lock:
+            buf, start, stop = self._last_range(symbol, count, only_completed, newest_tick_datetime)
+            return buf.arrays(start, stop, snapshot) if buf is not None else empty_kline_arrays()
+
+    def _last_range(self, symbol, count, only_completed, newest_tick_datetime):
+        """计算过去K线在缓存中的序号区间，所需K线不足时从数据库中读取
+        持有锁时调用，查询数据库期间释放锁，不阻塞tick线程。
+
+        :return: (K线缓存, 开始序号, 结束序号)，无K线时缓存为None
+        """
         symbol = symbol.upper()
 
+        if self.warmed_klines:
+            self._merge_warmed_klines()
+
+        buf = self.buffers.get(symbol)
+        cached_count = len(buf) if buf is not None else 0
+
         # 如所需K线不足，从数据库中读取
-        if len(self.klines) <= count:
-            from_datetime = (self.klines[symbol].values()[0].datetime
-                             if self.klines[symbol] else
-                             # 考虑跨周末的K线（例如用周五夜盘的tick更新下周一的日线），
-                             # 用三天后的时间作为过滤条件
-                             dt.datetime.now() + dt.timedelta(days=3))
-            for doc in ctaMongo.find_last_klines(
-                    KLINE_DB_NAMES[self.period], symbol, count - len(self.klines) + 1, from_datetime):
-                # 根据数据库查询结果生成历史K线
-                kline = KLine(doc['datetime'])
-                kline.vtSymbol = doc['vtSymbol']
-                kline.symbol = doc['symbol']
-                kline.open = doc['open']
-                kline.high = doc['high']
-                kline.low = doc['low']
-                kline.close = doc['close']
-                kline.volume = doc['volume']
-
-                # 如果有open和close的时间，则该记录是在线生成的K线，并且有需要继续更新的可能性。
-                kline.open_datetime = doc.get('open_datetime', dt.datetime.min)
-                kline.close_datetime = doc.get('close_datetime', dt.datetime.max)
-
-                # 将K线放入容器中
-                self.klines[symbol][kline.datetime] = kline
-
-            # 保证容器顺序
-            self.klines[symbol] = OrderedDict(sorted(self.klines[symbol].items()))
+        if cached_count <= count and self.load_history and symbol not in self.exhausted_symbols:
+            from_datetime = buf.klines(0, 1)[0].datetime if cached_count else _history_end_datetime()
+            load_count = count - cached_count + 1
+            self.lock.release()
+            try:
+                klines = self._load_klines(symbol, load_count, from_datetime)
+            finally:
+                self.lock.acquire()
+            if len(klines) < load_count:
+                self.exhausted_symbols.add(symbol)
+            self._merge_klines(symbol, klines)
+            buf = self.buffers.get(symbol)
+
+        if buf is None:
+            return None, 0, 0
 
         if not newest_tick_datetime:
             newest_tick_datetime = dt.datetime.now()
 
         if only_completed:
-            from_idx = len(self.klines[symbol])
-            for kline in self.klines[symbol].values()[::-1]:
-                if self.period < PERIOD_1DAY:  # 日线以下用K线的结束时间比较
-                    if kline.datetime < newest_tick_datetime:
-                        break
-                elif self.period == PERIOD_1DAY:  # 日线用日期比较
-                    # 将tick时间加上偏移量计算出所属日期，考虑跨非工作日的情况
-                    tick_date = adjust_to_next_working_day(
-                            newest_tick_datetime + dt.timedelta(hours=ctaTimeline.HOUR_BIAS)).date()
-                    if kline.datetime.date() < tick_date:
-                        break
-                else:
-                    raise AssertionError('K线周期不存在。')
-                from_idx -= 1
-            return self.klines[symbol].values()[max(from_idx - count, 0):from_idx]
+            if self.period < PERIOD_1DAY:  # 日线以下用K线的结束时间比较
+                stop = buf.count_before(newest_tick_datetime)
+            elif self.period == PERIOD_1DAY:  # 日线用日期比较
+                # 将tick时间加上偏移量计算出所属交易日，考虑跨非交易日的情况
+                tick_date = ctaCalendar.trading_day(newest_tick_datetime)
+                stop = buf.count_before(dt.datetime.combine(tick_date, dt.time()))
+            else:
+                raise AssertionError('K线周期不存在。')
+        else:
+            stop = len(buf)
+        return buf, max(stop - count, 0), stop
+
+    def warm_up(self, symbols, count=INIT_KLINE_COUNT):
+        """在线程池中预读历史K线
+
+        :param symbols: 合约代码列表
+        :param count: 每个合约预读的K线数目
+        :return:
+        """
+        for symbol in symbols:
+            symbol = symbol.upper()
+            if symbol not in self.warmed_symbols:
+                self.warmed_symbols.add(symbol)
+                if self.load_history:
+                    self.loading_symbols.add(symbol)
+                    _get_warm_up_pool().apply_async(self._warm_up_task, (symbol, count))
+
+    def _warm_up_task(self, symbol, count):
+        """预读任务，在线程池中执行
+
+        :param symbol: 合约代码
+        :param count: 预读的K线数目
+        :return:
+        """
+        try:
+            klines = self._load_klines(symbol, count, _history_end_datetime())
+            self.warmed_klines.append((symbol, klines))
+        except:
+            traceback.print_exc()
+            # 预读失败也需通知tick线程，以恢复推送该合约的K线
+            self.warmed_klines.append((symbol, []))
+
+    def _merge_warmed_klines(self):
+        """合并预读完成的历史K线，在tick线程中执行"""
+        while self.warmed_klines:
+            symbol, klines = self.warmed_klines.popleft()
+            self.loading_symbols.discard(symbol)
+            # 预读期间已释放的合约不再合并
+            if symbol in self.warmed_symbols and klines:
+                self._merge_klines(symbol, klines)
+
+    def put_kline(self, kline):
+        """加入完整的K线，替换缓存中同一时间的K线
+
+        :param kline: KLine
+        :return:
+        """
+        buf = self.buffers.get(kline.symbol)
+        if buf is None:
+            buf = self.buffers[kline.symbol] = KLineBuffer(kline.symbol, kline.vtSymbol)
+        idx = buf.find(kline.datetime) if buf.last is not None and kline.datetime <= buf.last.datetime else -1
+        if idx >= 0:
+            buf.set(idx, kline)
         else:
-            return self.klines[symbol].values()[-count:]
+            buf.insert(kline)
+        buf.mark_live(kline.datetime)
+
+    def drop(self, symbol):
+        """释放合约的K线缓存及相关状态，在tick线程中执行
+        之后再次更新该合约时重新预读历史K线。
+
+        :param symbol: 合约代码
+        :return:
+        """
+        self.buffers.pop(symbol, None)
+        self.kline_tables.pop(symbol, None)
+        self.last_minutes.pop(symbol, None)
+        self.exhausted_symbols.discard(symbol)
+        self.warmed_symbols.discard(symbol)
+        self.loading_symbols.discard(symbol)
+        self.held_symbols.discard(symbol)
+
+    def _load_klines(self, symbol, count, from_datetime):
+        """从数据库中读取历史K线
+
+        :param symbol: 合约代码
+        :param count: K线数目
+        :param from_datetime: 条件时间点，不包含以该时间结束的K线
+        :return: K线列表
+        """
+        klines = []
+        for doc in ctaMongo.find_last_klines(KLINE_DB_NAMES[self.period], symbol, count, from_datetime):
+            # 根据数据库查询结果生成历史K线
+            kline = KLine(doc['datetime'])
+            kline.vtSymbol = doc['vtSymbol']
+            kline.symbol = doc['symbol']
+            kline.open = doc['open']
+            kline.high = doc['high']
+            kline.low = doc['low']
+            kline.close = doc['close']
+            kline.volume = doc['volume']
+
+            # 如果有open和close的时间，则该记录是在线生成的K线，并且有需要继续更新的可能性。
+            kline.open_datetime = doc.get('open_datetime', dt.datetime.min)
+            kline.close_datetime = doc.get('close_datetime', dt.datetime.max)
+            kline.is_history = True
+
+            klines.append(kline)
+        return klines
+
+    def _merge_klines(self, symbol, klines):
+        """将历史K线合并到缓存中
+
+        :param symbol: 合约代码
+        :param klines: K线列表
+        :return:
+        """
+        if not klines:
+            return
+        buf = self.buffers.get(symbol)
+        if buf is None:
+            buf = self.buffers[symbol] = KLineBuffer(symbol, klines[0].vtSymbol)
+        buf.merge(klines)
+
+    @staticmethod
+    def _new_kline(kline_datetime, source):
+        """创建新的K线并用tick或较短周期的K线更新
+
+        :param kline_datetime: K线时间
+        :param source: VtTickData或KLine
+        :return: KLine
+        """
+        new_kline = KLine(kline_datetime)
+        new_kline.symbol = source.symbol
+        new_kline.vtSymbol = source.vtSymbol
+        if isinstance(source, KLine):
+            new_kline.merge(source)
+        else:
+            new_kline.update(source)
+        return new_kline
 
     def _calc_kline_datetime(self, tick):
         """计算K线时间
+        使用tick品种交易时间线和K线周期对应的查找表，以偏移后的分钟数定位K线。
 
         :param tick: VtTickData
         :return:
         """
-        # 1、3、5、15分钟K线，不会跨交易时间段
-        if self.period in self.kline_pattern_1:
-            # 以分钟精度计算tick时间
-            tick_dt_minute = tick.datetime.replace(second=0, microsecond=0)
+        # 与该品种上一个tick在同一分钟内时直接使用上次的结果
+        datetime = tick.datetime
+        last_minute = self.last_minutes.get(tick.symbol)
+        if last_minute is not None and last_minute[0] <= datetime < last_minute[1]:
+            return last_minute[2]
+
+        table = self.kline_tables.get(tick.symbol)
+        if table is None:
+            table = self.kline_tables[tick.symbol] = get_kline_table(self.period, tick)
+
+        entry = table[(datetime.hour * 60 + datetime.minute + BIAS_MINUTES) % MINUTES_OF_DAY]
+        if entry is None:
+            raise LookupError('找不到Tick数据对应的K线时间。')
+
+        # 以分钟精度计算tick时间，加上到K线时间的时间差
+        timedelta_tick2kline, to_working_day = entry
+        tick_dt_minute = dt.datetime(datetime.year, datetime.month, datetime.day, datetime.hour, datetime.minute)
+        kline_datetime = tick_dt_minute + timedelta_tick2kline
+        if to_working_day:
+            kline_datetime = ctaCalendar.next_trading_day(kline_datetime)
+
+        self.last_minutes[tick.symbol] = (tick_dt_minute, tick_dt_minute + ONE_MINUTE, kline_datetime)
+        return kline_datetime
+
+
+def clear_timeline_caches():
+    """清除按合约缓存的K线时间查找表及K线时间线，交易时间线替换后由ctaTimeline.load_sessions调用
+    按交易时间线缓存的编译结果与合约无关，无需清除。
+    """
+    get_kline_table.__dict__.clear()
+    get_kline_timeline.__dict__.clear()
+    for gen in list(_kline_gen_impls):
+        gen.kline_tables.clear()
+        gen.last_minutes.clear()
 
-            # 计算整周期中的分钟余数
-            minute_remainder = (int((tick_dt_minute - dt.datetime.min).total_seconds() // 60) %
-                                MINUTES_OF_PERIOD[self.period])
 
-            # 将tick_dt_minute修正到整周期位置
-            tick_dt_minute -= dt.timedelta(minutes=minute_remainder)
+ctaTimeline.add_sessions_listener(clear_timeline_caches)
 
-            # 返回K线的结束时间
-            return tick_dt_minute + dt.timedelta(minutes=MINUTES_OF_PERIOD[self.period])
 
-        # 2、30、60、120、240分钟K线，会跨交易时间段和周末非交易日
-        if self.period in self.kline_pattern_2:
-            # 获取tick品种对应的K线时间线
-            timeline = get_kline_timeline(self.period, tick)
+def _get_warm_up_pool():
+    """获取预读历史K线的线程池"""
+    global _warm_up_pool
+    with _warm_up_pool_lock:
+        if _warm_up_pool is None:
+            _warm_up_pool = ThreadPool(WARM_UP_THREADS)
+    return _warm_up_pool
 
-            # 以分钟精度计算tick时间
-            tick_dt_minute = tick.datetime.replace(second=0, microsecond=0)
-            tick_time = ctaTimeline.Tradetime(ctaTimeline.hour_bias_helper(tick_dt_minute.time()), ctaTimeline.OPEN)
 
-            # 使用二分法确定tick所在K线的位置
-            start_idx = bisect.bisect_right(timeline, tick_time) - 1
-            assert timeline[start_idx].oc
+def _read_only(array):
+    """将数组标记为只读后返回"""
+    array.flags.writeable = False
+    return array
 
-            # 获取K线的结束时间
-            timedelta_tick2close = (dt.datetime.combine(dt.datetime.min, timeline[start_idx + 1].time) -
-                                    dt.datetime.combine(dt.datetime.min, tick_time.time))
-            end_datetime = tick_dt_minute + timedelta_tick2close
 
-            # 对于有夜盘的品种，当最后一根K线跨了交易时间段，则它的结束时间的日期应当为下一个工作日，
-            # 否则当下一个工作日的tick到来时无法继续更新最后一根K线。
-            # 周一到周四的夜盘，由于结束时间会自动计算到正常工作日，不会出问题。
-            # 而对于周五的夜盘，由于跨了周末非交易日，最后一根K线的结束时间需要做特殊处理，否则会落到周六。
+def empty_kline_arrays():
+    """生成不含K线的K线数组"""
+    return KLineArrays(*[_read_only(np.empty(0, dtype)) for _, dtype in KLINE_COLUMNS])
 
-            # 首先判断tick为周五夜盘
-            if (tick.datetime + dt.timedelta(hours=ctaTimeline.HOUR_BIAS)).weekday() == 5:
-                # 获取夜盘结束时间
-                nighttime_end = next(itertools.dropwhile(lambda t: t.oc == ctaTimeline.OPEN,
-                                                         ctaTimeline.timeline_for_tick(tick)))
-                # 若K线开始时间、结束时间跨越了夜盘结束时间点，将K线结束时间调整到工作日
-                if timeline[start_idx].time < nighttime_end.time < timeline[start_idx + 1].time:
-                    end_datetime = adjust_to_next_working_day(end_datetime)
 
-            # 返回K线的结束时间
-            return end_datetime
+def make_kline_arrays(docs):
+    """根据数据库中的K线记录生成K线数组
 
-        # 日线，会跨周末非交易日
-        if self.period == self.kline_pattern_3:
-            # 将tick时间加上偏移量计算出所属日期，考虑跨非工作日的情况
-            tick_dt_date = adjust_to_next_working_day(
-                    tick.datetime + dt.timedelta(hours=ctaTimeline.HOUR_BIAS)).replace(
-                    hour=0, minute=0, second=0, microsecond=0)
+    :param docs: 按时间升序排列的K线记录
+    :return: KLineArrays，各字段为只读numpy数组
+    """
+    rows = [(doc['datetime'], doc['open'], doc['high'], doc['low'], doc['close'], doc['volume'],
+             doc.get('open_datetime', dt.datetime.min), doc.get('close_datetime', dt.datetime.max))
+            for doc in docs]
+    if not rows:
+        return empty_kline_arrays()
+    return KLineArrays(*[_read_only(np.array(values, dtype))
+                         for values, (_, dtype) in zip(zip(*rows), KLINE_COLUMNS)])
 
-            # 返回K线所在交易日零时
-            return tick_dt_date
 
-        raise LookupError('找不到Tick数据对应的K线时间。')
+def get_kline_table(period, tick):
+    """获取tick品种对应的K线时间查找表
+
+    :param period: K线周期常量
+    :param tick: VtTickData
+    :return: 参照compile_kline_table
+    """
+    # 尝试从缓存中获取已计算的结果
+    memorize_key = (tick.symbol, period)
+    if memorize_key in get_kline_table.__dict__:
+        return get_kline_table.__dict__[memorize_key]
+
+    table = compile_kline_table(period, ctaTimeline.timeline_for_tick(tick))
+    get_kline_table.__dict__[memorize_key] = table
+    return table
+
+
+def compile_kline_table(period, trade_timeline):
+    """编译K线时间查找表
+    将交易时间线和K线周期的组合编译为以偏移后的分钟数为索引的查找表，
+    同一交易时间线的所有品种共用同一张表。
+    各周期K线的划分方法：
+        1、3、5、15分钟K线，不会跨交易时间段，按整周期划分；
+        2、30、60、120、240分钟K线，会跨交易时间段和周末非交易日，按get_kline_timeline得到的时间线划分；
+        日线，会跨周末和节假日等非交易日，按偏移后的日期划分，K线时间为交易日零时。
+
+    :param period: K线周期常量
+    :param trade_timeline: 交易时间线
+    :return: 长度为MINUTES_OF_DAY的列表，元素为(从tick所在分钟到K线时间的时间差, 是否需要将K线时间调整至交易日)，
+             不属于任何K线的分钟为None
+    """
+    # 尝试从缓存中获取已计算的结果
+    memorize_key = (period, tuple(trade_timeline))
+    if memorize_key in compile_kline_table.__dict__:
+        return compile_kline_table.__dict__[memorize_key]
+
+    table = [None] * MINUTES_OF_DAY
+    period_minutes = MINUTES_OF_PERIOD[period]
+
+    if period in KLineGenImpl.kline_pattern_1:
+        # 周期分钟数能整除小时偏移量，偏移后的分钟数与原分钟数对周期的余数相同
+        for minute in range(MINUTES_OF_DAY):
+            table[minute] = (dt.timedelta(minutes=period_minutes - minute % period_minutes), False)
+
+    elif period in KLineGenImpl.kline_pattern_2:
+        timeline = _build_kline_timeline(period, trade_timeline)
+
+        # 对于有夜盘的品种，当K线跨了夜盘结束时间，则它的结束时间的日期应当为下一个交易日，
+        # 周一到周四的夜盘一般会自动落到交易日，周五的夜盘则会落到周六，需要调整到下一个交易日。
+        nighttime_end = next(itertools.dropwhile(lambda t: t.oc == ctaTimeline.OPEN, trade_timeline))
+
+        for minute in range(MINUTES_OF_DAY):
+            tick_time = ctaTimeline.Tradetime(dt.time(minute // 60, minute % 60), ctaTimeline.OPEN)
+
+            # 使用二分法确定K线的位置，落在非交易时间的分钟不属于任何K线
+            start_idx = bisect.bisect_right(timeline, tick_time) - 1
+            if not timeline[start_idx].oc:
+                continue
+
+            timedelta_tick2close = (dt.datetime.combine(dt.date.min, timeline[start_idx + 1].time) -
+                                    dt.datetime.combine(dt.date.min, tick_time.time))
+            table[minute] = (timedelta_tick2close,
+                             timeline[start_idx].time < nighttime_end.time < timeline[start_idx + 1].time)
+
+    elif period == KLineGenImpl.kline_pattern_3:
+        # 偏移后日期的零时，考虑跨非交易日的情况
+        for minute in range(MINUTES_OF_DAY):
+            table[minute] = (dt.timedelta(minutes=BIAS_MINUTES - minute), True)
+
+    compile_kline_table.__dict__[memorize_key] = table
+    return table
 
 
 def get_kline_timeline(period, tick):
@@ -415,14 +1436,25 @@ def get_kline_timeline(period, tick):
     if memorize_key in get_kline_timeline.__dict__:
         return get_kline_timeline.__dict__[memorize_key]
 
+    # 根据该品种交易时间线计算，并将计算结果存入缓存
+    timeline = _build_kline_timeline(period, ctaTimeline.timeline_for_tick(tick))
+    get_kline_timeline.__dict__[memorize_key] = timeline
+
+    return timeline
+
+
+def _build_kline_timeline(period, trade_timeline):
+    """根据交易时间线计算中周期K线的时间线，参照get_kline_timeline
+
+    :param period: K线周期常量
+    :param trade_timeline: 交易时间线
+    :return:
+    """
     # 方法返回值
     timeline = []
     # 周期分钟数
     period_minutes = MINUTES_OF_PERIOD[period]
 
-    # 获取该品种交易时间线
-    trade_timeline = ctaTimeline.timeline_for_tick(tick)
-
     # 交易时间线上每个时间段的开始部分，需要补充到上一个时间段最后一根K线的长度
     delta_add_to_last_kline = dt.timedelta()
 
@@ -464,18 +1496,23 @@ def get_kline_timeline(period, tick):
     if timeline[-1] != trade_timeline[-1]:
         timeline.append(trade_timeline[-1])
 
-    # 将计算结果存入缓存
-    get_kline_timeline.__dict__[memorize_key] = timeline
-
     return timeline
 
 
 def adjust_to_next_working_day(datetime):
-    """将时间点向后调整至工作日
+    """将时间点向后调整至交易日，考虑周末和交易所节假日
 
     :param datetime: dt.datetime or dt.date
     :return:
     """
-    while datetime.weekday() in (5, 6):
-        datetime += dt.timedelta(days=1)
-    return datetime
+    return ctaCalendar.next_trading_day(datetime)
+
+
+def _history_end_datetime():
+    """读取历史K线时的条件时间点
+    考虑跨非交易日的K线（例如用周五夜盘的tick更新下一个交易日的日线），
+    使用当前时间所属交易日的次日零时。
+
+    :return:
+    """
+    return dt.datetime.combine(ctaCalendar.trading_day(dt.datetime.now()), dt.time()) + dt.timedelta(days=1)
@@ -1,69 +1,703 @@
 # encoding: UTF-8
 
+import cPickle
 import multiprocessing
+import operator
+import os
+import shutil
+import threading
+import time
 import traceback
+import zlib
+from Queue import Empty
+from collections import OrderedDict
 
 import pymongo
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
 
 from ctaAlgo.ctaBase import CtaBarData
 from dataRecorder.drBase import DrTickData
+from . import ctaJournal
 
-# 数据库写入进程
-_db_write_proc = None
+# 数据库写入进程，每个进程负责一部分集合的写入
+_db_write_procs = []
 
-# 数据库写入进程的任务队列
-_db_write_task_queue = None
+# 数据库写入进程的任务队列，与写入进程一一对应
+_db_write_task_queues = []
+
+# (数据库名, 集合名) => 负责写入的进程序号
+_db_write_shard_cache = {}
+
+# 写入进程向主进程汇报统计信息的队列
+_db_write_stats_queue = None
+
+# 各写入进程最近一次汇报的统计信息，写入进程序号 => 统计信息字典
+_db_write_stats = {}
+
+# 主进程推送任务失败的次数
+_post_error_count = 0
+
+# 替代数据库写入进程接收写入任务的对象，参照set_write_sink
+_write_sink = None
+
+# 历史数据查询使用的数据库连接，MongoClient自带连接池，可在多个线程中共用
+_query_conn = None
+_query_conn_lock = threading.Lock()
+
+# 写入进程中已确认建立datetime索引的集合，(数据库名, 集合名)的集合
+_indexed_collections = set()
 
 # 数据库写入进程停止符
-STOP_CTAMONGO_QUEUE = ('STOP_CTAMONGO_QUEUE', None)
+STOP_CTAMONGO_QUEUE = ('STOP_CTAMONGO_QUEUE', None, 0)
+
+# 写入进程汇报统计信息的间隔（秒）
+WRITE_STATS_INTERVAL = 5.0
+
+# 统计信息中计算的延时百分位
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# tick写入任务传输的字段，与DrTickData的属性一一对应，另外保留接口推送的gatewayName；
+# rawData为接口原始数据，不一定能写入数据库，不记录
+TICK_FIELDS = ('vtSymbol', 'symbol', 'exchange', 'gatewayName',
+               'lastPrice', 'lastVolume', 'volume', 'openInterest',
+               'openPrice', 'highPrice', 'lowPrice', 'preClosePrice',
+               'upperLimit', 'lowerLimit',
+               'date', 'time', 'datetime',
+               'bidPrice1', 'bidPrice2', 'bidPrice3', 'bidPrice4', 'bidPrice5',
+               'askPrice1', 'askPrice2', 'askPrice3', 'askPrice4', 'askPrice5',
+               'bidVolume1', 'bidVolume2', 'bidVolume3', 'bidVolume4', 'bidVolume5',
+               'askVolume1', 'askVolume2', 'askVolume3', 'askVolume4', 'askVolume5')
+
+# K线写入任务传输的字段
+KLINE_FIELDS = ('symbol', 'datetime', 'open', 'high', 'low', 'close', 'volume', 'open_datetime', 'close_datetime')
+
+# 写入任务的编码函数，将对象转换为只包含上述字段的元组，以减少进程间传输的序列化开销
+encode_tick = operator.attrgetter(*TICK_FIELDS)
+encode_kline = operator.attrgetter(*KLINE_FIELDS)
+
+# 默认数据库写入进程数
+DEFAULT_WRITE_SHARDS = 1
+
+# 停止时等待各写入进程完成剩余任务的最长时间（秒）
+STOP_WRITE_TIMEOUT = 10
+
+# 批量写入的默认最大任务数
+DEFAULT_WRITE_BATCH_SIZE = 1000
+
+# 批量写入的默认最长等待时间（秒），队列中任务不足一批时最多等待该时间后即写入
+DEFAULT_WRITE_LINGER = 0.05
+
+# 数据库无法连接或写入失败时，发送线程重试写入日志中任务的间隔（秒）
+JOURNAL_RETRY_INTERVAL = 5.0
+
+# 日志中同一批任务写入失败的最大尝试次数，超过后移入拒绝日志，不再阻塞后续任务
+JOURNAL_MAX_ATTEMPTS = 12
+
+# 写前日志目录中记录写入进程数的文件名
+JOURNAL_SHARDS_FILENAME = 'shards'
+
+# 写前日志目录中暂存待重新分片日志的子目录名
+JOURNAL_REPARTITION_DIRNAME = 'repartition'
+
+# 写前日志目录中保存多次写入失败的任务的子目录名，其中的任务需排查原因后重新写入
+JOURNAL_REJECTED_DIRNAME = 'rejected'
 
+# 更新中K线的默认刷新间隔（秒）
+DEFAULT_KLINE_FLUSH_INTERVAL = 1.0
 
-def init_db_write_process():
+# 等待写入的更新中K线，(数据库名, 集合名, K线时间) => K线
+# 同一根K线在刷新间隔内的多次更新只保留最新状态
+_pending_klines = OrderedDict()
+
+# 更新中K线的刷新间隔（秒）
+_kline_flush_interval = DEFAULT_KLINE_FLUSH_INTERVAL
+
+# 上一次刷新更新中K线的时间
+_last_kline_flush_time = 0
+
+
+def init_db_write_process(shards=DEFAULT_WRITE_SHARDS, batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                          linger=DEFAULT_WRITE_LINGER, kline_flush_interval=DEFAULT_KLINE_FLUSH_INTERVAL,
+                          journal_dir=None):
     """初始化数据库写入进程
+    启动shards个写入进程，每个进程拥有独立的任务队列和数据库连接。
 
+    :param shards: 写入进程数
+    :param batch_size: 单次批量写入的最大任务数
+    :param linger: 凑批时的最长等待时间（秒）
+    :param kline_flush_interval: 更新中K线的刷新间隔（秒）
+    :param journal_dir: 写前日志目录，各写入进程使用其中的独立子目录；为None时不使用日志，任务直接写入数据库
+    :return:
+    """
+    global _kline_flush_interval, _db_write_stats_queue
+    _kline_flush_interval = kline_flush_interval
+    if not _db_write_procs:
+        if journal_dir:
+            _repartition_journals(journal_dir, max(shards, 1))
+        _db_write_stats_queue = multiprocessing.Queue()
+        for shard in range(max(shards, 1)):
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=_do_db_write_task,
+                                           args=(shard, queue, _db_write_stats_queue, batch_size, linger,
+                                                 journal_dir))
+            proc.daemon = True
+            proc.start()
+            _db_write_task_queues.append(queue)
+            _db_write_procs.append(proc)
+
+
+def stop_db_write_process(timeout=STOP_WRITE_TIMEOUT):
+    """停止所有数据库写入进程
+    暂存的K线将先被推送，各写入进程完成队列中剩余的任务后退出。
+
+    :param timeout: 等待每个写入进程退出的最长时间（秒）
     :return:
     """
-    global _db_write_proc, _db_write_task_queue
-    if not _db_write_proc:
-        _db_write_task_queue = multiprocessing.Queue()
-        _db_write_proc = multiprocessing.Process(target=_do_db_write_task, args=(_db_write_task_queue,))
-        _db_write_proc.daemon = True
-        _db_write_proc.start()
+    flush_klines()
+    for queue in _db_write_task_queues:
+        queue.put(STOP_CTAMONGO_QUEUE)
+    for proc in _db_write_procs:
+        proc.join(timeout)
+    del _db_write_procs[:]
+    del _db_write_task_queues[:]
+    _db_write_shard_cache.clear()
+    _db_write_stats.clear()
+
+
+def get_db_write_queues():
+    """获取各写入进程的任务队列，用于传递给K线生成子进程
+
+    :return: 任务队列列表
+    """
+    return list(_db_write_task_queues)
+
+
+def attach_db_write_queues(queues, kline_flush_interval=DEFAULT_KLINE_FLUSH_INTERVAL):
+    """在子进程中使用主进程启动的写入进程，写入任务按相同的分片规则推送
+
+    :param queues: get_db_write_queues的返回值
+    :param kline_flush_interval: 更新中K线的刷新间隔（秒）
+    :return:
+    """
+    global _kline_flush_interval
+    _kline_flush_interval = kline_flush_interval
+    _db_write_task_queues[:] = queues
+    _db_write_shard_cache.clear()
+
+
+def _shard_of(dbname, colname):
+    """计算集合对应的写入进程序号
+    使用稳定的哈希值，保证同一集合的任务总是由同一进程按顺序写入。
+
+    :param dbname: 数据库名
+    :param colname: 集合名
+    :return: 写入进程序号
+    """
+    key = (dbname, colname)
+    if key not in _db_write_shard_cache:
+        _db_write_shard_cache[key] = _shard_index(dbname, colname, len(_db_write_task_queues))
+    return _db_write_shard_cache[key]
 
 
-def _post(*task):
+def _shard_index(dbname, colname, shards):
+    """按集合的稳定哈希值计算写入进程序号
+
+    :param dbname: 数据库名
+    :param colname: 集合名
+    :param shards: 写入进程数
+    :return: 写入进程序号
+    """
+    return (zlib.crc32('{}/{}'.format(dbname, colname)) & 0xFFFFFFFF) % shards
+
+
+def _repartition_journals(journal_dir, shards):
+    """写入进程数改变后，将各写入进程日志中尚未写入的任务按新的写入进程数重新分片
+    减少写入进程数时，多出的写入进程的日志不再有进程发送；增加时，同一集合的任务会分属新旧两个进程，
+    新旧任务的写入顺序无法保证。因此在启动写入进程前，将所有日志移至暂存目录，
+    按集合重新分配到各写入进程的日志中。同一集合的任务原本只在一个日志中，移动后仍保持顺序。
+    中途退出时暂存目录保留，下次启动时继续处理。
+
+    :param journal_dir: 写前日志目录
+    :param shards: 写入进程数
+    :return:
+    """
+    if not os.path.isdir(journal_dir):
+        os.makedirs(journal_dir)
+    shards_filename = os.path.join(journal_dir, JOURNAL_SHARDS_FILENAME)
+    try:
+        with open(shards_filename) as fp:
+            previous_shards = int(fp.read())
+    except (IOError, ValueError):
+        previous_shards = None
+
+    repartition_dir = os.path.join(journal_dir, JOURNAL_REPARTITION_DIRNAME)
+    names = [name for name in os.listdir(journal_dir) if name.startswith('shard') and name[5:].isdigit()]
+    if names and previous_shards != shards:
+        if not os.path.isdir(repartition_dir):
+            os.makedirs(repartition_dir)
+        stamp = int(time.time())
+        for name in names:
+            os.rename(os.path.join(journal_dir, name), os.path.join(repartition_dir, '{}.{}'.format(name, stamp)))
+
+    if os.path.isdir(repartition_dir):
+        targets = {}
+        for name in sorted(os.listdir(repartition_dir)):
+            source = ctaJournal.Journal(os.path.join(repartition_dir, name))
+            while True:
+                position, payloads = source.read(DEFAULT_WRITE_BATCH_SIZE)
+                if not payloads:
+                    break
+                routed = OrderedDict()
+                for payload in payloads:
+                    try:
+                        _, args, _ = cPickle.loads(payload)
+                        shard = _shard_index(args[0], args[1], shards)
+                    except:  # 无法解析的任务交给0号写入进程，由其移入拒绝日志
+                        shard = 0
+                    routed.setdefault(shard, []).append(payload)
+                for shard, shard_payloads in routed.items():
+                    target = targets.get(shard)
+                    if target is None:
+                        target = targets[shard] = ctaJournal.Journal(
+                                os.path.join(journal_dir, 'shard{}'.format(shard)))
+                    target.append(shard_payloads)
+                source.commit(position)
+            source.close()
+            shutil.rmtree(os.path.join(repartition_dir, name))
+        for target in targets.values():
+            target.close()
+        os.rmdir(repartition_dir)
+
+    with open(shards_filename, 'w') as fp:
+        fp.write(str(shards))
+
+
+def _post(func, args):
     """数据库写入任务推送
+    任务按参数中的数据库名、集合名分发至对应的写入进程。
 
-    :param task:
+    :param func: 任务函数名
+    :param args: 任务参数，前两项为数据库名、集合名
     :return:
     """
+    global _post_error_count
+    if _write_sink is not None:
+        _write_sink.post(func, args)
+        return
+
     try:
-        _db_write_task_queue.put_nowait(task)
+        # 附带推送时间，用于统计任务在队列中的等待时间
+        _db_write_task_queues[_shard_of(args[0], args[1])].put_nowait((func, args, time.time()))
     except:
+        _post_error_count += 1
         traceback.print_exc()
 
 
+def set_write_sink(sink):
+    """设置替代数据库写入进程的写入目标，回放和测试时使用
+
+    :param sink: 实现post(func, args)方法的对象，例如MemorySink；为None时恢复推送至写入进程
+    :return: 之前的写入目标
+    """
+    global _write_sink
+    previous, _write_sink = _write_sink, sink
+    return previous
+
+
+class MemorySink(object):
+    """内存中的写入目标
+    与数据库相同，同一集合中时间相同的记录互相替换，结果可按集合读取。
+    """
+
+    def __init__(self):
+        # (数据库名, 集合名) => 时间 => (字段名, 编码后的记录)
+        self.collections = {}
+
+        # 收到的写入任务数
+        self.task_count = 0
+
+    def post(self, func, args):
+        """接收写入任务
+
+        :param func: 任务函数名
+        :param args: (数据库名, 集合名, 编码后的记录)
+        :return:
+        """
+        dbname, colname, record = args
+        fields = TICK_FIELDS if func == _upsert_tick_task.__name__ else KLINE_FIELDS
+        records = self.collections.get((dbname, colname))
+        if records is None:
+            records = self.collections[(dbname, colname)] = {}
+        records[record[fields.index('datetime')]] = (fields, record)
+        self.task_count += 1
+
+    def find(self, dbname, colname):
+        """读取集合中的全部记录
+
+        :param dbname: 数据库名
+        :param colname: 集合名
+        :return: 按时间升序排列的记录字典列表
+        """
+        records = self.collections.get((dbname, colname), {})
+        return [dict(zip(*records[k])) for k in sorted(records)]
+
+
+def get_write_stats():
+    """获取数据库写入统计信息
+    收取各写入进程汇报的最新统计信息，并附加主进程侧的统计。
+
+    :return: 统计信息字典：
+             - shards          各写入进程的统计信息列表，参照WriteStats.report
+             - pending_klines  暂存中等待写入的更新中K线数目
+             - post_errors     主进程推送任务失败的累计次数
+             - updated         自上次调用以来是否收到了新的汇报
+    """
+    updated = False
+    while _db_write_stats_queue is not None:
+        try:
+            stats = _db_write_stats_queue.get_nowait()
+        except Empty:
+            break
+        _db_write_stats[stats['shard']] = stats
+        updated = True
+
+    return dict(shards=[_db_write_stats[k] for k in sorted(_db_write_stats)],
+                pending_klines=len(_pending_klines),
+                post_errors=_post_error_count,
+                updated=updated)
+
+
 def _make_db_conn():
     """生成新的数据库连接"""
     return pymongo.MongoClient()
 
 
-def _do_db_write_task(queue):
+def _get_query_conn():
+    """获取历史数据查询使用的数据库连接，可在多个线程中共用"""
+    global _query_conn
+    with _query_conn_lock:
+        if _query_conn is None:
+            _query_conn = _make_db_conn()
+    return _query_conn
+
+
+def reset_query_conn():
+    """丢弃从父进程继承的查询连接，在子进程开始时调用，之后的查询使用新建的连接"""
+    global _query_conn, _query_conn_lock
+    _query_conn = None
+    _query_conn_lock = threading.Lock()
+
+
+def _do_db_write_task(shard, queue, stats_queue, batch_size, linger, journal_dir=None):
     """数据库写入任务执行引擎
+    从队列中成批取出任务，按数据库、集合分组后使用bulk_write批量写入。
+    使用写前日志时，任务先追加到日志中，再由发送线程从日志中读取并写入数据库。
 
+    :param shard: 写入进程序号
     :param queue: 数据库写入任务队列
+    :param stats_queue: 统计信息汇报队列
+    :param batch_size: 单次批量写入的最大任务数
+    :param linger: 凑批时的最长等待时间（秒）
+    :param journal_dir: 写前日志目录，为None时不使用日志
     :return:
     """
     conn = _make_db_conn()
+    stats = WriteStats(shard, queue)
+
+    # 启动日志发送线程，首先发送上次运行时遗留的任务
+    journal, shipper, stopping = None, None, threading.Event()
+    if journal_dir:
+        journal = ctaJournal.Journal(os.path.join(journal_dir, 'shard{}'.format(shard)))
+        stats.journal = journal
+        rejected_path = os.path.join(journal_dir, JOURNAL_REJECTED_DIRNAME, 'shard{}'.format(shard))
+        shipper = threading.Thread(target=_ship_journal,
+                                   args=(conn, journal, stats, batch_size, linger, stopping, rejected_path))
+        shipper.daemon = True
+        shipper.start()
+
+    running = True
+    while running:
+        try:
+            # 空闲时也定期醒来汇报统计信息
+            tasks = _drain_tasks(queue, batch_size, linger, WRITE_STATS_INTERVAL)
+            if any(func == STOP_CTAMONGO_QUEUE[0] for func, _, _ in tasks):
+                running = False
+                tasks = [task for task in tasks if task[0] != STOP_CTAMONGO_QUEUE[0]]
+
+            if journal:
+                journal.append([cPickle.dumps(task, cPickle.HIGHEST_PROTOCOL) for task in tasks])
+            elif tasks:
+                _write_tasks(conn, tasks, stats)
+        except:
+            stats.errors += 1
+            traceback.print_exc()
+
+        if stats.is_due():
+            stats_queue.put(stats.report())
+
+    # 等待发送线程写完日志中的任务，数据库无法连接时剩余任务留待下次启动时发送
+    if journal:
+        stopping.set()
+        shipper.join()
+        journal.close()
+    stats_queue.put(stats.report())
+
+
+def _ship_journal(conn, journal, stats, batch_size, linger, stopping, rejected_path):
+    """日志发送线程
+    从日志中成批读取任务写入数据库，全部写入成功后才提交已发送位置；
+    数据库无法连接时等待后重试，停止时仍无法连接则剩余任务留待下次启动时发送；
+    其他写入失败同样等待后重试，同一批任务失败JOURNAL_MAX_ATTEMPTS次后移入拒绝日志再提交，不会被丢弃；
+    读取、提交日志或写入拒绝日志出错时同样计入错误数并等待后重试，发送线程不会因此退出。
+
+    :param conn: 数据库连接
+    :param journal: 写前日志
+    :param stats: 统计信息
+    :param batch_size: 单次批量写入的最大任务数
+    :param linger: 日志为空时的等待时间（秒）
+    :param stopping: 写入进程停止标志，设置后发送完剩余任务即退出
+    :param rejected_path: 拒绝日志目录，首次使用时创建
+    :return:
+    """
+    rejected = None
+    attempts = 0
     while True:
+        position, payloads = None, []
         try:
-            func, args = queue.get()
-            if func == STOP_CTAMONGO_QUEUE[0]:
+            position, payloads = journal.read(batch_size)
+            if not payloads:
+                if stopping.is_set():
+                    break
+                time.sleep(linger)
+                continue
+
+            try:
+                tasks = [cPickle.loads(payload) for payload in payloads]
+            except:  # 无法解析的记录重试也不会成功
+                traceback.print_exc()
+                stats.errors += 1
+                tasks, attempts = None, JOURNAL_MAX_ATTEMPTS
+
+            if tasks is None or _write_tasks(conn, tasks, stats):
+                attempts += 1
+                if attempts < JOURNAL_MAX_ATTEMPTS:
+                    if stopping.is_set():
+                        break
+                    time.sleep(JOURNAL_RETRY_INTERVAL)
+                    continue
+
+                if rejected is None:
+                    rejected = ctaJournal.Journal(rejected_path)
+                rejected.append(payloads)
+            journal.commit(position)
+            attempts = 0
+        except Exception:  # 包括数据库连接异常及日志文件读写错误
+            stats.errors += 1
+            traceback.print_exc()
+            if stopping.is_set():
                 break
-            globals()[func](conn, *args)
+            time.sleep(JOURNAL_RETRY_INTERVAL)
+
+    if rejected is not None:
+        rejected.close()
+
+
+def _write_tasks(conn, tasks, stats):
+    """将一批任务写入数据库
+    数据库连接异常将被抛出，由调用者决定是否重试。
+
+    :param conn: 数据库连接
+    :param tasks: 任务列表
+    :param stats: 统计信息
+    :return: 失败数，包括无法生成写入操作的任务数和写入失败的集合数
+    """
+    failures = 0
+
+    # 按数据库、集合对写入操作分组，组内保持任务的先后顺序
+    requests = OrderedDict()
+    for func, args, _ in tasks:
+        try:
+            dbname, colname, request = globals()[func](*args)
+            requests.setdefault((dbname, colname), []).append(request)
         except:
+            failures += 1
             traceback.print_exc()
 
+    if requests:
+        begin_time = time.time()
+        failures += _bulk_write(conn, requests, stats)
+        stats.record_batch(tasks, begin_time, time.time())
+    stats.errors += failures
+    return failures
+
+
+def _drain_tasks(queue, batch_size, linger, timeout=None):
+    """从任务队列中取出一批任务
+    阻塞等待第一个任务，之后在linger时间内尽量凑满一批。
+
+    :param queue: 数据库写入任务队列
+    :param batch_size: 单次批量写入的最大任务数
+    :param linger: 凑批时的最长等待时间（秒）
+    :param timeout: 等待第一个任务的最长时间（秒），超时返回空列表
+    :return: 任务列表
+    """
+    try:
+        tasks = [queue.get(timeout=timeout)]
+    except Empty:
+        return []
+    deadline = time.time() + linger
+    while len(tasks) < batch_size:
+        try:
+            # 队列中已有的任务直接取出，队列为空时等待至截止时间
+            tasks.append(queue.get(timeout=max(deadline - time.time(), 0)))
+        except Empty:
+            break
+    return tasks
+
+
+def _bulk_write(conn, requests, stats=None):
+    """执行批量写入
+
+    :param conn: 数据库连接
+    :param requests: (数据库名, 集合名) => 写入操作列表
+    :param stats: 统计信息，用于记录写入失败；为None时只打印异常
+    :return: 写入失败的集合数，数据库连接异常将被抛出
+    """
+    errors = 0
+    for (dbname, colname), ops in requests.items():
+        try:
+            col = conn[dbname][colname]
+
+            # 首次写入集合时确保datetime索引存在，写入时的过滤条件和历史数据查询都依赖该索引
+            if (dbname, colname) not in _indexed_collections:
+                col.create_index([('datetime', pymongo.ASCENDING)], background=True)
+                _indexed_collections.add((dbname, colname))
+
+            # 同一条记录可能在一批中被多次替换，必须按顺序执行
+            col.bulk_write(ops, ordered=True)
+        except ConnectionFailure:
+            raise
+        except BulkWriteError as e:
+            errors += 1
+            traceback.print_exc()
+            write_errors = e.details.get('writeErrors') or e.details.get('writeConcernErrors') or [{}]
+            if stats:
+                stats.record_failure(dbname, colname, write_errors[0].get('errmsg', str(e)))
+        except Exception as e:
+            errors += 1
+            traceback.print_exc()
+            if stats:
+                stats.record_failure(dbname, colname, str(e))
+    return errors
+
+
+class WriteStats(object):
+    """写入进程统计信息
+    在写入进程中累计一个汇报周期内的数据，并定期生成汇报用的字典。
+    """
+
+    def __init__(self, shard, queue):
+        """初始化
+
+        :param shard: 写入进程序号
+        :param queue: 写入进程的任务队列，用于获取队列深度
+        """
+        self.shard = shard
+        self.queue = queue
+        self.errors = 0  # 累计错误次数
+        self.write_failures = 0  # 累计写入失败的集合次数
+        self.last_error = None  # 最近一次写入失败的说明
+        self.journal = None  # 写前日志，用于获取积压量
+        self.reset()
+
+    def reset(self):
+        """开始新的汇报周期"""
+        self.begin_time = time.time()
+        self.task_count = 0
+        self.task_latencies = []  # 任务从推送到写入完成的时间
+        self.batch_latencies = []  # 每批bulk_write的执行时间
+        self.oldest_task_age = 0.0  # 取出任务时，批内最早任务已等待的时间
+
+    def record_batch(self, tasks, begin_time, end_time):
+        """记录一批任务的写入结果
+
+        :param tasks: 任务列表
+        :param begin_time: 开始写入的时间
+        :param end_time: 写入完成的时间
+        :return:
+        """
+        self.task_count += len(tasks)
+        self.task_latencies.extend(end_time - post_time for _, _, post_time in tasks)
+        self.batch_latencies.append(end_time - begin_time)
+        self.oldest_task_age = max(self.oldest_task_age, begin_time - tasks[0][2])
+
+    def record_failure(self, dbname, colname, message):
+        """记录一次集合写入失败
+
+        :param dbname: 数据库名
+        :param colname: 集合名
+        :param message: 失败原因
+        :return:
+        """
+        self.write_failures += 1
+        self.last_error = '{}.{}: {}'.format(dbname, colname, message)
+
+    def is_due(self):
+        """是否到达汇报时间"""
+        return time.time() - self.begin_time >= WRITE_STATS_INTERVAL
+
+    def report(self):
+        """生成汇报用的统计信息，并开始新的汇报周期
+
+        :return: 统计信息字典：
+                 - shard             写入进程序号
+                 - time              汇报时间
+                 - queue_depth       任务队列中等待的任务数
+                 - tasks_per_second  汇报周期内每秒写入的任务数
+                 - task_latency      任务从推送到写入完成的时间百分位（秒）
+                 - batch_latency     每批bulk_write执行时间的百分位（秒）
+                 - oldest_task_age   汇报周期内等待最久任务的等待时间（秒）
+                 - journal_backlog   写前日志中尚未写入数据库的字节数
+                 - errors            累计错误次数
+                 - write_failures    累计写入失败的集合次数，包含在errors中
+                 - last_error        最近一次写入失败的说明，没有失败时为None
+        """
+        now = time.time()
+        try:
+            queue_depth = self.queue.qsize()
+        except NotImplementedError:  # 部分平台不支持
+            queue_depth = -1
+
+        report = dict(shard=self.shard,
+                      time=now,
+                      queue_depth=queue_depth,
+                      tasks_per_second=self.task_count / max(now - self.begin_time, 1e-6),
+                      task_latency=percentiles(self.task_latencies),
+                      batch_latency=percentiles(self.batch_latencies),
+                      oldest_task_age=self.oldest_task_age,
+                      journal_backlog=self.journal.backlog() if self.journal else 0,
+                      errors=self.errors,
+                      write_failures=self.write_failures,
+                      last_error=self.last_error)
+        self.reset()
+        return report
+
+
+def percentiles(values, points=LATENCY_PERCENTILES):
+    """计算百分位
+
+    :param values: 数值列表
+    :param points: 需要计算的百分位
+    :return: 字典，'p50'等百分位 => 数值，另含'max'和'count'
+    """
+    values = sorted(values)
+    result = {'p{}'.format(p): values[min(len(values) * p // 100, len(values) - 1)] if values else 0.0
+              for p in points}
+    result['max'] = values[-1] if values else 0.0
+    result['count'] = len(values)
+    return result
+
 
 def upsert_tick(dbname, colname, tick):
     """更新tick数据库
@@ -74,74 +708,89 @@ def upsert_tick(dbname, colname, tick):
     :param tick: tick数据
     :return:
     """
-    _post(_upsert_tick_task.__name__, (dbname, colname, tick))
+    _post(_upsert_tick_task.__name__, (dbname, colname, encode_tick(tick)))
 
 
-def upsert_kline(dbname, colname, kline):
+def upsert_kline(dbname, colname, kline, completed=False):
     """更新K线数据库
-    任务将被推送至数据库写入进程异步执行。
+    已完成的K线立即推送至数据库写入进程异步执行；
+    更新中的K线暂存，每隔刷新间隔只推送各K线的最新状态。
 
     :param dbname: 数据库名
     :param colname: 集合名
     :param kline: K线数据
+    :param completed: K线是否已完成
     :return:
     """
-    _post(_upsert_klines_task.__name__, (dbname, colname, kline))
+    key = (dbname, colname, kline.datetime)
+    if completed:
+        # 已完成的K线不再更新，取代暂存中的旧状态直接写入
+        _pending_klines.pop(key, None)
+        _post(_upsert_klines_task.__name__, (dbname, colname, encode_kline(kline)))
+    else:
+        _pending_klines[key] = kline
 
+    if time.time() - _last_kline_flush_time >= _kline_flush_interval:
+        flush_klines()
+
+
+def flush_klines():
+    """将暂存的更新中K线推送至数据库写入进程
+
+    :return:
+    """
+    global _last_kline_flush_time
+    _last_kline_flush_time = time.time()
+    while _pending_klines:
+        (dbname, colname, _), kline = _pending_klines.popitem(last=False)
+        _post(_upsert_klines_task.__name__, (dbname, colname, encode_kline(kline)))
 
-def _upsert_tick_task(conn, dbname, colname, tick):
+
+def _upsert_tick_task(dbname, colname, record):
     """tick数据库更新任务
-    该任务在数据库写入进程中同步执行。
+    该任务在数据库写入进程中执行，生成批量写入所需的操作。
 
-    :param conn: 数据库连接
     :param dbname: 数据库名
     :param colname: 集合名
-    :param tick: tick数据
-    :return:
+    :param record: 按TICK_FIELDS编码的tick数据
+    :return: (数据库名, 集合名, 写入操作)
     """
-    try:
-        dr_tick = DrTickData()
-        dr_tick.__dict__.update(tick.__dict__)
-        flt = dict(datetime=dr_tick.datetime)
-        col = conn[dbname][colname]
-        col.replace_one(flt, dr_tick.__dict__, upsert=True)
-    except:
-        traceback.print_exc()
+    dr_tick = DrTickData()
+    dr_tick.__dict__.update(zip(TICK_FIELDS, record))
+    flt = dict(datetime=dr_tick.datetime)
+    return dbname, colname, ReplaceOne(flt, dr_tick.__dict__, upsert=True)
 
 
-def _upsert_klines_task(conn, dbname, colname, kline):
+def _upsert_klines_task(dbname, colname, record):
     """K线数据库更新任务
-    该任务在数据库写入进程中同步执行。
+    该任务在数据库写入进程中执行，生成批量写入所需的操作。
 
-    :param conn: 数据库连接
     :param dbname: 数据库名
     :param colname: 集合名
-    :param kline: K线数据
-    :return:
+    :param record: 按KLINE_FIELDS编码的K线数据
+    :return: (数据库名, 集合名, 写入操作)
     """
-    try:
-        bar = CtaBarData()
-        bar.vtSymbol = kline.symbol
-        bar.symbol = kline.symbol
-        bar.open = float(kline.open)
-        bar.high = float(kline.high)
-        bar.low = float(kline.low)
-        bar.close = float(kline.close)
-        bar.date = kline.datetime.date().strftime('%Y%m%d')
-        bar.time = kline.datetime.time().isoformat()
-        bar.datetime = kline.datetime
-        bar.volume = kline.volume
-
-        # 在线生成的K线额外记录open和close的时间，用于重启程序后能够继续更新K线。
-        # 主要针对跨交易时间段的周期。
-        bar.open_datetime = kline.open_datetime
-        bar.close_datetime = kline.close_datetime
-
-        flt = dict(datetime=bar.datetime)
-        col = conn[dbname][colname]
-        col.replace_one(flt, bar.__dict__, upsert=True)
-    except:
-        traceback.print_exc()
+    symbol, datetime, open_, high, low, close, volume, open_datetime, close_datetime = record
+
+    bar = CtaBarData()
+    bar.vtSymbol = symbol
+    bar.symbol = symbol
+    bar.open = float(open_)
+    bar.high = float(high)
+    bar.low = float(low)
+    bar.close = float(close)
+    bar.date = datetime.date().strftime('%Y%m%d')
+    bar.time = datetime.time().isoformat()
+    bar.datetime = datetime
+    bar.volume = volume
+
+    # 在线生成的K线额外记录open和close的时间，用于重启程序后能够继续更新K线。
+    # 主要针对跨交易时间段的周期。
+    bar.open_datetime = open_datetime
+    bar.close_datetime = close_datetime
+
+    flt = dict(datetime=bar.datetime)
+    return dbname, colname, ReplaceOne(flt, bar.__dict__, upsert=True)
 
 
 def find_last_klines(dbname, colname, count, from_datetime):
@@ -153,14 +802,85 @@ def find_last_klines(dbname, colname, count, from_datetime):
     :param from_datetime: 条件时间点，检索结果不包含以该时间结束的K线
     :return: 结果按时间逆序排列
     """
-    if 'conn' not in find_last_klines.__dict__:
-        find_last_klines.__dict__['conn'] = _make_db_conn()
-    conn = find_last_klines.__dict__['conn']
-
-    col = conn[dbname][colname]
+    col = _get_query_conn()[dbname][colname]
 
     return list(col.find(filter={'datetime': {'$lt': from_datetime}},
                          projection={'_id': False},
                          limit=count,
-                         sort=(('date', pymongo.DESCENDING),
-                               ('time', pymongo.DESCENDING))))
+                         sort=(('datetime', pymongo.DESCENDING),)))
+
+
+def find_klines(dbname, colname, after_datetime, end_datetime, count):
+    """按时间顺序分段检索K线，用于由已有K线批量生成其他周期的K线
+
+    :param dbname: 数据库名
+    :param colname: 集合名
+    :param after_datetime: 条件时间点，检索结果不包含以该时间结束的K线
+    :param end_datetime: 区间结束时间（包含）
+    :param count: 获取K线的数目
+    :return: 结果按时间升序排列
+    """
+    col = _get_query_conn()[dbname][colname]
+
+    return list(col.find(filter={'datetime': {'$gt': after_datetime, '$lte': end_datetime}},
+                         projection={'_id': False},
+                         limit=count,
+                         sort=(('datetime', pymongo.ASCENDING),)))
+
+
+def find_collection_names(dbname):
+    """获取数据库中的全部集合名
+
+    :param dbname: 数据库名
+    :return: 集合名列表
+    """
+    return _get_query_conn()[dbname].collection_names(include_system_collections=False)
+
+
+def find_ticks(dbname, colname, start_datetime, end_datetime, fields=None):
+    """检索时间区间内的tick，用于由历史tick批量生成K线
+
+    :param dbname: 数据库名
+    :param colname: 集合名
+    :param start_datetime: 区间开始时间（包含）
+    :param end_datetime: 区间结束时间（不包含）
+    :param fields: 需要的字段，默认为全部字段
+    :return: 结果按时间升序排列
+    """
+    col = _get_query_conn()[dbname][colname]
+
+    projection = dict.fromkeys(fields, True) if fields else {}
+    projection['_id'] = False
+    return list(col.find(filter={'datetime': {'$gte': start_datetime, '$lt': end_datetime}},
+                         projection=projection,
+                         sort=(('datetime', pymongo.ASCENDING),)))
+
+
+def iter_ticks(dbname, colname, start_datetime, end_datetime):
+    """按时间顺序逐个读取时间区间内的tick，不一次性载入内存，用于回放
+
+    :param dbname: 数据库名
+    :param colname: 集合名
+    :param start_datetime: 区间开始时间（包含）
+    :param end_datetime: 区间结束时间（不包含）
+    :return: tick记录字典的迭代器
+    """
+    col = _get_query_conn()[dbname][colname]
+
+    return col.find(filter={'datetime': {'$gte': start_datetime, '$lt': end_datetime}},
+                    projection={'_id': False},
+                    sort=(('datetime', pymongo.ASCENDING),))
+
+
+def write_klines(dbname, colname, records):
+    """在当前进程中同步写入一批K线，不经过数据库写入进程，用于批量生成K线
+
+    :param dbname: 数据库名
+    :param colname: 集合名
+    :param records: 按KLINE_FIELDS编码的K线数据列表
+    :return: 写入失败的集合数，数据库连接异常将被抛出
+    """
+    ops = [_upsert_klines_task(dbname, colname, record)[2] for record in records]
+    if not ops:
+        return 0
+    return _bulk_write(_get_query_conn(), {(dbname, colname): ops})
@@ -0,0 +1,162 @@
+# encoding: UTF-8
+
+import time
+from collections import defaultdict
+
+from . import ctaTick
+
+"""
+【tick处理流程】
+接口推送的tick依次经过以下阶段：
+    normalize  生成规范化的CtaTickData，参照ctaTick.normalize_tick；
+    kline      检验是否在交易时间内、计算成交量、更新各周期K线并推送数据库写入任务，参照KLineGenerator.update；
+    callback   K线完成时执行注册的回调。
+CtaDrEngine处理行情事件和ctaReplay回放历史tick使用同一流程，保证回放结果与实盘一致。
+stage_times统计各阶段的累计耗时；需要按合约、周期分析耗时分布时使用set_profiler，参照ctaProfile。
+设置了ctaDispatch.KlineDispatcher时，回调由其异步执行，stage_times的callback阶段只包括入队的时间；
+TickProfiler的callback、end_to_end阶段由分发器在回调执行完毕时记录。
+"""
+
+# 处理阶段
+STAGES = ('normalize', 'kline', 'callback')
+
+
+class TickPipeline(object):
+    """tick处理流程"""
+
+    def __init__(self, kline_gen, active_dict=None):
+        """初始化
+
+        :param kline_gen: KLineGenerator
+        :param active_dict: 主力合约对应表，默认为空
+        """
+        self.kline_gen = kline_gen
+        self.active_dict = active_dict if active_dict is not None else {}
+
+        # K线完成事件回调集合，合约代码 => 采集周期 => 回调列表
+        self.kline_completed_listeners = defaultdict(lambda: defaultdict(list))
+
+        # 各阶段累计耗时（秒），为None时不计时
+        self.stage_times = None
+
+        # 记录各阶段耗时分布的ctaProfile.TickProfiler，为None时不记录
+        self.profiler = None
+
+        # 异步执行回调的ctaDispatch.KlineDispatcher，为None时在当前线程中执行
+        self.dispatcher = None
+
+    def enable_stage_timing(self):
+        """开始统计各阶段耗时，已有的统计清零"""
+        self.stage_times = dict.fromkeys(STAGES, 0.0)
+
+    def set_profiler(self, profiler):
+        """设置记录各阶段耗时分布的记录器，同时用于K线生成器
+
+        :param profiler: ctaProfile.TickProfiler，为None时停止记录
+        :return:
+        """
+        self.profiler = profiler
+        self.kline_gen.profiler = profiler
+
+    def add_demand(self, symbol, periods):
+        """注册回调时增加合约需要生成的周期，参照KLineGenerator.add_demand"""
+        self.kline_gen.add_demand(symbol, periods)
+
+    def remove_demand(self, symbol, periods):
+        """注销回调时减少合约需要生成的周期，参照KLineGenerator.remove_demand"""
+        self.kline_gen.remove_demand(symbol, periods)
+
+    def poll(self):
+        """处理在其他线程或进程中完成的K线，单进程处理时K线在process中完成，无需处理"""
+        pass
+
+    def stop(self):
+        """停止处理流程，单进程处理时无需处理"""
+        pass
+
+    def process(self, vt_tick):
+        """处理一个tick
+
+        :param vt_tick: 接口推送的VtTickData，不会被修改
+        :return: 参照KLineGenerator.update
+        """
+        if self.stage_times is not None or self.profiler is not None:
+            return self._process_timed(vt_tick)
+
+        # 生成字母信息统一为大写、计算了tick时间的规范化tick，事件中的原始数据保持不变
+        tick = ctaTick.normalize_tick(vt_tick)
+
+        # 更新K线
+        updated_klines = self.kline_gen.update(tick, self.active_dict)
+        if updated_klines:
+            self._notify(updated_klines)
+        return updated_klines
+
+    def _process_timed(self, vt_tick):
+        """处理一个tick，统计各阶段累计耗时或记录各阶段耗时分布，参照process"""
+        profiler = self.profiler
+        start = time.time()
+        tick = ctaTick.normalize_tick(vt_tick)
+        normalized = time.time()
+        updated_klines = self.kline_gen.update(tick, self.active_dict)
+        updated = time.time()
+        if updated_klines:
+            if profiler is None:
+                self._notify(updated_klines)
+            else:
+                self._notify_profiled(tick, updated_klines)
+        notified = time.time()
+
+        stage_times = self.stage_times
+        if stage_times is not None:
+            stage_times['normalize'] += normalized - start
+            stage_times['kline'] += updated - normalized
+            stage_times['callback'] += notified - updated
+        if profiler is not None:
+            profiler.record('normalize', tick.symbol, None, normalized - start)
+            if updated_klines is not None:
+                profiler.record_since('end_to_end', tick.symbol, None, tick.datetime)
+        return updated_klines
+
+    def _notify_profiled(self, tick, updated_klines):
+        """K线完成时执行回调，并按周期记录回调耗时及从tick时间到回调完成的耗时，参照_notify
+        设置了分发器时回调尚未执行，交由分发器在回调执行完毕时记录。
+        """
+        profiler = self.profiler
+        for p, kline in updated_klines.items():
+            if kline.is_completed:
+                listeners = self.kline_completed_listeners[kline.updated_kline.symbol][p]
+                if not listeners:
+                    continue
+                if self.dispatcher is not None:
+                    self._run_listeners(listeners, kline.updated_kline, (profiler, tick.symbol, p, tick.datetime))
+                    continue
+                start = time.time()
+                self._run_listeners(listeners, kline.updated_kline)
+                profiler.record('callback', tick.symbol, p, time.time() - start)
+                profiler.record_since('end_to_end', tick.symbol, p, tick.datetime)
+
+    def _notify(self, updated_klines):
+        """K线完成时执行回调
+
+        :param updated_klines: 参照KLineGenerator.update
+        :return:
+        """
+        for p, kline in updated_klines.items():
+            if kline.is_completed:
+                self._run_listeners(self.kline_completed_listeners[kline.updated_kline.symbol][p],
+                                    kline.updated_kline)
+
+    def _run_listeners(self, listeners, kline, profile=None):
+        """执行回调，设置了分发器时放入队列异步执行
+
+        :param listeners: 回调列表
+        :param kline: 完成的K线
+        :param profile: 异步执行时记录耗时分布的信息，参照KlineDispatcher.submit
+        :return:
+        """
+        if self.dispatcher is None:
+            map(lambda callback: callback(kline), listeners)
+        else:
+            for callback in listeners:
+                self.dispatcher.submit(callback, kline, profile)
@@ -0,0 +1,195 @@
+# encoding: UTF-8
+
+import datetime as dt
+import json
+import time
+from collections import defaultdict
+
+"""
+【tick处理各阶段耗时分布】
+按阶段、合约、K线周期分别记录耗时直方图，用于定位tick到达策略onBar的延迟来源：
+    normalize   生成规范化tick，包括解析tick时间，参照ctaTick.normalize_tick；
+    validate    检验tick是否在交易时间内，参照ctaTimeline.is_valid_tick；
+    kline       各周期K线生成器的更新，参照KLineGenImpl.update；
+    post        tick及K线数据库写入任务的编码和推送，参照ctaMongo.upsert_kline；
+    callback    K线完成时执行注册的回调；异步分发时由分发器在每个回调执行完毕时分别记录，不包括排队时间；
+    end_to_end  从tick时间（接口时间戳）到处理完成的时间，K线周期为None时为tick处理完成，
+                否则为该周期K线完成回调执行完毕（异步分发时包括排队时间），受本地与交易所时钟偏差的影响。
+tick级别的阶段K线周期为None。
+
+由TickPipeline.set_profiler启用；未启用时K线生成器与启用时共用同一处理流程，只在各阶段判断是否启用，不计时也不记录。
+直方图按对数分桶，每个2倍区间分为8个桶，百分位的相对误差不超过1/8，记录开销与样本数无关。
+"""
+
+# 记录的阶段
+PROFILE_STAGES = ('normalize', 'validate', 'kline', 'post', 'callback', 'end_to_end')
+
+# 报告的百分位
+PROFILE_PERCENTILES = (50, 90, 99, 99.9)
+
+# 每个2倍区间的桶数为2 ** HISTOGRAM_SUB_BITS
+HISTOGRAM_SUB_BITS = 3
+
+
+class LatencyHistogram(object):
+    """耗时直方图，以微秒为单位按对数分桶"""
+
+    def __init__(self):
+        self.counts = defaultdict(int)  # 桶序号 => 样本数
+        self.count = 0
+        self.total = 0.0  # 样本总和（秒）
+        self.max = 0.0  # 最大样本（秒）
+
+    def record(self, seconds):
+        """记录一个样本
+
+        :param seconds: 耗时（秒），负数按0记录
+        :return:
+        """
+        if seconds < 0:
+            seconds = 0.0
+        self.counts[_bucket_of(int(seconds * 1e6))] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """计算百分位
+
+        :param p: 百分位，0 ~ 100
+        :return: 样本所在桶的上限（微秒），不超过最大样本；无样本时为0
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        accumulated = 0
+        for idx in sorted(self.counts):
+            accumulated += self.counts[idx]
+            if accumulated >= rank:
+                return min(float(_bucket_upper(idx)), self.max * 1e6)
+        return self.max * 1e6
+
+    def summary(self, points=PROFILE_PERCENTILES):
+        """生成汇总信息
+
+        :param points: 需要计算的百分位
+        :return: 字典：count、mean、max以及'p50'等百分位，耗时单位为微秒
+        """
+        result = {'p{:g}'.format(p): self.percentile(p) for p in points}
+        result['count'] = self.count
+        result['mean'] = self.total / self.count * 1e6 if self.count else 0.0
+        result['max'] = self.max * 1e6
+        return result
+
+
+def _bucket_of(us):
+    """计算微秒数所在桶的序号，小于2 ** (HISTOGRAM_SUB_BITS + 1)的值各占一个桶"""
+    shift = us.bit_length() - HISTOGRAM_SUB_BITS - 1
+    if shift <= 0:
+        return us
+    return (shift << HISTOGRAM_SUB_BITS) + (us >> shift)
+
+
+def _bucket_upper(idx):
+    """计算桶的上限（微秒，不包含）"""
+    shift = (idx >> HISTOGRAM_SUB_BITS) - 1
+    if shift <= 0:
+        return idx + 1
+    return ((idx - (shift << HISTOGRAM_SUB_BITS)) + 1) << shift
+
+
+class TickProfiler(object):
+    """tick处理各阶段耗时记录器"""
+
+    # 计时函数，返回当前时间（秒）
+    clock = staticmethod(time.time)
+
+    def __init__(self):
+        # (阶段, 合约代码, K线周期) => LatencyHistogram
+        self.histograms = {}
+        self.start_time = time.time()
+
+    def record(self, stage, symbol, period, seconds):
+        """记录一个阶段的耗时
+
+        :param stage: 阶段，参照PROFILE_STAGES
+        :param symbol: 合约代码
+        :param period: K线周期常量，tick级别的阶段为None
+        :param seconds: 耗时（秒）
+        :return:
+        """
+        key = (stage, symbol, period)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def record_since(self, stage, symbol, period, tick_datetime):
+        """记录从tick时间到当前的耗时
+
+        :param stage: 阶段
+        :param symbol: 合约代码
+        :param period: K线周期常量或None
+        :param tick_datetime: tick时间
+        :return:
+        """
+        self.record(stage, symbol, period, (dt.datetime.now() - tick_datetime).total_seconds())
+
+    def get_histogram(self, stage, symbol, period=None):
+        """获取一个阶段的耗时直方图
+
+        :param stage: 阶段
+        :param symbol: 合约代码
+        :param period: K线周期常量，tick级别的阶段为None
+        :return: LatencyHistogram，尚无记录时为None
+        """
+        return self.histograms.get((stage, symbol.upper(), period))
+
+    def snapshot(self):
+        """生成各阶段耗时分布的汇总信息
+
+        :return: 按阶段、合约、K线周期排列的字典列表，每项包括stage、symbol、period以及LatencyHistogram.summary的字段
+        """
+        # 复制后遍历，tick线程可同时新增记录
+        items = list(self.histograms.items())
+        stage_order = {stage: idx for idx, stage in enumerate(PROFILE_STAGES)}
+        items.sort(key=lambda item: (stage_order.get(item[0][0], len(PROFILE_STAGES)), item[0][1],
+                                     -1 if item[0][2] is None else item[0][2]))
+        rows = []
+        for (stage, symbol, period), histogram in items:
+            row = histogram.summary()
+            row.update(stage=stage, symbol=symbol, period=period)
+            rows.append(row)
+        return rows
+
+    def reset(self):
+        """清空记录"""
+        self.histograms = {}
+        self.start_time = time.time()
+
+    def dump(self, filename):
+        """将汇总信息写入JSON文件
+
+        :param filename: 文件名
+        :return: 汇总信息，参照snapshot
+        """
+        rows = self.snapshot()
+        with open(filename, 'w') as fp:
+            json.dump(dict(start_time=self.start_time, time=time.time(), stages=rows), fp, indent=2)
+        return rows
+
+
+def format_profile(rows):
+    """将汇总信息格式化为文本
+
+    :param rows: TickProfiler.snapshot的返回值
+    :return: 多行文本，耗时单位为微秒
+    """
+    lines = ['{:<10} {:<12} {:>4} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10}'.format(
+            'stage', 'symbol', 'prd', 'count', 'mean', 'p50', 'p90', 'p99', 'p99.9', 'max')]
+    for row in rows:
+        lines.append('{:<10} {:<12} {:>4} {:>9} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.1f}'.format(
+                row['stage'], row['symbol'], '-' if row['period'] is None else row['period'], row['count'],
+                row['mean'], row['p50'], row['p90'], row['p99'], row['p99.9'], row['max']))
+    return '\n'.join(lines)
@@ -0,0 +1,253 @@
+# encoding: UTF-8
+
+import argparse
+import csv
+import datetime as dt
+import heapq
+import time
+
+from vtGateway import VtTickData
+
+from . import ctaKLine
+from . import ctaMongo
+from . import ctaPipeline
+from . import ctaProfile
+from . import ctaTick
+from .ctaMongo import TICK_FIELDS
+
+"""
+【tick回放】
+从tick数据库或本地文件按时间顺序读取tick，经过与CtaDrEngine.procecssTickEvent相同的处理流程
+（ctaPipeline.TickPipeline：规范化、有效性检验、K线生成、K线完成回调），用于策略试运行和数据采集的回归测试。
+
+回放方式：
+    最大速度  tick读取后立即处理，用于测试吞吐量和回归测试；
+    按时间    按tick之间的时间间隔处理，可指定倍速，用于策略试运行。
+回放结束后报告每秒处理的tick数以及各阶段（读取、处理流程各阶段、按时间等待）的耗时。
+
+数据库写入可通过ctaMongo.set_write_sink替换为内存中的MemorySink，回放结果不写入数据库。
+set_write_sink是进程内的全局设置，在运行中的CtaDrEngine所在进程中回放时会同时替换实盘数据的写入目标，
+因此替换写入目标时只能使用make_replay_pipeline生成的独立处理流程，不能回放CtaDrEngine.tick_pipeline。
+回放结束时推送暂存的更新中K线，各周期最后一根K线同样写入。
+本地文件为首行是字段名的CSV文件，字段为ctaMongo.TICK_FIELDS的全部或一部分，可由export_tick_file从数据库导出。
+命令行运行方式：python -m dataRecorder.drEngineEx.ctaReplay (-s 集合名 ... --start 开始时间 --end 结束时间 | -f 文件名)
+"""
+
+# 本地文件中的整数字段，其余非字符串字段为浮点数
+TICK_FILE_INT_FIELDS = frozenset(('lastVolume', 'volume', 'openInterest',
+                                  'bidVolume1', 'bidVolume2', 'bidVolume3', 'bidVolume4', 'bidVolume5',
+                                  'askVolume1', 'askVolume2', 'askVolume3', 'askVolume4', 'askVolume5'))
+
+# 本地文件中的字符串字段
+TICK_FILE_STR_FIELDS = frozenset(('vtSymbol', 'symbol', 'exchange', 'gatewayName', 'date', 'time'))
+
+# 本地文件的字段，datetime由date和time计算，不写入文件
+TICK_FILE_FIELDS = tuple(f for f in TICK_FIELDS if f != 'datetime')
+
+# 回放统计的阶段，处理流程各阶段参照ctaPipeline.STAGES
+REPLAY_STAGES = ('source',) + ctaPipeline.STAGES + ('pacing',)
+
+
+class TickReplayer(object):
+    """tick回放引擎"""
+
+    def __init__(self, pipeline, realtime=False, speed=1.0):
+        """初始化
+
+        :param pipeline: ctaPipeline.TickPipeline，例如CtaDrEngine.tick_pipeline或make_replay_pipeline的结果。
+                         注意CtaDrEngine的K线生成器会过滤引擎启动前的tick，其结果写入实盘的写入目标
+        :param realtime: 是否按tick之间的时间间隔回放，默认为最大速度
+        :param speed: 按时间回放时的倍速
+        """
+        self.pipeline = pipeline
+        self.realtime = realtime
+        self.speed = speed
+
+    def replay(self, ticks):
+        """回放tick
+
+        :param ticks: 按时间顺序排列的VtTickData的可迭代对象
+        :return: 统计信息字典：
+                 - ticks             回放的tick数
+                 - valid_ticks       交易时间内的tick数
+                 - completed_klines  完成的K线数
+                 - elapsed           耗时（秒）
+                 - ticks_per_second  每秒处理的tick数
+                 - stage_times       各阶段累计耗时（秒），阶段参照REPLAY_STAGES
+        """
+        pipeline = self.pipeline
+        pipeline.enable_stage_timing()
+        source_time = pacing_time = 0.0
+        count = valid_count = completed_count = 0
+
+        first_tick_datetime = None
+        start = last = time.time()
+        for vt_tick in ticks:
+            now = time.time()
+            source_time += now - last
+
+            # 按时间回放时等待至tick对应的时刻
+            if self.realtime:
+                tick_datetime = ctaTick.parse_tick_datetime(vt_tick.date, vt_tick.time)
+                if first_tick_datetime is None:
+                    first_tick_datetime = tick_datetime
+                delay = start + (tick_datetime - first_tick_datetime).total_seconds() / self.speed - now
+                if delay > 0:
+                    time.sleep(delay)
+                    pacing_time += time.time() - now
+
+            updated_klines = pipeline.process(vt_tick)
+            count += 1
+            if updated_klines is not None:
+                valid_count += 1
+                completed_count += sum(1 for kline in updated_klines.values() if kline.is_completed)
+            last = time.time()
+
+        # 推送暂存的更新中K线，包括各周期最后一根尚未完成的K线
+        pipeline.kline_gen.flush(pipeline.active_dict)
+
+        elapsed = time.time() - start
+        stage_times = dict(pipeline.stage_times, source=source_time, pacing=pacing_time)
+        pipeline.stage_times = None
+        return dict(ticks=count,
+                    valid_ticks=valid_count,
+                    completed_klines=completed_count,
+                    elapsed=elapsed,
+                    ticks_per_second=count / elapsed if elapsed > 0 else 0.0,
+                    stage_times=stage_times)
+
+
+def make_replay_pipeline(periods=(ctaKLine.PERIOD_1MIN,), recording_tick=False, cascade=False):
+    """生成回放历史tick使用的处理流程，不过滤过去的tick，不从数据库读取历史K线
+
+    :param periods: K线周期常量列表
+    :param recording_tick: 是否写入tick
+    :param cascade: 是否使用级联模式
+    :return: ctaPipeline.TickPipeline
+    """
+    kline_gen = ctaKLine.KLineGenerator(periods, recording_tick, ignore_past=False, cascade=cascade,
+                                        load_history=False)
+    return ctaPipeline.TickPipeline(kline_gen)
+
+
+def iter_db_ticks(colnames, start_datetime, end_datetime):
+    """从tick数据库按时间顺序读取tick，多个集合按时间合并
+
+    :param colnames: 集合名列表
+    :param start_datetime: 开始时间（包含）
+    :param end_datetime: 结束时间（不包含）
+    :return: VtTickData的迭代器
+    """
+    def iter_collection(idx, colname):
+        for doc in ctaMongo.iter_ticks(ctaKLine.TICK_DB_NAME, colname, start_datetime, end_datetime):
+            tick = VtTickData()
+            tick.__dict__.update(doc)
+            # 时间相同时按集合顺序排列，不比较tick对象
+            yield doc['datetime'], idx, tick
+
+    streams = [iter_collection(idx, colname) for idx, colname in enumerate(colnames)]
+    for _, _, tick in heapq.merge(*streams):
+        yield tick
+
+
+def iter_file_ticks(filename):
+    """从本地文件按顺序读取tick
+
+    :param filename: CSV文件名
+    :return: VtTickData的迭代器
+    """
+    with open(filename, 'rb') as fp:
+        reader = csv.reader(fp)
+        # 忽略tick字段以外的列
+        columns = [(idx, f, str if f in TICK_FILE_STR_FIELDS else _to_int if f in TICK_FILE_INT_FIELDS else float)
+                   for idx, f in enumerate(next(reader)) if f in TICK_FILE_FIELDS]
+        for row in reader:
+            tick = VtTickData()
+            for idx, field, convert in columns:
+                setattr(tick, field, convert(row[idx]))
+            yield tick
+
+
+def _to_int(value):
+    """将文件中的整数字段转换为整数，允许带小数点的写法"""
+    return int(float(value))
+
+
+def export_tick_file(ticks, filename):
+    """将tick写入本地文件
+
+    :param ticks: VtTickData或tick记录字典的可迭代对象
+    :param filename: CSV文件名
+    :return: 写入的tick数
+    """
+    # 记录中缺少的字段使用VtTickData的默认值
+    defaults = VtTickData().__dict__
+    count = 0
+    with open(filename, 'wb') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(TICK_FILE_FIELDS)
+        for tick in ticks:
+            values = tick if isinstance(tick, dict) else tick.__dict__
+            writer.writerow([values.get(f, defaults[f]) for f in TICK_FILE_FIELDS])
+            count += 1
+    return count
+
+
+def format_replay_stats(stats):
+    """将回放统计信息格式化为文本
+
+    :param stats: TickReplayer.replay的返回值
+    :return: 多行文本
+    """
+    lines = ['tick {ticks} 个（交易时间内 {valid_ticks} 个），完成K线 {completed_klines} 根，'
+             '耗时 {elapsed:.2f} 秒，每秒 {ticks_per_second:.0f} 个tick。'.format(**stats)]
+    for stage in REPLAY_STAGES:
+        seconds = stats['stage_times'][stage]
+        lines.append('  {:<10} {:8.2f}秒 {:8.2f}us/tick'.format(
+                stage, seconds, seconds / stats['ticks'] * 1e6 if stats['ticks'] else 0.0))
+    return '\n'.join(lines)
+
+
+def main():
+    parse_datetime = lambda s: dt.datetime.strptime(s, '%Y%m%d%H%M' if len(s) > 8 else '%Y%m%d')
+
+    parser = argparse.ArgumentParser(description='回放历史tick')
+    parser.add_argument('-s', '--colnames', nargs='+', help='tick数据库中的集合名')
+    parser.add_argument('--start', type=parse_datetime, help='开始时间，YYYYMMDD[HHMM]')
+    parser.add_argument('--end', type=parse_datetime, help='结束时间（不包含），YYYYMMDD[HHMM]')
+    parser.add_argument('-f', '--file', help='本地tick文件')
+    parser.add_argument('-p', '--periods', type=int, nargs='+', default=[ctaKLine.PERIOD_1MIN], help='K线周期常量')
+    parser.add_argument('--cascade', action='store_true', help='使用级联模式')
+    parser.add_argument('--realtime', action='store_true', help='按tick时间间隔回放，默认为最大速度')
+    parser.add_argument('--speed', type=float, default=1.0, help='按时间回放时的倍速')
+    parser.add_argument('--write-db', action='store_true', help='将K线写入数据库，默认写入内存')
+    parser.add_argument('--profile', action='store_true', help='按合约、周期输出各阶段耗时分布')
+    args = parser.parse_args()
+
+    if args.file:
+        ticks = iter_file_ticks(args.file)
+    elif args.colnames and args.start and args.end:
+        ticks = iter_db_ticks(args.colnames, args.start, args.end)
+    else:
+        parser.error('需要指定本地文件，或集合名及开始、结束时间。')
+
+    if args.write_db:
+        ctaMongo.init_db_write_process()
+    else:
+        ctaMongo.set_write_sink(ctaMongo.MemorySink())
+    try:
+        pipeline = make_replay_pipeline(args.periods, cascade=args.cascade)
+        if args.profile:
+            profiler = ctaProfile.TickProfiler()
+            pipeline.set_profiler(profiler)
+        replayer = TickReplayer(pipeline, args.realtime, args.speed)
+        print(format_replay_stats(replayer.replay(ticks)))
+        if args.profile:
+            print(ctaProfile.format_profile(profiler.snapshot()))
+    finally:
+        if args.write_db:
+            ctaMongo.stop_db_write_process()
+
+
+if __name__ == '__main__':
+    main()
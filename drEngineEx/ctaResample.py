@@ -0,0 +1,236 @@
+# encoding: UTF-8
+
+import argparse
+import datetime as dt
+import multiprocessing
+import time
+import traceback
+
+import numpy as np
+
+from . import ctaCalendar
+from . import ctaMongo
+from . import ctaTimeline
+from .ctaAggregate import (
+    TRADING_DAY_START,
+    calc_kline_datetimes,
+    encode_kline_arrays,
+    reduce_klines,
+    valid_minute_mask,
+)
+from .ctaKLine import (
+    KLINE_COLUMNS,
+    KLINE_DB_NAMES,
+    KLineArrays,
+    MINUTES_OF_PERIOD,
+    PERIOD_1MIN,
+    TickTime,
+    empty_kline_arrays,
+)
+
+"""
+【由1分钟K线批量生成其他周期K线】
+采集时未配置的周期没有历史K线，由VnTrader_1Min_Db中的1分钟K线重新生成。
+每根1分钟K线按其开始时间（K线时间减去1分钟）计算所属K线，与级联模式下由1分钟K线合成其余周期的结果相同，
+各周期的划分方法参照ctaKLine.compile_kline_table。
+
+集合按时间顺序分段读取，每段生成的最后一根K线可能未完成，其对应的1分钟K线在下一段中重新读取。
+各集合在进程池中并行处理，结果按集合批量写入对应周期的数据库，替换同一时间的已有K线。
+命令行运行方式：python -m dataRecorder.drEngineEx.ctaResample -p 周期 ... [-s 集合名 ...] [--first 开始日期] [--last 结束日期]
+"""
+
+# 每次读取的1分钟K线数目
+DEFAULT_CHUNK_SIZE = 100000
+
+# 默认进程数
+DEFAULT_PROCESSES = multiprocessing.cpu_count()
+
+# 1分钟K线数据库
+MINUTE_DB_NAME = KLINE_DB_NAMES[PERIOD_1MIN]
+
+ONE_MINUTE = dt.timedelta(minutes=1)
+
+
+def make_minute_kline_arrays(docs):
+    """根据数据库中的1分钟K线记录生成K线数组
+    导入的K线没有开盘、收盘时间，分别使用K线的开始、结束时间。
+
+    :param docs: 按时间升序排列的K线记录
+    :return: KLineArrays
+    """
+    rows = [(doc['datetime'], doc['open'], doc['high'], doc['low'], doc['close'], doc['volume'],
+             doc.get('open_datetime') or doc['datetime'] - ONE_MINUTE, doc.get('close_datetime') or doc['datetime'])
+            for doc in docs]
+    if not rows:
+        return empty_kline_arrays()
+    return KLineArrays(*[np.array(values, dtype) for values, (_, dtype) in zip(zip(*rows), KLINE_COLUMNS)])
+
+
+def resample_klines(minute_klines, period, trade_timeline):
+    """由1分钟K线批量生成其他周期的K线
+
+    :param minute_klines: 按时间升序排列的1分钟KLineArrays
+    :param period: K线周期常量
+    :param trade_timeline: 交易时间线
+    :return: KLineArrays，按K线时间升序排列
+    """
+    # 按1分钟K线的开始时间定位，不在交易时间内的1分钟K线不属于任何K线
+    minutes = minute_klines.datetime.astype('M8[m]') - np.timedelta64(1, 'm')
+    valid = valid_minute_mask(minutes, trade_timeline)
+    if not valid.all():
+        minute_klines = KLineArrays(*[column[valid] for column in minute_klines])
+        minutes = minutes[valid]
+    if not len(minutes):
+        return empty_kline_arrays()
+
+    return reduce_klines(calc_kline_datetimes(minutes, period, trade_timeline), minute_klines)
+
+
+def resample_collection(colname, periods, first_day=None, last_day=None, exchange='',
+                        chunk_size=DEFAULT_CHUNK_SIZE):
+    """由一个集合的1分钟K线生成各周期K线，写入对应周期的数据库
+
+    :param colname: 集合名，即合约代码或主力合约等别名，用于确定交易时间线
+    :param periods: K线周期常量列表，不包括1分钟
+    :param first_day: 开始交易日（包含），dt.date，默认为最早的K线
+    :param last_day: 结束交易日（包含），dt.date，默认为最新的K线
+    :param exchange: 交易所代码，品种没有单独配置交易时间时使用
+    :param chunk_size: 每次读取的1分钟K线数目，不足一根K线时自动加大
+    :return: 周期 => 写入的K线数目
+    """
+    assert PERIOD_1MIN not in periods
+    trade_timeline = ctaTimeline.timeline_for_tick(TickTime(colname.upper(), exchange.upper(), None))
+
+    # 以交易日开始的时刻划分，保证区间两端的K线完整
+    after = (dt.datetime.combine(ctaCalendar.previous_trading_day(first_day), TRADING_DAY_START)
+             if first_day else dt.datetime.min)
+    end = dt.datetime.combine(last_day, TRADING_DAY_START) if last_day else dt.datetime.max
+
+    counts = dict.fromkeys(periods, 0)
+    written = {period: np.empty(0, 'M8[us]') for period in periods}
+    while True:
+        docs = ctaMongo.find_klines(MINUTE_DB_NAME, colname, after, end, chunk_size)
+        if not docs:
+            break
+        exhausted = len(docs) < chunk_size
+        minute_klines = make_minute_kline_arrays(docs)
+        symbol = docs[-1].get('symbol') or colname
+
+        next_after = minute_klines.datetime[-1]
+        for period in periods:
+            klines = resample_klines(minute_klines, period, trade_timeline)
+            if not len(klines.datetime):
+                continue
+
+            # 重新读取的1分钟K线所属的K线已经写入时不再重复写入
+            keep = ~np.in1d(klines.datetime, written[period])
+
+            # 最后一根1分钟K线所属的K线，以及时间更晚的K线（例如调整至下一交易日的周五夜盘K线）可能未完成，
+            # 留到下一段中重新生成
+            if not exhausted:
+                pending = klines.datetime >= _last_kline_datetime(minute_klines, period, trade_timeline)
+                keep &= ~pending
+                next_after = min(next_after, klines.open_datetime[pending].min().astype('M8[m]').astype('M8[us]'))
+
+            klines = KLineArrays(*[column[keep] for column in klines])
+            if len(klines.datetime):
+                ctaMongo.write_klines(KLINE_DB_NAMES[period], colname, encode_kline_arrays(symbol, klines))
+                written[period] = np.append(written[period], klines.datetime)
+                counts[period] += len(klines.datetime)
+
+        if exhausted:
+            break
+
+        # 一段中只有未完成的K线时，加大读取数目重新读取
+        next_after = next_after.tolist()
+        if next_after <= after:
+            chunk_size *= 2
+            continue
+        after = next_after
+    return counts
+
+
+def _last_kline_datetime(minute_klines, period, trade_timeline):
+    """计算最后一根交易时间内的1分钟K线所属K线的时间
+
+    :param minute_klines: 按时间升序排列的1分钟KLineArrays
+    :param period: K线周期常量
+    :param trade_timeline: 交易时间线
+    :return: datetime64[us]
+    """
+    minutes = minute_klines.datetime.astype('M8[m]') - np.timedelta64(1, 'm')
+    minutes = minutes[valid_minute_mask(minutes, trade_timeline)]
+    return calc_kline_datetimes(minutes[-1:], period, trade_timeline)[0]
+
+
+def resample_collections(colnames, periods, first_day=None, last_day=None, exchange='',
+                         processes=DEFAULT_PROCESSES, chunk_size=DEFAULT_CHUNK_SIZE):
+    """在进程池中并行处理多个集合，参照resample_collection
+
+    :param colnames: 集合名列表，默认为1分钟K线数据库中的全部集合
+    :param periods: K线周期常量列表，不包括1分钟
+    :param first_day: 开始交易日（包含）
+    :param last_day: 结束交易日（包含）
+    :param exchange: 交易所代码
+    :param processes: 进程数
+    :param chunk_size: 每次读取的1分钟K线数目
+    :return: 集合名 => 周期 => 写入的K线数目，处理失败的集合不包括在内
+    """
+    if not colnames:
+        colnames = ctaMongo.find_collection_names(MINUTE_DB_NAME)
+
+    tasks = [(colname, periods, first_day, last_day, exchange, chunk_size) for colname in colnames]
+    results = {}
+    pool = multiprocessing.Pool(processes, initializer=ctaMongo.reset_query_conn)
+    try:
+        for colname, counts, elapsed in pool.imap_unordered(_resample_collection_task, tasks):
+            if counts is None:
+                print('{} 处理失败。'.format(colname))
+                continue
+            results[colname] = counts
+            print('{} 完成，K线 {} 根，耗时 {:.1f} 秒。({}/{})'.format(
+                    colname, sum(counts.values()), elapsed, len(results), len(tasks)))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def _resample_collection_task(args):
+    """进程池中执行的任务，异常在子进程中输出
+
+    :param args: resample_collection的参数
+    :return: (集合名, 周期 => 写入的K线数目或None, 耗时秒数)
+    """
+    start = time.time()
+    try:
+        counts = resample_collection(*args)
+    except:
+        traceback.print_exc()
+        counts = None
+    return args[0], counts, time.time() - start
+
+
+def main():
+    parse_date = lambda s: dt.datetime.strptime(s, '%Y%m%d').date()
+
+    parser = argparse.ArgumentParser(description='由1分钟K线生成其他周期K线')
+    parser.add_argument('-p', '--periods', type=int, nargs='+', required=True, help='K线周期常量，不包括1分钟')
+    parser.add_argument('-s', '--colnames', nargs='+', help='集合名，默认为1分钟K线数据库中的全部集合')
+    parser.add_argument('--first', type=parse_date, help='开始交易日，YYYYMMDD')
+    parser.add_argument('--last', type=parse_date, help='结束交易日，YYYYMMDD')
+    parser.add_argument('--exchange', default='', help='交易所代码，品种没有单独配置交易时间时使用')
+    parser.add_argument('--processes', type=int, default=DEFAULT_PROCESSES, help='进程数')
+    args = parser.parse_args()
+
+    start = time.time()
+    results = resample_collections(args.colnames, args.periods, args.first, args.last, args.exchange,
+                                   args.processes)
+    for period in sorted(args.periods):
+        print('{}分钟K线 {} 根。'.format(MINUTES_OF_PERIOD[period],
+                                       sum(counts[period] for counts in results.values())))
+    print('共 {} 个集合，耗时 {:.1f} 秒。'.format(len(results), time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
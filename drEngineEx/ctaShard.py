@@ -0,0 +1,270 @@
+# encoding: UTF-8
+
+import multiprocessing
+import time
+import traceback
+import zlib
+from Queue import Empty
+
+from . import ctaKLine
+from . import ctaMongo
+from . import ctaPipeline
+from . import ctaShm
+from . import ctaTick
+from .ctaMongo import KLINE_FIELDS
+
+"""
+【按合约分片的多进程K线生成】
+单进程模式下所有合约的K线都在事件引擎线程中生成，记录的合约数受单个CPU核心限制。
+分片模式下合约按代码的稳定哈希值分配给若干K线生成进程，每个进程运行独立的KLineGenerator，
+负责所分配合约的有效性检验、K线生成和数据库写入任务推送（直接推送至主进程启动的数据库写入进程）。
+
+主进程只规范化tick，按ctaMongo.TICK_FIELDS编码为元组后放入对应进程的队列，不传输tick对象；
+K线生成进程将已注册回调的周期的已完成K线按KLINE_FIELDS编码后送回主进程，
+主进程在处理tick及定时器事件时取回K线、加入主进程的K线生成器供获取过去K线，并执行回调。
+同一合约的tick由同一进程按顺序处理，K线按完成顺序送回。
+
+与单进程模式的区别：
+    1. process不返回更新的K线，K线完成回调在之后的process或poll中执行；
+    2. 主进程只保存已注册回调的周期的已完成K线，更新中的K线只能从数据库中获取；
+    3. 主力合约对应表使用启动时的内容；
+    4. 不统计各阶段耗时，各进程的积压情况参照report。
+"""
+
+# 主进程发送给K线生成进程的消息类型
+(MSG_TICK,
+ MSG_DEMAND,
+ MSG_STOP) = range(3)
+
+# 默认K线生成进程数
+DEFAULT_KLINE_WORKERS = multiprocessing.cpu_count()
+
+# 停止时等待各K线生成进程完成剩余tick的最长时间（秒），超时后强制终止
+STOP_WORKER_TIMEOUT = 10
+
+# 统计信息汇报间隔（秒）
+SHARD_STATS_INTERVAL = 5.0
+
+
+class ShardedTickPipeline(ctaPipeline.TickPipeline):
+    """按合约分片的多进程tick处理流程"""
+
+    def __init__(self, kline_gen, active_dict=None, workers=DEFAULT_KLINE_WORKERS, settings=None):
+        """初始化并启动K线生成进程
+
+        :param kline_gen: 主进程的KLineGenerator，保存送回的已完成K线，不处理tick
+        :param active_dict: 主力合约对应表
+        :param workers: K线生成进程数
+        :param settings: K线生成进程中KLineGenerator的参数：periods、recording_tick、cascade、symbol_periods、
+                         ignore_past、load_history，以及kline_flush_interval，
+                         配置了shm_dir时各进程将所分配合约的K线发布到该目录的共享内存，每段保存shm_capacity根K线
+        """
+        super(ShardedTickPipeline, self).__init__(kline_gen, active_dict)
+        settings = dict(settings or {}, active_dict=dict(self.active_dict))
+
+        self.result_queue = multiprocessing.Queue()
+        self.tick_queues = []
+        self.procs = []
+        self.shard_cache = {}  # 合约代码 => 进程序号
+        self.sent_counts = []  # 各进程汇报周期内发送的tick数
+        self.begin_time = time.time()
+        db_write_queues = ctaMongo.get_db_write_queues()
+        for shard in range(max(workers, 1)):
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=_run_kline_worker,
+                                           args=(shard, queue, self.result_queue, db_write_queues, settings))
+            proc.daemon = True
+            proc.start()
+            self.tick_queues.append(queue)
+            self.procs.append(proc)
+            self.sent_counts.append(0)
+
+    def add_demand(self, symbol, periods):
+        """注册回调时增加合约需要生成的周期，同时通知该合约所在的K线生成进程"""
+        super(ShardedTickPipeline, self).add_demand(symbol, periods)
+        symbol = symbol.upper()
+        self.tick_queues[self._shard_of(symbol)].put((MSG_DEMAND, (symbol, tuple(periods), 1)))
+
+    def remove_demand(self, symbol, periods):
+        """注销回调时减少合约需要生成的周期，同时通知该合约所在的K线生成进程"""
+        super(ShardedTickPipeline, self).remove_demand(symbol, periods)
+        symbol = symbol.upper()
+        self.tick_queues[self._shard_of(symbol)].put((MSG_DEMAND, (symbol, tuple(periods), -1)))
+
+    def process(self, vt_tick):
+        """将tick发送至所在的K线生成进程，并处理已送回的K线
+
+        :param vt_tick: 接口推送的VtTickData，不会被修改
+        :return: None，K线完成回调在送回后执行
+        """
+        tick = ctaTick.normalize_tick(vt_tick)
+        shard = self._shard_of(tick.symbol)
+        self.tick_queues[shard].put((MSG_TICK, ctaMongo.encode_tick(tick)))
+        self.sent_counts[shard] += 1
+        self.poll()
+
+    def poll(self):
+        """取回K线生成进程送回的已完成K线，加入主进程的K线生成器并执行回调
+
+        :return: 取回的K线数目
+        """
+        count = 0
+        while not self.result_queue.empty():
+            try:
+                completed = self.result_queue.get_nowait()
+            except Empty:
+                break
+            for period, vt_symbol, values in completed:
+                kline = _decode_kline(vt_symbol, values)
+                self.kline_gen.put_completed_kline(period, kline)
+                self._run_listeners(self.kline_completed_listeners[kline.symbol][period], kline)
+                count += 1
+        return count
+
+    def is_due(self):
+        """是否到达汇报时间"""
+        return time.time() - self.begin_time >= SHARD_STATS_INTERVAL
+
+    def report(self):
+        """生成各K线生成进程的统计信息，并开始新的汇报周期
+
+        :return: 统计信息字典列表，每项包括：
+                 - shard             进程序号
+                 - alive             进程是否在运行
+                 - queue_depth       队列中等待处理的消息数，部分平台不支持时为-1
+                 - ticks_per_second  汇报周期内每秒发送至该进程的tick数
+        """
+        now = time.time()
+        elapsed = max(now - self.begin_time, 1e-6)
+        stats = []
+        for shard, (queue, proc) in enumerate(zip(self.tick_queues, self.procs)):
+            try:
+                queue_depth = queue.qsize()
+            except NotImplementedError:  # 部分平台不支持
+                queue_depth = -1
+            stats.append(dict(shard=shard,
+                              alive=proc.is_alive(),
+                              queue_depth=queue_depth,
+                              ticks_per_second=self.sent_counts[shard] / elapsed))
+            self.sent_counts[shard] = 0
+        self.begin_time = now
+        return stats
+
+    def stop(self, timeout=STOP_WORKER_TIMEOUT):
+        """停止K线生成进程，各进程处理完队列中剩余的tick后退出，之后执行剩余的回调
+        超时仍未退出的进程被强制终止，其剩余的tick及未推送的数据库写入任务将丢失。
+        返回时所有K线生成进程均已退出，之后可以安全地停止数据库写入进程。
+
+        :param timeout: 等待每个进程退出的最长时间（秒）
+        :return:
+        """
+        for queue in self.tick_queues:
+            queue.put((MSG_STOP, None))
+        for shard, proc in enumerate(self.procs):
+            # 等待进程退出时取回K线，避免送回队列写满后进程无法退出
+            deadline = time.time() + timeout
+            while proc.is_alive() and time.time() < deadline:
+                self.poll()
+                proc.join(0.05)
+            if proc.is_alive():
+                try:
+                    queue_depth = self.tick_queues[shard].qsize()
+                except NotImplementedError:
+                    queue_depth = -1
+                print('K线生成进程{}未在{}秒内退出，强制终止，队列中剩余消息 {} 个。'.format(shard, timeout, queue_depth))
+                proc.terminate()
+                proc.join()
+                # 队列中的剩余消息已无法送达，退出时不再等待
+                self.tick_queues[shard].cancel_join_thread()
+        self.poll()
+        del self.procs[:]
+        del self.tick_queues[:]
+        del self.sent_counts[:]
+
+    def _shard_of(self, symbol):
+        """计算合约对应的K线生成进程序号，使用稳定的哈希值保证同一合约总是由同一进程处理
+
+        :param symbol: 大写的合约代码
+        :return: 进程序号
+        """
+        shard = self.shard_cache.get(symbol)
+        if shard is None:
+            shard = self.shard_cache[symbol] = (zlib.crc32(symbol) & 0xFFFFFFFF) % len(self.tick_queues)
+        return shard
+
+
+def _decode_kline(vt_symbol, values):
+    """由按KLINE_FIELDS编码的K线生成KLine
+
+    :param vt_symbol: vt系统代码
+    :param values: ctaMongo.encode_kline的结果
+    :return: KLine
+    """
+    fields = dict(zip(KLINE_FIELDS, values))
+    kline = ctaKLine.KLine(fields.pop('datetime'))
+    kline.__dict__.update(fields)
+    kline.vtSymbol = vt_symbol
+    return kline
+
+
+def _run_kline_worker(shard, tick_queue, result_queue, db_write_queues, settings):
+    """K线生成进程
+
+    :param shard: 进程序号
+    :param tick_queue: 主进程发送消息的队列
+    :param result_queue: 送回已完成K线的队列
+    :param db_write_queues: 数据库写入进程的任务队列
+    :param settings: 参照ShardedTickPipeline.__init__
+    :return:
+    """
+    flush_interval = settings.get('kline_flush_interval', ctaMongo.DEFAULT_KLINE_FLUSH_INTERVAL)
+    ctaMongo.reset_query_conn()
+    ctaMongo.attach_db_write_queues(db_write_queues, flush_interval)
+
+    kline_gen = ctaKLine.KLineGenerator(periods=settings.get('periods', (ctaKLine.PERIOD_1MIN,)),
+                                        recording_tick=settings.get('recording_tick', False),
+                                        ignore_past=settings.get('ignore_past', True),
+                                        cascade=settings.get('cascade', False),
+                                        load_history=settings.get('load_history', True),
+                                        symbol_periods=settings.get('symbol_periods'))
+    if settings.get('shm_dir'):
+        kline_gen.publisher = ctaShm.BarPublisher(settings['shm_dir'],
+                                                  settings.get('shm_capacity') or ctaShm.DEFAULT_SHM_CAPACITY)
+    active_dict = settings['active_dict']
+
+    while True:
+        try:
+            kind, payload = tick_queue.get(timeout=flush_interval)
+        except Empty:
+            # 行情清淡时刷新暂存的更新中K线
+            kline_gen.flush(active_dict)
+            continue
+
+        try:
+            if kind == MSG_TICK:
+                tick = ctaTick.decode_tick(payload)
+                updated_klines = kline_gen.update(tick, active_dict)
+                if not updated_klines:
+                    continue
+
+                # 只送回已注册回调的周期
+                demanded = kline_gen.demands.get(tick.symbol)
+                if demanded:
+                    completed = [(p, kline.updated_kline.vtSymbol, ctaMongo.encode_kline(kline.updated_kline))
+                                 for p, kline in updated_klines.items() if kline.is_completed and p in demanded]
+                    if completed:
+                        result_queue.put(completed)
+            elif kind == MSG_DEMAND:
+                symbol, periods, delta = payload
+                if delta > 0:
+                    kline_gen.add_demand(symbol, periods)
+                else:
+                    kline_gen.remove_demand(symbol, periods)
+            elif kind == MSG_STOP:
+                break
+        except:
+            traceback.print_exc()
+
+    kline_gen.flush(active_dict)
+    if kline_gen.publisher:
+        kline_gen.publisher.close()
@@ -0,0 +1,313 @@
+# encoding: UTF-8
+
+import argparse
+import mmap
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from .ctaKLine import KLINE_COLUMNS, KLineArrays, MINUTES_OF_PERIOD
+
+"""
+【共享内存K线】
+K线生成器可将各合约、各周期的K线发布到共享内存段中，同一台机器上的其他进程（研究用notebook、监控工具、
+其他进程中的策略）以只读方式映射后直接读取最新的K线，无需查询数据库。
+
+每个合约、周期对应一个文件（默认位于/dev/shm下），通过mmap共享，结构为：
+    头部  8个uint64：magic、seq、count、capacity、last_completed、period以及两个保留字段；
+    数据  2 * capacity条记录，字段与ctaKLine.KLINE_COLUMNS相同，第i根K线同时写入i % capacity及其后capacity处，
+          因此最新的不超过capacity根K线总是连续的，读取时不需要拷贝。
+count为已发布的K线总数，最后一根可能是更新中的K线，last_completed表示其是否已完成。
+写入时seq先加1变为奇数，写入完成后再加1变为偶数（seqlock），读取前后seq相同且为偶数时读取的位置有效。
+已完成的K线写入后不再修改，迟到tick对其的更新只写入数据库，因此已完成K线的视图在之后发布capacity根K线前保持不变；
+更新中的K线随时可能被修改，只以拷贝的方式读取。
+
+发布的K线只包括发布开始后生成的K线，更早的K线仍需从数据库中读取。
+K线生成器重新启动时以新文件替换原文件，新文件在替换前已写好头部，已打开的读取者在下次读取时自动重新映射。
+命令行运行方式：python -m dataRecorder.drEngineEx.ctaShm [合约代码 -p 周期 -n 数目] [-d 目录]
+"""
+
+# 默认共享内存目录
+DEFAULT_SHM_DIR = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'vnpy_kline')
+
+# 每个共享内存段保存的默认K线数目
+DEFAULT_SHM_CAPACITY = 4096
+
+# 文件格式标识及版本
+SHM_MAGIC = 0x4C4B4E56 << 32 | 1
+
+# 头部字段序号
+(HEADER_MAGIC,
+ HEADER_SEQ,
+ HEADER_COUNT,
+ HEADER_CAPACITY,
+ HEADER_LAST_COMPLETED,
+ HEADER_PERIOD) = range(6)
+
+# 头部字节数
+HEADER_SIZE = 64
+
+# K线记录的数据类型
+SHM_RECORD_DTYPE = np.dtype(list(KLINE_COLUMNS))
+
+# 读取时等待写入完成的最大重试次数
+READ_RETRIES = 1000
+
+# 文件扩展名
+SHM_SUFFIX = '.bars'
+
+
+def segment_path(directory, symbol, period):
+    """合约、周期对应的共享内存文件路径
+
+    :param directory: 共享内存目录
+    :param symbol: 合约代码
+    :param period: K线周期常量
+    :return: 文件路径
+    """
+    return os.path.join(directory, '{}.{}{}'.format(symbol.upper(), period, SHM_SUFFIX))
+
+
+def list_segments(directory=DEFAULT_SHM_DIR):
+    """列出目录中已发布的共享内存段
+
+    :param directory: 共享内存目录
+    :return: 按合约代码、周期排列的(合约代码, K线周期常量)列表
+    """
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for filename in os.listdir(directory):
+        if filename.endswith(SHM_SUFFIX):
+            symbol, _, period = filename[:-len(SHM_SUFFIX)].rpartition('.')
+            if symbol and period.isdigit():
+                segments.append((symbol, int(period)))
+    return sorted(segments)
+
+
+class BarSegment(object):
+    """一个合约、周期的共享内存段"""
+
+    def __init__(self, path, writable=False, capacity=DEFAULT_SHM_CAPACITY, period=0):
+        """映射共享内存文件
+
+        :param path: 文件路径
+        :param writable: 是否为发布者，发布者以新文件替换原文件
+        :param capacity: 发布者保存的K线数目
+        :param period: 发布者的K线周期常量
+        """
+        self.path = path
+        if writable:
+            _create_segment_file(path, capacity, period)
+
+        with open(path, 'r+b' if writable else 'rb') as fp:
+            self.inode = os.fstat(fp.fileno()).st_ino
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.header = np.frombuffer(self.mm, np.uint64, HEADER_SIZE // 8)
+
+        if int(self.header[HEADER_MAGIC]) != SHM_MAGIC:
+            self.close()
+            raise ValueError('{}不是K线共享内存文件。'.format(path))
+
+        self.capacity = int(self.header[HEADER_CAPACITY])
+        self.period = int(self.header[HEADER_PERIOD])
+        self.records = np.frombuffer(self.mm, SHM_RECORD_DTYPE, 2 * self.capacity, HEADER_SIZE)
+
+    def close(self):
+        """释放映射
+        只释放引用，不调用mmap.close，已返回的数组视图仍可使用，映射在其全部释放后解除。
+        """
+        self.header = self.records = self.mm = None
+
+
+def _create_segment_file(path, capacity, period):
+    """创建写好头部的共享内存文件，替换原文件，已映射原文件的读取者不受影响
+
+    :param path: 文件路径
+    :param capacity: 保存的K线数目
+    :param period: K线周期常量
+    :return:
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:  # 其他进程已创建
+            pass
+
+    header = np.zeros(HEADER_SIZE // 8, np.uint64)
+    header[HEADER_MAGIC] = SHM_MAGIC
+    header[HEADER_CAPACITY] = capacity
+    header[HEADER_PERIOD] = period
+    size = HEADER_SIZE + 2 * capacity * SHM_RECORD_DTYPE.itemsize
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(header.tobytes())
+        fp.truncate(size)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Windows下目标文件存在时不能改名，改为原地重建
+        os.remove(tmp_path)
+        with open(path, 'r+b') as fp:
+            fp.write(header.tobytes())
+            fp.truncate(size)
+
+
+class BarPublisher(object):
+    """共享内存K线发布者，由K线生成器在tick线程中调用，参照KLineGenerator._publish"""
+
+    def __init__(self, directory=DEFAULT_SHM_DIR, capacity=DEFAULT_SHM_CAPACITY):
+        """初始化
+
+        :param directory: 共享内存目录
+        :param capacity: 每个共享内存段保存的K线数目
+        """
+        self.directory = directory
+        self.capacity = capacity
+        self.segments = {}  # (合约代码, K线周期常量) => BarSegment
+
+    def publish(self, symbol, period, kline, completed):
+        """发布一根K线
+        时间与更新中的最新K线相同时更新最新K线，晚于最新K线时追加；
+        已完成的K线不再修改，迟到tick对较早K线的更新忽略。
+
+        :param symbol: 合约代码
+        :param period: K线周期常量
+        :param kline: KLine
+        :param completed: K线是否已完成
+        :return:
+        """
+        segment = self.segments.get((symbol, period))
+        if segment is None:
+            segment = self.segments[(symbol, period)] = BarSegment(
+                    segment_path(self.directory, symbol, period), True, self.capacity, period)
+
+        header, records, capacity = segment.header, segment.records, segment.capacity
+        count = int(header[HEADER_COUNT])
+        kline_datetime = np.datetime64(kline.datetime, 'us')
+
+        # 定位K线序号，只能追加或更新尚未完成的最新K线
+        if not count or kline_datetime > records[(count - 1) % capacity]['datetime']:
+            idx = count
+        elif (kline_datetime == records[(count - 1) % capacity]['datetime'] and
+              not header[HEADER_LAST_COMPLETED]):
+            idx = count - 1
+        else:
+            return
+
+        value = (kline_datetime, kline.open, kline.high, kline.low, kline.close, kline.volume,
+                 np.datetime64(kline.open_datetime, 'us'), np.datetime64(kline.close_datetime, 'us'))
+        slot = idx % capacity
+
+        # uint64与整数运算的结果为浮点数，按整数计算后写入
+        seq = int(header[HEADER_SEQ])
+        header[HEADER_SEQ] = seq + 1
+        records[slot] = value
+        records[slot + capacity] = value
+        if idx == count:
+            header[HEADER_COUNT] = count + 1
+        header[HEADER_LAST_COMPLETED] = completed
+        header[HEADER_SEQ] = seq + 2
+
+    def close(self):
+        """解除所有映射，文件保留供读取者继续读取"""
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+
+
+class BarReader(object):
+    """共享内存K线读取者"""
+
+    def __init__(self, symbol, period, directory=DEFAULT_SHM_DIR):
+        """以只读方式映射共享内存段
+
+        :param symbol: 合约代码
+        :param period: K线周期常量
+        :param directory: 共享内存目录
+        :raise IOError: 共享内存段尚未发布
+        """
+        self.path = segment_path(directory, symbol, period)
+        self.segment = BarSegment(self.path)
+
+    def get_last_kline_arrays(self, count, only_completed=True, copy=False):
+        """读取最新的K线
+
+        :param count: K线数目，超过共享内存段保存的数目时按保存的数目读取；
+                      跳过更新中的K线时最多读取capacity - 1根已完成K线
+        :param only_completed: 是否跳过更新中的K线只读取已完成的K线，默认为跳过
+        :param copy: 是否拷贝。默认返回共享内存的只读视图，其中的已完成K线在之后发布capacity根K线前保持不变；
+                     包括更新中的K线时总是拷贝，拷贝在seqlock的保护下进行
+        :return: KLineArrays，各字段为按时间升序排列的numpy数组
+        """
+        copy = copy or not only_completed
+        self._reopen_if_replaced()
+        segment = self.segment
+        header, capacity = segment.header, segment.capacity
+        for _ in xrange(READ_RETRIES):
+            seq = int(header[HEADER_SEQ])
+            if seq & 1:
+                time.sleep(0)
+                continue
+
+            total = stop = int(header[HEADER_COUNT])
+            if only_completed and stop and not header[HEADER_LAST_COMPLETED]:
+                stop -= 1
+            # 更新中的K线占用的位置上原有的K线已被覆盖，跳过更新中的K线时最多读取capacity - 1根
+            n = max(min(count, stop, capacity - (total - stop)), 0)
+            start = (stop - n) % capacity
+            records = segment.records[start:start + n]
+            if copy:
+                records = records.copy()
+            if int(header[HEADER_SEQ]) == seq:
+                return KLineArrays(*[records[name] for name, _ in KLINE_COLUMNS])
+        raise RuntimeError('读取{}超时。'.format(self.path))
+
+    def published_count(self):
+        """已发布的K线总数，包括更新中的K线"""
+        self._reopen_if_replaced()
+        return int(self.segment.header[HEADER_COUNT])
+
+    def close(self):
+        """释放映射"""
+        self.segment.close()
+
+    def _reopen_if_replaced(self):
+        """发布者重新启动替换了文件时重新映射，映射失败时继续读取原文件，下次读取时重试"""
+        try:
+            if os.stat(self.path).st_ino == self.segment.inode:
+                return
+            segment = BarSegment(self.path)
+        except (OSError, IOError, ValueError):
+            return
+        self.segment.close()
+        self.segment = segment
+
+
+def main():
+    parser = argparse.ArgumentParser(description='读取共享内存中的K线')
+    parser.add_argument('symbol', nargs='?', help='合约代码，默认列出已发布的合约和周期')
+    parser.add_argument('-p', '--period', type=int, default=0, help='K线周期常量')
+    parser.add_argument('-n', '--count', type=int, default=10, help='K线数目')
+    parser.add_argument('-d', '--directory', default=DEFAULT_SHM_DIR, help='共享内存目录')
+    parser.add_argument('--all', action='store_true', help='包括更新中的K线')
+    args = parser.parse_args()
+
+    if not args.symbol:
+        for symbol, period in list_segments(args.directory):
+            print('{} {}分钟'.format(symbol, MINUTES_OF_PERIOD[period]))
+        return
+
+    reader = BarReader(args.symbol, args.period, args.directory)
+    arrays = reader.get_last_kline_arrays(args.count, only_completed=not args.all, copy=True)
+    for row in zip(*arrays):
+        print(' '.join(str(v) for v in row))
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# encoding: UTF-8
+
+import datetime as dt
+import operator
+
+from .ctaMongo import TICK_FIELDS
+
+"""
+【规范化tick】
+接口推送的VtTickData字段繁多，且事件中的原始数据还需交给父类DrEngine和界面使用，不能直接修改。
+数据采集使用只包含K线生成和数据库写入所需字段的CtaTickData，直接由接口推送的tick生成，
+合约代码、交易所等字母信息统一为大写，并按原始字符串缓存。
+
+【tick时间解析】
+各接口的tick.date为YYYYMMDD格式的日期，tick.time为HH:MM:SS.f格式的时间，
+其中秒的小数部分位数因接口而异（例如CTP为1位，其他接口可能为3位或6位）。
+日期在一个交易日内基本不变，解析结果按日期字符串缓存；时间按固定位置截取解析。
+不符合固定格式的输入交由strptime处理，结果和异常与strptime一致。
+"""
+
+# tick时间的完整格式
+TICK_DATETIME_FORMAT = '%Y%m%d %H:%M:%S.%f'
+
+# 日期缓存的最大数目，超过时清空
+DATE_CACHE_SIZE = 64
+
+# 日期字符串 => (年, 月, 日)
+_date_cache = {}
+
+# 原样复制的字段
+COPIED_FIELDS = tuple(f for f in TICK_FIELDS if f not in ('vtSymbol', 'symbol', 'exchange', 'datetime'))
+_get_copied_fields = operator.attrgetter(*COPIED_FIELDS)
+
+# 原始字符串 => 大写并驻留的字符串
+_symbol_cache = {}
+
+
+class CtaTickData(object):
+    """数据采集使用的tick，字段为数据库写入的tick字段，其中lastVolume由K线生成器计算"""
+
+    __slots__ = TICK_FIELDS
+
+
+def normalize_tick(vt_tick):
+    """由接口推送的tick生成CtaTickData，不修改原tick
+
+    :param vt_tick: VtTickData
+    :return: CtaTickData，合约代码、交易所等含字母的信息为大写，并计算了tick时间
+    """
+    tick = CtaTickData()
+    for field, value in zip(COPIED_FIELDS, _get_copied_fields(vt_tick)):
+        setattr(tick, field, value)
+    tick.vtSymbol = normalize_symbol(vt_tick.vtSymbol)
+    tick.symbol = normalize_symbol(vt_tick.symbol)
+    tick.exchange = normalize_symbol(vt_tick.exchange)
+    tick.datetime = parse_tick_datetime(vt_tick.date, vt_tick.time)
+    return tick
+
+
+def decode_tick(values):
+    """由按TICK_FIELDS编码的tick生成CtaTickData，用于在其他进程中还原规范化tick
+
+    :param values: ctaMongo.encode_tick的结果
+    :return: CtaTickData，成交量由K线生成器计算
+    """
+    tick = CtaTickData()
+    for field, value in zip(TICK_FIELDS, values):
+        setattr(tick, field, value)
+    return tick
+
+
+def normalize_symbol(raw):
+    """将合约代码、交易所等字符串统一为大写，同一原始字符串返回同一对象
+
+    :param raw: 原始字符串
+    :return: 大写字符串
+    """
+    symbol = _symbol_cache.get(raw)
+    if symbol is None:
+        symbol = raw.upper()
+        if isinstance(symbol, str):
+            symbol = intern(symbol)
+        _symbol_cache[raw] = symbol
+    return symbol
+
+
+def parse_tick_datetime(date, time):
+    """解析tick时间，结果与datetime.strptime(' '.join([date, time]), TICK_DATETIME_FORMAT)相同
+
+    :param date: tick.date，YYYYMMDD
+    :param time: tick.time，HH:MM:SS.f，秒的小数部分为1至6位
+    :return: dt.datetime
+    """
+    ymd = _date_cache.get(date)
+    if ymd is None:
+        # 日期格式较为宽松（例如允许一位数的月份），交由strptime解析后缓存
+        d = dt.datetime.strptime(date, '%Y%m%d')
+        ymd = (d.year, d.month, d.day)
+        if len(_date_cache) >= DATE_CACHE_SIZE:
+            _date_cache.clear()
+        _date_cache[date] = ymd
+
+    # 固定格式的时间按位置截取
+    if 10 <= len(time) <= 15 and time[2] == ':' and time[5] == ':' and time[8] == '.':
+        hour, minute, second, fraction = time[0:2], time[3:5], time[6:8], time[9:]
+        if (hour + minute + second + fraction).isdigit():
+            return dt.datetime(ymd[0], ymd[1], ymd[2], int(hour), int(minute), int(second),
+                               int(fraction) * 10 ** (6 - len(fraction)))
+
+    return dt.datetime.strptime(' '.join([date, time]), TICK_DATETIME_FORMAT)
@@ -2,10 +2,10 @@
 
 import bisect
 import datetime as dt
+import json
+import os
 from collections import namedtuple
 
-from .ctaConstant import *
-
 """
 【交易时间线】
 交易时间线用于描述期货品种在一天时间内的交易时间段， 程序内部表示为由数个时间点组成的列表。
@@ -17,9 +17,13 @@ from .ctaConstant import *
      (10:30, 开始), (11:30, 停止),
      ...]
 
+各品种的交易时间线由配置文件CTADR_session.json定义，交易时间调整时只需修改配置文件。
+
 【tick过滤】
 tick过滤使用期货品种对应的交易时间线，从中检索tick时间之前最接近（可相等）的时间点。
 如时间点被标识为开始，则tick在有效交易时间内，反之无效。
+每个交易时间线预先按上述规则编译为一天内每分钟是否有效的查找表，tick过滤只需查表。
+品种和交易所均未配置的合约的tick视为无效。
 """
 
 # 交易开始/停止标识符，用于识别时间点的含义
@@ -46,137 +50,149 @@ def hour_bias_helper(t, b=HOUR_BIAS):
     return t.replace(hour=(t.hour + b) % 24)
 
 
-# 默认日盘时间
-DAYTIME_DEFAULT = map(lambda t: Tradetime(hour_bias_helper(t.time), t.oc), (
-    Tradetime(dt.time(hour=9, minute=0), OPEN),
-    Tradetime(dt.time(hour=10, minute=15), CLOSE),
-    Tradetime(dt.time(hour=10, minute=30), OPEN),
-    Tradetime(dt.time(hour=11, minute=30), CLOSE),
-    Tradetime(dt.time(hour=13, minute=30), OPEN),
-    Tradetime(dt.time(hour=15, minute=0), CLOSE),
-))
-
-# 日盘时间，CFFEX股指（Index Future）
-DAYTIME_CFFEX_IF = map(lambda t: Tradetime(hour_bias_helper(t.time), t.oc), (
-    Tradetime(dt.time(hour=9, minute=30), OPEN),
-    Tradetime(dt.time(hour=11, minute=30), CLOSE),
-    Tradetime(dt.time(hour=13, minute=0), OPEN),
-    Tradetime(dt.time(hour=15, minute=0), CLOSE),
-))
-
-# 日盘时间，CFFEX国债（Treasury Bond）
-DAYTIME_CFFEX_TB = map(lambda t: Tradetime(hour_bias_helper(t.time), t.oc), (
-    Tradetime(dt.time(hour=9, minute=15), OPEN),
-    Tradetime(dt.time(hour=11, minute=30), CLOSE),
-    Tradetime(dt.time(hour=13, minute=0), OPEN),
-    Tradetime(dt.time(hour=15, minute=15), CLOSE),
-))
-
-# 夜盘时间，SHFE，AU、AG
-NIGHTTIME_SHFE_1 = map(lambda t: Tradetime(hour_bias_helper(t.time), t.oc), (
-    Tradetime(dt.time(hour=21, minute=0), OPEN),
-    Tradetime(dt.time(hour=2, minute=30), CLOSE),
-))
-
-# 夜盘时间，SHFE，CU、AL、ZN、PB、SN、NI
-NIGHTTIME_SHFE_2 = map(lambda t: Tradetime(hour_bias_helper(t.time), t.oc), (
-    Tradetime(dt.time(hour=21, minute=0), OPEN),
-    Tradetime(dt.time(hour=1, minute=0), CLOSE),
-))
-
-# 夜盘时间，SHFE，RU、RB、HC、BU
-NIGHTTIME_SHFE_3 = map(lambda t: Tradetime(hour_bias_helper(t.time), t.oc), (
-    Tradetime(dt.time(hour=21, minute=0), OPEN),
-    Tradetime(dt.time(hour=23, minute=0), CLOSE),
-))
-
-# 夜盘时间，DCE
-NIGHTTIME_DCE = map(lambda t: Tradetime(hour_bias_helper(t.time), t.oc), (
-    Tradetime(dt.time(hour=21, minute=0), OPEN),
-    Tradetime(dt.time(hour=23, minute=30), CLOSE),
-))
-
-# 夜盘时间，CZCE
-NIGHTTIME_CZCE = map(lambda t: Tradetime(hour_bias_helper(t.time), t.oc), (
-    Tradetime(dt.time(hour=21, minute=0), OPEN),
-    Tradetime(dt.time(hour=23, minute=30), CLOSE),
-))
-
-# 各交易所日盘商品交易时间线，含小时偏移量
-TRADING_TIMELINES = {
-    EXCHANGE_UNKNOWN: DAYTIME_DEFAULT,
-    EXCHANGE_SHFE: DAYTIME_DEFAULT,  # 上期所
-    EXCHANGE_DCE: DAYTIME_DEFAULT,  # 大商所
-    EXCHANGE_CZCE: DAYTIME_DEFAULT,  # 郑商所
-    EXCHANGE_CFFEX: dict(  # 中金所
-            IF=DAYTIME_CFFEX_IF,  # 股指
-            TB=DAYTIME_CFFEX_TB,  # 国债
-    ),
-}
-
-# 有夜盘品种的交易时间线，由夜盘+日盘组合而成，含小时偏移量
-TRADING_TIMELINES_WITH_NIGHTTIME = [
-    NIGHTTIME_SHFE_1 + DAYTIME_DEFAULT,
-    NIGHTTIME_SHFE_2 + DAYTIME_DEFAULT,
-    NIGHTTIME_SHFE_3 + DAYTIME_DEFAULT,
-    NIGHTTIME_DCE + DAYTIME_DEFAULT,
-    NIGHTTIME_CZCE + DAYTIME_DEFAULT,
-]
-
-# 有夜盘的品种代码到时间线的映射
-NIGHTTIME_CODE_MAPPING = {
-    # 上期所
-    CODE_AU: 0, CODE_AG: 0,
-    CODE_CU: 1, CODE_AL: 1, CODE_ZN: 1, CODE_PB: 1, CODE_SN: 1, CODE_NI: 1,
-    CODE_RU: 2, CODE_RB: 2, CODE_HC: 2, CODE_BU: 2,
-    # 大商所
-    CODE_P: 3, CODE_J: 3, CODE_M: 3, CODE_Y: 3, CODE_A: 3, CODE_B: 3, CODE_JM: 3, CODE_I: 3,
-    # 郑商所
-    CODE_SR: 4, CODE_CF: 4, CODE_RM: 4, CODE_MAPTA: 4, CODE_ZC: 4, CODE_FG: 4, CODE_OI: 4,
-}
+# 交易时间配置文件
+SESSION_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'CTADR_session.json')
+
+# 一天的分钟数
+MINUTES_OF_DAY = 1440
+
+# 小时偏移量对应的分钟数
+BIAS_MINUTES = HOUR_BIAS * 60
+
+# 时间线名 => 交易时间线，含小时偏移量
+TRADING_TIMELINES = {}
+
+# 交易所 => 该交易所未单独配置品种的时间线名
+EXCHANGE_TIMELINES = {}
+
+# 品种代码 => 时间线名
+PRODUCT_TIMELINES = {}
+
+# 合约代码 => 交易时间线
+_symbol_timelines = {}
+
+# 合约代码 => 有效分钟表
+_symbol_valid_minutes = {}
+
+# 交易时间线替换后调用的函数，用于清除其他模块中按合约缓存的、依赖交易时间线的结果
+_sessions_listeners = []
+
+
+def load_sessions(filename=SESSION_FILE):
+    """读取交易时间配置文件，替换当前的交易时间线
+    配置文件中的时间不含小时偏移量，每个时间线为按交易顺序排列的[开始时间, 结束时间]列表，
+    有夜盘的品种夜盘在前。替换后清除按合约缓存的交易时间线，并通知add_sessions_listener注册的函数。
+
+    :param filename: 配置文件名
+    :return:
+    """
+    with open(filename) as fp:
+        settings = json.load(fp)
+
+    timelines = {}
+    for name, sessions in settings['timelines'].items():
+        timeline = []
+        for open_time, close_time in sessions:
+            timeline.append(Tradetime(hour_bias_helper(_parse_session_time(open_time)), OPEN))
+            timeline.append(Tradetime(hour_bias_helper(_parse_session_time(close_time)), CLOSE))
+        if timeline != sorted(timeline):
+            raise ValueError('交易时间线{}的时间点未按顺序排列。'.format(name))
+        timelines[str(name)] = timeline
+
+    for name in settings['exchanges'].values() + settings['products'].values():
+        if name not in timelines:
+            raise ValueError('交易时间线{}不存在。'.format(name))
+
+    TRADING_TIMELINES.clear()
+    TRADING_TIMELINES.update(timelines)
+    EXCHANGE_TIMELINES.clear()
+    EXCHANGE_TIMELINES.update((str(k), str(v)) for k, v in settings['exchanges'].items())
+    PRODUCT_TIMELINES.clear()
+    PRODUCT_TIMELINES.update((str(k), str(v)) for k, v in settings['products'].items())
+
+    _symbol_timelines.clear()
+    _symbol_valid_minutes.clear()
+    for listener in _sessions_listeners:
+        listener()
+
+
+def add_sessions_listener(listener):
+    """注册交易时间线替换后调用的函数，参照load_sessions
+
+    :param listener: 无参数的函数
+    :return:
+    """
+    _sessions_listeners.append(listener)
+
+
+def _parse_session_time(s):
+    """解析配置文件中HH:MM格式的时间"""
+    return dt.datetime.strptime(s, '%H:%M').time()
 
 
 def timeline_for_tick(tick):
-    """从TRADE_TIMES中获取该tick所属的时间线
-    判定仅使用tick中的symbol和exchange属性，其余属性均不使用。
+    """获取该tick所属品种的交易时间线
+    判定仅使用tick中的symbol和exchange属性，其余属性均不使用，结果按合约代码缓存。
+    品种未单独配置时使用交易所的时间线。
 
     :param tick: VtTickData
     :return: 时间线列表（[TradeTime, ...]）
     """
-    # 从合约代码中提取品种
-    code = tick.symbol.strip().rstrip('0123456789').upper()
+    timeline = _symbol_timelines.get(tick.symbol)
+    if timeline is None:
+        # 从合约代码中提取品种
+        code = tick.symbol.strip().rstrip('0123456789').upper()
+
+        name = PRODUCT_TIMELINES.get(code) or EXCHANGE_TIMELINES.get(tick.exchange)
+        if name is None:
+            raise LookupError('找不到Tick数据对应的交易时间线。')
+
+        timeline = _symbol_timelines[tick.symbol] = TRADING_TIMELINES[name]
+    return timeline
 
-    # 有夜盘的品种
-    if code in NIGHTTIME_CODE_MAPPING:
-        return TRADING_TIMELINES_WITH_NIGHTTIME[NIGHTTIME_CODE_MAPPING[code]]
 
-    # 日盘品种
-    if tick.exchange in TRADING_TIMELINES:
-        if tick.exchange == EXCHANGE_CFFEX:  # TODO 暂未实现识别方法
-            raise NotImplementedError('中金所股指、国债暂不支持。')
-        return TRADING_TIMELINES[tick.exchange]
+def compile_valid_minutes(timeline):
+    """将交易时间线编译为有效分钟表
+
+    :param timeline: 交易时间线
+    :return: 长度为MINUTES_OF_DAY的bytearray，以偏移后的分钟数为索引，交易时间内的分钟为1，其余为0
+    """
+    # 尝试从缓存中获取已计算的结果
+    memorize_key = tuple(timeline)
+    if memorize_key in compile_valid_minutes.__dict__:
+        return compile_valid_minutes.__dict__[memorize_key]
 
-    # TODO 该判断方法属于权宜之计，今后有时间一定要将所有品种逐一映射到时间线
+    valid_minutes = bytearray(MINUTES_OF_DAY)
+    for minute in range(MINUTES_OF_DAY):
+        # 在时间线中用二分法检索该分钟所在时间范围的起始
+        # 如在一天的交易时间之前则idx为-1，由于Python索引的特性，
+        # idx自动指向时间线末尾的收盘时间点，因此不存在问题。
+        idx = bisect.bisect_right(timeline, Tradetime(dt.time(minute // 60, minute % 60), OPEN)) - 1
+        valid_minutes[minute] = timeline[idx].oc
 
-    raise LookupError('找不到Tick数据对应的交易时间线。')
+    compile_valid_minutes.__dict__[memorize_key] = valid_minutes
+    return valid_minutes
 
 
 def is_valid_tick(tick):
     """验证Tick是否在有效交易时间段
+    找不到交易时间线的合约的tick均视为无效，只在首次遇到时输出提示，不在tick处理中抛出异常。
 
     :param tick: VtTickData
     :return: True/False
     """
-    timeline = timeline_for_tick(tick)
-    # print(tick.vtSymbol, timeline)
+    valid_minutes = _symbol_valid_minutes.get(tick.symbol)
+    if valid_minutes is None:
+        try:
+            valid_minutes = compile_valid_minutes(timeline_for_tick(tick))
+        except LookupError:
+            print('合约{}（交易所{}）找不到交易时间线，其tick均视为无效。'.format(tick.symbol, tick.exchange))
+            valid_minutes = bytearray(MINUTES_OF_DAY)
+        _symbol_valid_minutes[tick.symbol] = valid_minutes
 
     # 取时间部分，加上时间偏移量
-    tick_time = Tradetime(hour_bias_helper(tick.datetime.time()), OPEN)
+    datetime = tick.datetime
+    return valid_minutes[(datetime.hour * 60 + datetime.minute + BIAS_MINUTES) % MINUTES_OF_DAY] == 1
 
-    # 在时间线中用二分法检索tick所在时间范围的起始
-    # 如tick时间在一天的交易时间之前则idx为-1，由于Python索引的特性，
-    # idx自动指向时间线末尾的收盘时间点，因此不存在问题。
-    idx = bisect.bisect_right(timeline, tick_time) - 1
-    # print(timeline[idx])
 
-    return timeline[idx].oc
+load_sessions()